@@ -1,5 +1,14 @@
 import os
 from argparse import ArgumentParser, ArgumentTypeError, Namespace
+from typing import Optional
+
+from .state import DEFAULT_STATE_PATH
+from .watch import DEFAULT_DEBOUNCE
+from ..utils.compression import CODECS, check_codec
+from ..utils.packs import DEFAULT_PACK_SIZE
+from ..utils.size import parse_size
+from ..utils.throttle import BandwidthRule, parse_bandwidth_rule
+from ..utils.watcher import DEFAULT_POLL_INTERVAL
 
 
 class Arguments:
@@ -13,6 +22,27 @@ class Arguments:
         self.source_dir: str = args.source
         self.bucket_name: str = args.destination[0]
         self.bucket_dir: str = args.destination[1]
+        self.jobs: int = args.jobs
+        self.stream: bool = args.stream
+        self.pack_threshold: int = args.pack
+        self.pack_size: int = args.pack_size
+        self.dedup: bool = args.dedup
+        self.hash_processes: Optional[int] = args.hash_processes
+        self.delta_threshold: int = args.delta
+        self.compression: Optional[str] = args.compress
+        self.compression_level: Optional[int] = args.compression_level
+        self.state_file: Optional[str] = None if args.no_state else args.state
+        self.reconcile: bool = args.reconcile
+        self.mirror: bool = args.mirror
+        self.snapshot: bool = not args.no_snapshot
+        self.dry_run: bool = args.dry_run
+        self.watch: bool = args.watch
+        self.debounce: float = args.debounce
+        self.poll_interval: float = args.poll_interval
+        self.report_file: Optional[str] = args.report
+        self.profile_file: Optional[str] = args.profile
+        self.bandwidth_rules: list[BandwidthRule] = args.max_bandwidth
+        self.reconcile_interval: float = args.reconcile_interval * 24 * 60 * 60
 
 
 def parse_arguments() -> Arguments:
@@ -25,7 +55,67 @@ def parse_arguments() -> Arguments:
     parser.add_argument('source', metavar='directory', type=directory, help='directory to backup')
     parser.add_argument('destination', metavar='bucket::directory', type=bucket_and_directory,
                         help='bucket and directory to backup to')
-    return Arguments(parser.parse_args())
+    parser.add_argument('-j', '--jobs', type=positive_integer, default=1,
+                        help='number of files to back up concurrently (default: 1)')
+    parser.add_argument('--stream', action='store_true',
+                        help='start backing up files while the directory is still being scanned')
+    storage_format = parser.add_mutually_exclusive_group()
+    storage_format.add_argument('--pack', metavar='size', type=size, default=0,
+                                help='pack files smaller than this size (e.g. 64KB) into larger objects')
+    storage_format.add_argument('--dedup', action='store_true',
+                                help='store each distinct file content only once, shared across the whole bucket')
+    parser.add_argument('--delta', metavar='size', type=size, default=0,
+                        help='back up files at least this size (e.g. 16MB) as chunks, uploading only changed chunks')
+    parser.add_argument('--hash-processes', metavar='count', type=positive_integer,
+                        help='number of processes to hash files in when deduplicating or chunking '
+                             '(default: number of CPUs)')
+    parser.add_argument('--pack-size', metavar='size', type=size, default=DEFAULT_PACK_SIZE,
+                        help='size of the objects files are packed into (default: 64MB)')
+    parser.add_argument('--compress', metavar='codec', type=codec,
+                        help=f'compress files as they are backed up ({" or ".join(CODECS)})')
+    parser.add_argument('--compression-level', metavar='level', type=int,
+                        help=f'compression level (default: {", ".join(f"{c} {l}" for c, l in CODECS.items())})')
+    parser.add_argument('--state', metavar='file', default=DEFAULT_STATE_PATH,
+                        help='state database used to skip unchanged files (default: %(default)s)')
+    parser.add_argument('--no-state', action='store_true',
+                        help='check every file against the bucket instead of using a state database')
+    parser.add_argument('--reconcile', action='store_true',
+                        help='reconcile the state database with the bucket before backing up')
+    parser.add_argument('--reconcile-interval', metavar='days', type=non_negative_number, default=7,
+                        help='reconcile the state database if it has not been for this many days (default: 7)')
+    parser.add_argument('--mirror', action='store_true',
+                        help='delete objects from the bucket directory whose files no longer exist in the directory')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only list the objects --mirror would delete, without backing up or deleting anything')
+    parser.add_argument('--no-snapshot', action='store_true',
+                        help='do not record a snapshot of the backup that it can be restored from later')
+    parser.add_argument('--watch', action='store_true',
+                        help='after backing up, keep running and back up files as they change')
+    parser.add_argument('--debounce', metavar='seconds', type=non_negative_number, default=DEFAULT_DEBOUNCE,
+                        help='when watching, wait until no changes are made for this long before backing them up '
+                             '(default: %(default)s)')
+    parser.add_argument('--poll-interval', metavar='seconds', type=positive_number, default=DEFAULT_POLL_INTERVAL,
+                        help='when watching without inotify, scan the directory for changes this often '
+                             '(default: %(default)s)')
+    parser.add_argument('--max-bandwidth', metavar='rate[@start-end]', type=bandwidth_rule, action='append',
+                        default=[],
+                        help='limit the bandwidth of all transfers combined (e.g. 50Mbps or 5MB/s), optionally only '
+                             'between two times of day (e.g. 50Mbps@9-17); repeat to schedule several limits')
+    parser.add_argument('--report', metavar='file',
+                        help='write metrics of the run (requests, latencies, and time spent in each phase) as JSON')
+    parser.add_argument('--profile', metavar='file',
+                        help='write a cProfile profile of the run, which can be read with pstats')
+    args = parser.parse_args()
+    if args.dedup and args.delta:
+        parser.error('argument --delta: not allowed with argument --dedup')
+    if args.dry_run and not args.mirror:
+        parser.error('argument --dry-run: requires argument --mirror')
+    if args.watch:
+        for option, value in (('--pack', args.pack), ('--dedup', args.dedup), ('--delta', args.delta),
+                              ('--dry-run', args.dry_run)):
+            if value:
+                parser.error(f'argument --watch: not allowed with argument {option}')
+    return Arguments(args)
 
 
 def directory(raw_path: str) -> str:
@@ -41,3 +131,61 @@ def bucket_and_directory(name: str) -> tuple[str, str]:
     if len(elements) != 2:
         raise ArgumentTypeError('missing bucket directory')
     return elements[0], elements[1]
+
+
+def positive_integer(raw_integer: str) -> int:
+    """Meant to be used a type converter for ArgumentParser.add_argument()."""
+    try:
+        integer = int(raw_integer)
+    except ValueError:
+        raise ArgumentTypeError('not an integer')
+    if integer < 1:
+        raise ArgumentTypeError('must be at least 1')
+    return integer
+
+
+def non_negative_number(raw_number: str) -> float:
+    """Meant to be used a type converter for ArgumentParser.add_argument()."""
+    try:
+        number = float(raw_number)
+    except ValueError:
+        raise ArgumentTypeError('not a number')
+    if number < 0:
+        raise ArgumentTypeError('must not be negative')
+    return number
+
+
+def positive_number(raw_number: str) -> float:
+    """Meant to be used a type converter for ArgumentParser.add_argument()."""
+    try:
+        number = float(raw_number)
+    except ValueError:
+        raise ArgumentTypeError('not a number')
+    if number <= 0:
+        raise ArgumentTypeError('must be positive')
+    return number
+
+
+def size(raw_size: str) -> int:
+    """Meant to be used a type converter for ArgumentParser.add_argument()."""
+    try:
+        return parse_size(raw_size)
+    except ValueError as e:
+        raise ArgumentTypeError(str(e))
+
+
+def codec(name: str) -> str:
+    """Meant to be used a type converter for ArgumentParser.add_argument()."""
+    try:
+        check_codec(name)
+    except ValueError as e:
+        raise ArgumentTypeError(str(e))
+    return name
+
+
+def bandwidth_rule(raw_rule: str) -> BandwidthRule:
+    """Meant to be used a type converter for ArgumentParser.add_argument()."""
+    try:
+        return parse_bandwidth_rule(raw_rule)
+    except ValueError as e:
+        raise ArgumentTypeError(str(e))
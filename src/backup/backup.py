@@ -1,11 +1,31 @@
+import hashlib
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from typing import Callable, Optional
+from threading import Lock
+from typing import Callable, Iterable, Optional
 
 import boto3
+from boto3.exceptions import S3UploadFailedError
 from botocore.exceptions import ClientError
 
+from .state import BackupState, UploadState
+from ..utils.chunks import (AVERAGE_CHUNK_SIZE, CHUNK_KIND, Chunk, DeltaEntry, DeltaIndex, chunk_file,
+                            chunk_manifest_digest, get_delta_index, put_chunk, put_chunk_manifest, put_delta_index)
+from ..utils.compression import COMPRESSION_METADATA, CompressingReader
+from ..utils.concurrency import AdaptiveConcurrency
+from ..utils.dedup import BlobStore, DedupEntry, DedupManifest, get_dedup_manifest, hash_files, put_dedup_manifest
+from ..utils.listing import ObjectIndex, list_bucket_directory
+from ..utils.multipart import (MULTIPART_THRESHOLD, EtagReader, abort_multipart_upload, choose_concurrency,
+                               choose_part_size, transfer_config, upload_multipart)
+from ..utils.packs import (DEFAULT_PACK_SIZE, PackIndex, PackWriter, delete_packs, get_pack_index, pack_key,
+                           put_pack_index)
+from ..utils.progress import FileTransfer, ProgressLogger
+from ..utils.scanner import FileEntry, scan_directory
+from ..utils.snapshots import OBJECT_KIND, Snapshot, SnapshotEntry, get_snapshot_references
+from ..utils.workers import run_workers
+
 
 def create_bucket(bucket_name: str, s3_client=None) -> bool:
     """
@@ -26,12 +46,13 @@ def create_bucket(bucket_name: str, s3_client=None) -> bool:
     except ClientError:
         pass
     # Prepare to try to create the bucket.
+    # Buckets in us-east-1 are created without a location constraint, as S3 rejects it there.
     region = s3_client.meta.region_name
-    bucket_config = {'LocationConstraint': region}
+    extra_args = {} if region == 'us-east-1' else {'CreateBucketConfiguration': {'LocationConstraint': region}}
     # Try to create the bucket.
     print('Attempting to create the bucket...', end='')
     try:
-        s3_client.create_bucket(Bucket=bucket_name, CreateBucketConfiguration=bucket_config)
+        s3_client.create_bucket(Bucket=bucket_name, **extra_args)
     except ClientError as e:
         # If creating the bucket failed, then print an error message and return False.
         error_code = e.response['Error']['Code']
@@ -64,10 +85,44 @@ def print_create_bucket_error(error_code: str, bucket_name: str) -> bool:
 
 
 def backup_directory(directory: str, bucket_name: str, bucket_directory: str, s3_client=None,
-                     followlinks: bool = False, callback: Optional[Callable[[str, bool], None]] = None) -> None:
+                     followlinks: bool = False, callback: Optional[Callable[[str, bool], None]] = None,
+                     object_index: Optional[ObjectIndex] = None, jobs: int = 1,
+                     state: Optional[BackupState] = None, files: Optional[Iterable[FileEntry]] = None,
+                     progress: Optional[ProgressLogger] = None, pack_threshold: int = 0,
+                     pack_size: int = DEFAULT_PACK_SIZE, compression: Optional[str] = None,
+                     compression_level: Optional[int] = None, dedup: bool = False,
+                     hash_processes: Optional[int] = None, delta_threshold: int = 0,
+                     concurrency: Optional[AdaptiveConcurrency] = None, snapshot: Optional[Snapshot] = None,
+                     previous_snapshot: Optional[Snapshot] = None, quiet: bool = False) -> None:
     """
     Backs up the directory to the bucket.
 
+    Files that match their entry in the state database are skipped without making any requests.
+    Rather than checking the remaining files against the bucket individually,
+    the bucket directory is listed once (when first needed) and every file is checked against that listing.
+
+    If packing is enabled, files smaller than the pack threshold are instead appended into pack objects,
+    and checked against the pack index uploaded by the previous backup.
+    A new pack index is uploaded at the end of the backup, and packs it no longer references are deleted.
+
+    If deduplication is enabled, every file is instead hashed and stored as a blob named after its contents,
+    which is shared by every file (in any backed up directory in the bucket) with the same contents.
+    Unchanged files are checked against the dedup manifest uploaded by the previous backup,
+    and a new dedup manifest is uploaded at the end of the backup.
+    Deduplication and packing can't both be enabled.
+
+    If delta backups are enabled, files at least as large as the delta threshold are instead split into
+    content-defined chunks, and only the chunks that aren't already stored are uploaded.
+    Like blobs, chunks are shared by every backed up directory in the bucket.
+    Each file's chunks are listed in its own chunk manifest,
+    and unchanged files are checked against the delta index uploaded by the previous backup.
+    Deduplication and delta backups can't both be enabled.
+
+    If compression is enabled, every file that isn't packed is compressed as it is uploaded.
+
+    Uploads of files, blobs, and chunks that S3 throttles (e.g. with SlowDown) are retried with backoff,
+    and the number of them in flight adapts to throttling (see AdaptiveConcurrency).
+
     :param directory: The directory to back up.
     :param bucket_name: The name of the bucket to back up the directory to.
     :param bucket_directory: The name of the backed up directory in the bucket.
@@ -76,35 +131,408 @@ def backup_directory(directory: str, bucket_name: str, bucket_directory: str, s3
     :param callback: An optional callback function that will be called after each file is backed up.
                      The parameters are the backed up file's path,
                      and whether the file was backed up or not.
+                     Calls to the callback are never made concurrently, even if jobs is greater than 1.
+    :param object_index: The objects already in the bucket directory.
+                         The bucket directory will be listed if none is specified.
+    :param jobs: The number of files to back up concurrently.
+    :param state: The state database to check files against and record backed up files in, if any.
+    :param files: The files in the directory, from scan_directory().
+                  The directory will be scanned if none are specified.
+    :param progress: An optional ProgressLogger to complete each file in after it is backed up.
+                     Unlike using ProgressLogger.complete_file() as the callback,
+                     this uses the size from the scan rather than stat'ing every file again.
+                     If one is specified, only the files that fail to back up are printed.
+    :param pack_threshold: Files smaller than this many bytes are packed. Packing is disabled if this is 0.
+    :param pack_size: The size of pack objects in bytes.
+    :param compression: The codec to compress files with (see CODECS), or None to not compress files.
+    :param compression_level: The compression level. The codec's default level is used if none is specified.
+    :param dedup: True to deduplicate files, False otherwise.
+    :param hash_processes: The number of processes to hash files (or chunks of files) in.
+                           Defaults to the number of CPUs.
+    :param delta_threshold: Files at least this many bytes are backed up as chunks.
+                            Delta backups are disabled if this is 0.
+    :param concurrency: The AdaptiveConcurrency to limit uploads in flight with, such as one shared with other
+                        directories, or one instrumenting the client. Defaults to one allowing jobs uploads at once.
+    :param snapshot: The Snapshot to add every backed up file to (including unchanged ones), if any.
+                     Adds the version IDs of uploaded objects if the bucket is versioned,
+                     which costs a head_object() request for each uploaded file (only if it is versioned).
+    :param previous_snapshot: The previous snapshot of the directory, if any,
+                              to take what isn't known about unchanged files (e.g. their version IDs) from.
+    :param quiet: True to only print the files that fail to back up, by their full path,
+                  such as when several directories are backed up at once.
+    :raises ValueError: If deduplication is enabled along with packing or delta backups.
     """
+    if dedup and pack_threshold > 0:
+        raise ValueError('deduplication and packing cannot both be enabled')
+    if dedup and delta_threshold > 0:
+        raise ValueError('deduplication and delta backups cannot both be enabled')
     # Create a simple S3 Client if none was specified.
     if s3_client is None:
         s3_client = boto3.client('s3')
-    # Walk the directory, backing up every file that needs to be backed up.
-    for path, directory_names, file_names in os.walk(directory):
-        relative_path = get_relative_path(path, directory)
-        for file_name in file_names:
-            # Get the absolute path, relative path, and object key of the file.
-            file_path = os.path.join(path, file_name)
-            if not followlinks and os.path.islink(file_path):
-                continue
-            relative_file_path = os.path.join(relative_path, file_name)
-            object_key = os.path.join(bucket_directory, relative_file_path)
+    if concurrency is None:
+        concurrency = AdaptiveConcurrency(jobs)
+    # Only one thread at a time may list the bucket directory.
+    index_lock = Lock()
+    # Only one thread at a time may print or call the callback, so that their output doesn't interleave.
+    # Printing also holds the progress logger's lock, so that the output doesn't interleave with its redraws.
+    output_lock = Lock() if progress is None else progress.lock
+
+    def get_object_index() -> ObjectIndex:
+        # List the objects that are already backed up, the first time they're needed.
+        nonlocal object_index
+        with index_lock:
+            if object_index is None:
+                object_index = list_bucket_directory(bucket_name, bucket_directory, s3_client, jobs)
+        return object_index
+
+    def report(file: FileEntry, backed_up: bool, failed: bool = False, transfer: Optional[FileTransfer] = None) -> None:
+        # Print the result and call the callback if there is one.
+        with output_lock:
+            if failed:
+                print(f'Backing up         {file.path if quiet else file.relative_path}', end='')
+                print('    failed', file=sys.stderr)
+            elif quiet or progress is not None:
+                # Only failures are printed quietly, or when the progress logger is counting the files instead.
+                pass
+            elif backed_up:
+                print(f'Backing up         {file.relative_path}')
+            else:
+                print(f'Already backed up  {file.relative_path}')
+            if callback is not None:
+                callback(file.path, backed_up)
+            if progress is not None:
+                progress.complete(file.size, 0 if transfer is None else transfer.transferred_size)
+
+    def report_pack(packed_files: list[FileEntry], uploaded: bool) -> None:
+        for packed_file in packed_files:
+            # If the pack failed, keep the previous version of the file (if any) in the pack index.
+            previous_entry = previous_pack_index.get(packed_file.relative_path)
+            if not uploaded and previous_entry is not None:
+                pack_writer.keep(packed_file.relative_path, previous_entry)
+            # Count the bytes of uploaded files as transferred, so that they count towards the transfer rate.
+            transfer = FileTransfer(progress)
+            if uploaded:
+                transfer(packed_file.size)
+            report(packed_file, uploaded, failed=not uploaded, transfer=transfer)
+
+    def pack_file(file: FileEntry) -> None:
+        # Keep the file's current entry if it hasn't changed, otherwise pack it again.
+        # The file will be reported once its pack is uploaded.
+        previous_entry = previous_pack_index.get(file.relative_path)
+        if previous_entry is not None and previous_entry.mtime_ns == file.mtime_ns \
+                and previous_entry.length == file.size:
+            pack_writer.keep(file.relative_path, previous_entry)
+            report(file, False)
+            return
+        try:
+            pack_writer.add(file)
+        except OSError:
+            report(file, False, failed=True)
+
+    def is_deduplicated(file: FileEntry) -> Optional[str]:
+        # Get the digest of the file from the previous dedup manifest, if the file hasn't changed since.
+        previous_entry = previous_dedup_manifest.get(file.relative_path)
+        if previous_entry is not None and previous_entry.mtime_ns == file.mtime_ns \
+                and previous_entry.size == file.size:
+            return previous_entry.digest
+        return None
+
+    def dedup_file(hashed_file: tuple[FileEntry, Optional[str]]) -> None:
+        file, digest = hashed_file
+        previous_entry = previous_dedup_manifest.get(file.relative_path)
+        # Unchanged files are kept without checking that their blob exists, so that they make no requests.
+        if digest is not None and digest == is_deduplicated(file):
+            dedup_manifest.entries[file.relative_path] = previous_entry
+            report(file, False)
+            return
+        stored = False
+        transfer = FileTransfer(progress)
+        if digest is not None:
+            stored, uploaded = blob_store.store(digest, lambda object_key: concurrency.call(
+                upload_file, file.path, bucket_name, object_key, s3_client, compression, compression_level,
+                transfer, state))
+        if stored:
+            dedup_manifest.entries[file.relative_path] = DedupEntry(digest, file.size, file.mtime_ns)
+        elif previous_entry is not None:
+            # Keep the previous version of the file (if any) in the dedup manifest.
+            dedup_manifest.entries[file.relative_path] = previous_entry
+        report(file, stored, failed=not stored, transfer=transfer)
+
+    def delta_file(file: FileEntry) -> None:
+        # Keep the file's current entry if it hasn't changed, otherwise back up its chunks again.
+        previous_entry = previous_delta_index.get(file.relative_path)
+        if previous_entry is not None and (previous_entry.size, previous_entry.mtime_ns) == (file.size, file.mtime_ns):
+            delta_index.entries[file.relative_path] = previous_entry
+            report(file, False)
+            return
+        transfer = FileTransfer(progress)
+        failed_chunks = []
+
+        def store_chunk(chunk: Chunk) -> None:
+            def upload_chunk(object_key: str) -> None:
+                with open(file.path, 'rb') as f:
+                    f.seek(chunk.offset)
+                    data = f.read(chunk.length)
+                # Never store a chunk under the wrong digest, as chunks are shared.
+                if hashlib.sha256(data).hexdigest() != chunk.digest:
+                    raise OSError(f'{file.path} changed while it was being backed up')
+                concurrency.call(put_chunk, bucket_name, object_key, data, s3_client, compression, compression_level)
+
+            stored, uploaded = chunk_store.store(chunk.digest, upload_chunk)
+            if stored:
+                transfer(chunk.length)
+            else:
+                failed_chunks.append(chunk)
+
+        try:
+            chunks = chunk_file(file.path, file.size, chunk_executor)
+            run_workers(store_chunk, chunks, choose_concurrency(file.size, AVERAGE_CHUNK_SIZE))
+            if not failed_chunks:
+                # Chunk manifests are named after their digests, so a file with the same chunks as before has one.
+                manifest = chunk_manifest_digest(chunks)
+                if previous_entry is None or previous_entry.manifest != manifest:
+                    put_chunk_manifest(bucket_name, bucket_directory, chunks, s3_client)
+                delta_index.entries[file.relative_path] = DeltaEntry(file.size, file.mtime_ns, manifest)
+                report(file, True, transfer=transfer)
+                return
+        except (ClientError, OSError):
+            pass
+        # Keep the previous version of the file (if any) in the delta index.
+        if previous_entry is not None:
+            delta_index.entries[file.relative_path] = previous_entry
+        report(file, False, failed=True, transfer=transfer)
+
+    def backup_file(file: FileEntry) -> None:
+        if pack_writer is not None and file.size < pack_threshold:
+            pack_file(file)
+            return
+        if delta_index is not None and file.size >= delta_threshold:
+            delta_file(file)
+            return
+        file_path, relative_file_path = file.path, file.relative_path
+        object_key = os.path.join(bucket_directory, relative_file_path)
+        failed = False
+        transfer = FileTransfer(progress)
+        # Files that are unchanged since they were recorded in the state database are skipped with their recorded ETag.
+        etag = None if state is None else state.get_unchanged_etag(bucket_name, object_key, file)
+        version_id = None
+        if etag is not None:
+            should_backup_file = False
+        else:
             # Backup the file if needed.
-            should_backup_file = should_backup(file_path, bucket_name, object_key, s3_client)
+            object_info = get_object_index().get(object_key)
+            should_backup_file = object_info is None or is_modified_since(file.mtime, object_info.last_modified)
+            etag = None if object_info is None else object_info.etag
             if should_backup_file:
-                print(f'Backing up         {relative_file_path}', end='')
                 try:
-                    s3_client.upload_file(file_path, bucket_name, object_key)
-                    print()
-                except ClientError:
-                    print('    failed', file=sys.stderr)
+                    etag = concurrency.call(upload_file, file_path, bucket_name, object_key, s3_client, compression,
+                                            compression_level, callback=transfer, state=state)
+                    if versioned:
+                        version_id = get_version_id(bucket_name, object_key, s3_client)
+                except (ClientError, S3UploadFailedError, OSError):
                     should_backup_file = False
+                    failed = True
+            # Record the file, so that it can be skipped next time if it doesn't change.
+            if state is not None and etag is not None:
+                state.record(bucket_name, object_key, file, etag)
+        if snapshot is not None:
+            snapshot_file(file, object_key, etag, version_id, failed)
+        report(file, should_backup_file, failed, transfer)
+
+    def snapshot_file(file: FileEntry, object_key: str, etag: Optional[str], version_id: Optional[str],
+                      failed: bool) -> None:
+        # Fill in what isn't known about the file's object (e.g. when it was skipped) from the previous snapshot,
+        # as long as it's the same file in the same object.
+        previous_entry = None if previous_snapshot is None else previous_snapshot.get(file.relative_path)
+        if previous_entry is not None and (previous_entry.kind != OBJECT_KIND or previous_entry.key != object_key):
+            previous_entry = None
+        if failed:
+            # The object (if any) still holds the previous version of the file.
+            if previous_entry is not None:
+                snapshot.entries[file.relative_path] = previous_entry
+            return
+        if previous_entry is not None and (etag is None or etag == previous_entry.etag) \
+                and (previous_entry.size, previous_entry.mtime_ns) == (file.size, file.mtime_ns):
+            etag = previous_entry.etag
+            version_id = previous_entry.version_id if version_id is None else version_id
+        elif versioned and version_id is None and etag is not None:
+            # The file was skipped, and isn't in the previous snapshot, so look up the version of its object.
+            version_id = get_version_id(bucket_name, object_key, s3_client)
+        snapshot.entries[file.relative_path] = SnapshotEntry(file.size, file.mtime_ns, OBJECT_KIND, object_key,
+                                                             version_id, etag)
+
+    # Only versioned buckets have version IDs to record in the snapshot, which cost a request per uploaded file.
+    versioned = snapshot is not None and is_bucket_versioned(bucket_name, s3_client)
+    # Prepare to pack small files, if packing is enabled.
+    pack_writer = None
+    previous_pack_index = PackIndex()
+    if pack_threshold > 0:
+        previous_pack_index = get_pack_index(bucket_name, bucket_directory, s3_client)
+        pack_writer = PackWriter(bucket_name, bucket_directory, s3_client, pack_size, callback=report_pack,
+                                 concurrency=concurrency)
+    # Prepare to back up large files as chunks, if delta backups are enabled.
+    # Updating the delta index from multiple threads is safe, as each file only sets its own entry.
+    delta_index = None
+    if delta_threshold > 0:
+        previous_delta_index = get_delta_index(bucket_name, bucket_directory, s3_client)
+        delta_index = DeltaIndex()
+        chunk_store = BlobStore(bucket_name, s3_client, kind=CHUNK_KIND)
+    # Scan the directory if needed, backing up every file that needs to be backed up.
+    if files is None:
+        files = scan_directory(directory, followlinks)
+    if dedup:
+        # Hash the files in other processes while they are stored by the workers.
+        # Updating the dedup manifest from multiple threads is safe, as each file only sets its own entry.
+        previous_dedup_manifest = get_dedup_manifest(bucket_name, bucket_directory, s3_client)
+        dedup_manifest = DedupManifest()
+        blob_store = BlobStore(bucket_name, s3_client)
+        run_workers(dedup_file, hash_files(files, hash_processes, known_digest=is_deduplicated), jobs)
+        if snapshot is not None:
+            snapshot.add_indexes(bucket_directory, dedup_manifest=dedup_manifest)
+        try:
+            put_dedup_manifest(bucket_name, bucket_directory, dedup_manifest, s3_client)
+        except ClientError:
+            print('\nFailed to upload the dedup manifest.', file=sys.stderr)
+        return
+    if delta_index is None:
+        run_workers(backup_file, files, jobs)
+    else:
+        # Find the boundaries of chunks and hash them in other processes, shared by every file.
+        with ProcessPoolExecutor(hash_processes) as chunk_executor:
+            run_workers(backup_file, files, jobs)
+        if snapshot is not None:
+            snapshot.add_indexes(bucket_directory, delta_index=delta_index)
+        try:
+            put_delta_index(bucket_name, bucket_directory, delta_index, s3_client)
+        except ClientError:
+            print('\nFailed to upload the delta index.', file=sys.stderr)
+    # Upload the last pack and the new pack index, then delete the packs that are no longer needed.
+    if pack_writer is not None:
+        pack_writer.close()
+        if snapshot is not None:
+            snapshot.add_indexes(bucket_directory, pack_index=pack_writer.pack_index)
+        finish_packing(bucket_name, bucket_directory, previous_pack_index, pack_writer.pack_index, s3_client)
+
+
+def finish_packing(bucket_name: str, bucket_directory: str, previous_pack_index: PackIndex, pack_index: PackIndex,
+                   s3_client=None) -> bool:
+    """
+    Uploads the new pack index, then deletes the packs that were only referenced by the previous pack index,
+    except for those that a snapshot still refers to, so that every snapshot can still be restored.
+    Prints a message if something goes wrong.
+
+    :param bucket_name: The name of the bucket.
+    :param bucket_directory: The name of the backed up directory in the bucket.
+    :param previous_pack_index: The pack index from the previous backup.
+    :param pack_index: The pack index from this backup.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :return: True if the pack index was uploaded, False otherwise.
+    """
+    try:
+        put_pack_index(bucket_name, bucket_directory, pack_index, s3_client)
+    except ClientError:
+        print('\nFailed to upload the pack index.', file=sys.stderr)
+        return False
+    referenced_packs = {entry.pack for entry in pack_index.entries.values()}
+    unreferenced_packs = {entry.pack for entry in previous_pack_index.entries.values()} - referenced_packs
+    try:
+        if unreferenced_packs:
+            references = get_snapshot_references(bucket_name, bucket_directory, s3_client)
+            unreferenced_packs = {pack for pack in unreferenced_packs
+                                  if pack_key(bucket_directory, pack) not in references}
+        delete_packs(bucket_name, bucket_directory, unreferenced_packs, s3_client)
+    except ClientError:
+        print('\nFailed to delete unreferenced packs.', file=sys.stderr)
+    except OSError:
+        print('\nFailed to read the snapshots, so unreferenced packs were not deleted.', file=sys.stderr)
+    return True
+
+
+def upload_file(file_path: str, bucket_name: str, object_key: str, s3_client=None,
+                compression: Optional[str] = None, compression_level: Optional[int] = None,
+                callback: Optional[Callable[[int], None]] = None, state: Optional[BackupState] = None) -> str:
+    """
+    Uploads the file, optionally compressing it as it is uploaded.
+    The codec of a compressed file is recorded in the object's metadata, so that it can be decompressed when restored.
+
+    Large files are uploaded in parts, with the part size and the number of parts uploaded concurrently
+    chosen from the size of the file (see choose_part_size()).
+    If a state database is specified, large uncompressed files are uploaded resumably:
+    the multipart upload is recorded in the state database,
+    so that if it doesn't finish, the next upload of the unchanged file only uploads the missing parts.
+
+    :param file_path: The file path on this machine.
+    :param bucket_name: The name of the bucket.
+    :param object_key: The name/key of the object in the bucket.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :param compression: The codec to compress the file with (see CODECS), or None to not compress the file.
+    :param compression_level: The compression level. The codec's default level is used if none is specified.
+    :param callback: An optional callback function that will be called as the file is uploaded.
+                     The parameter is the number of bytes of the file uploaded since the last call
+                     (before compression, so that they add up to the size of the file).
+    :param state: The state database to record unfinished multipart uploads in, if any.
+    :return: The ETag of the uploaded object, computed locally or taken from the response rather than requested.
+    """
+    # Create a simple S3 Client if none was specified.
+    if s3_client is None:
+        s3_client = boto3.client('s3')
+    stat = os.stat(file_path)
+    if compression is None and stat.st_size >= MULTIPART_THRESHOLD:
+        return upload_large_file(file_path, bucket_name, object_key, s3_client, stat, callback, state)
+    # Compressed files are uploaded as a stream, which can't be resumed, but still use the chosen part size.
+    config = transfer_config(stat.st_size)
+    if compression is None:
+        with open(file_path, 'rb') as f:
+            # Compute the ETag as the file is uploaded, rather than reading the file again afterwards.
+            reader = EtagReader(f, config.multipart_chunksize)
+            s3_client.upload_fileobj(reader, bucket_name, object_key, Callback=callback, Config=config)
+        return reader.etag
+    with open(file_path, 'rb') as f:
+        # Compute the ETag of the compressed contents as they are uploaded, as they're never written anywhere.
+        reader = EtagReader(CompressingReader(f, compression, compression_level, callback), config.multipart_chunksize)
+        s3_client.upload_fileobj(reader, bucket_name, object_key, Config=config,
+                                 ExtraArgs={'Metadata': {COMPRESSION_METADATA: compression}})
+    return reader.etag
+
+
+def upload_large_file(file_path: str, bucket_name: str, object_key: str, s3_client, stat: os.stat_result,
+                      callback: Optional[Callable[[int], None]] = None, state: Optional[BackupState] = None) -> str:
+    """
+    Uploads a large file in parts, resuming its unfinished multipart upload from the state database if there is one.
+    An unfinished upload of a different version of the file is aborted instead.
+
+    :param file_path: The file path on this machine.
+    :param bucket_name: The name of the bucket.
+    :param object_key: The name/key of the object in the bucket.
+    :param s3_client: The S3 Client to use.
+    :param stat: The result of os.stat() on the file.
+    :param callback: An optional callback function that will be called as the file is uploaded.
+                     The parameter is the number of bytes of the file uploaded since the last call.
+    :param state: The state database to record the multipart upload in, if any.
+    :return: The ETag of the uploaded object.
+    """
+    part_size = choose_part_size(stat.st_size)
+    upload_id = None
+    on_create = None
+    if state is not None:
+        previous_upload = state.get_upload(bucket_name, object_key)
+        if previous_upload is not None:
+            if (previous_upload.size, previous_upload.mtime_ns, previous_upload.part_size) \
+                    == (stat.st_size, stat.st_mtime_ns, part_size):
+                upload_id = previous_upload.upload_id
             else:
-                print(f'Already backed up  {relative_file_path}')
-            # Call the callback if there is one.
-            if callback is not None:
-                callback(file_path, should_backup_file)
+                abort_multipart_upload(bucket_name, object_key, previous_upload.upload_id, s3_client)
+                state.forget_upload(bucket_name, object_key)
+
+        def on_create(new_upload_id: str) -> None:
+            state.record_upload(bucket_name, object_key,
+                                UploadState(new_upload_id, stat.st_size, stat.st_mtime_ns, part_size))
+
+    etag = upload_multipart(file_path, bucket_name, object_key, s3_client, part_size, upload_id=upload_id,
+                            on_create=on_create, callback=callback)
+    if state is not None:
+        state.forget_upload(bucket_name, object_key)
+    return etag
 
 
 def should_backup(file_path: str, bucket_name: str, object_key: str, s3_client=None) -> bool:
@@ -113,6 +541,8 @@ def should_backup(file_path: str, bucket_name: str, object_key: str, s3_client=N
 
     If the file has not been backed up (object_key is not present in the bucket) then it should be backed up.
     Otherwise, the file should be backed up if it has been modified more recently than the current backup.
+    This makes one request per file; backup_directory() checks against a single listing instead.
+    Only modification times are compared, so this works even if the file was compressed when it was backed up.
 
     :param file_path: The file path on this machine.
     :param bucket_name: The name of the bucket.
@@ -130,8 +560,53 @@ def should_backup(file_path: str, bucket_name: str, object_key: str, s3_client=N
     except ClientError:
         # If the object_key could not be found, the file needs to be backed up.
         return True
-    # Get the last modified date of the local file.
-    local_timestamp = os.path.getmtime(file_path)
+    return is_modified_since(os.path.getmtime(file_path), backup_last_modified)
+
+
+def is_bucket_versioned(bucket_name: str, s3_client=None) -> bool:
+    """
+    Determines if versioning is enabled on the bucket.
+
+    :param bucket_name: The name of the bucket.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :return: True if versioning is enabled, or if it couldn't be determined (e.g. it isn't allowed), False otherwise.
+    """
+    # Create a simple S3 Client if none was specified.
+    if s3_client is None:
+        s3_client = boto3.client('s3')
+    try:
+        return s3_client.get_bucket_versioning(Bucket=bucket_name).get('Status') == 'Enabled'
+    except ClientError:
+        return True
+
+
+def get_version_id(bucket_name: str, object_key: str, s3_client=None) -> Optional[str]:
+    """
+    Gets the version ID of the object.
+
+    :param bucket_name: The name of the bucket.
+    :param object_key: The name/key of the object in the bucket.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :return: The version ID of the object, or None if the object could not be found or the bucket isn't versioned.
+    """
+    # Create a simple S3 Client if none was specified.
+    if s3_client is None:
+        s3_client = boto3.client('s3')
+    try:
+        response = s3_client.head_object(Bucket=bucket_name, Key=object_key)
+    except ClientError:
+        return None
+    return response.get('VersionId')
+
+
+def is_modified_since(local_timestamp: float, backup_last_modified: datetime) -> bool:
+    """
+    Determines if a file has been modified more recently than its backup.
+
+    :param local_timestamp: The last modified time of the file on this machine (e.g. from os.path.getmtime()).
+    :param backup_last_modified: The last modified date of the backed up object.
+    :return: True if the file has been modified since it was backed up, False otherwise.
+    """
     local_last_modified = datetime.fromtimestamp(local_timestamp)
     local_last_modified = local_last_modified.astimezone()
     return local_last_modified > backup_last_modified
@@ -1,28 +1,144 @@
-import boto3
+import sys
+from functools import partial
 
-from .args import parse_arguments
+from botocore.exceptions import ClientError
+
+from .args import Arguments, parse_arguments
 from .backup import backup_directory, create_bucket
+from .mirror import mirror_directory
+from .state import BackupState
+from .watch import watch_directory
+from ..utils.client import create_client
+from ..utils.concurrency import AdaptiveConcurrency
+from ..utils.listing import list_bucket_directory
+from ..utils.metrics import Metrics, run_with_metrics
 from ..utils.progress import ProgressLogger
-from ..utils.size import directory_summary, format_size
+from ..utils.scanner import scan_directory
+from ..utils.size import files_summary, format_size
+from ..utils.snapshots import DEFAULT_SNAPSHOT_CACHE, LATEST_SNAPSHOT, Snapshot, get_snapshot, put_snapshot
+from ..utils.throttle import RateLimiter, throttle_client
+from ..utils.watcher import InotifyWatcher, create_watcher
+from ..utils.workers import prefetch
 
 
 def main():
     args = parse_arguments()
+    run_with_metrics(partial(backup, args), args.report_file, args.profile_file)
+
+
+def backup(args: Arguments, metrics: Metrics) -> None:
+    """
+    Runs the backup program.
+
+    :param args: The parsed command line arguments.
+    :param metrics: The Metrics to record the phases of the program and the requests of its client in.
+    """
     # Create a reusable client and the bucket.
-    s3_client = boto3.client('s3')
-    if not create_bucket(args.bucket_name, s3_client):
+    s3_client = create_client(args.jobs)
+    metrics.instrument(s3_client)
+    # Adapt the number of transfers in flight to throttling and latency, up to the number of jobs.
+    concurrency = AdaptiveConcurrency(args.jobs)
+    concurrency.instrument(s3_client)
+    # Share one bandwidth limit between every transfer, if any was specified.
+    if args.bandwidth_rules:
+        throttle_client(s3_client, RateLimiter(args.bandwidth_rules))
+    with metrics.phase('create_bucket'):
+        if not create_bucket(args.bucket_name, s3_client):
+            return
+    # Only list what would be deleted, if this is a dry run.
+    if args.dry_run:
+        print('Finding objects whose files no longer exist...')
+        with metrics.phase('mirror'):
+            mirror_directory(args.source_dir, args.bucket_name, args.bucket_dir, s3_client, args.jobs, dry_run=True)
         return
+    # Open the state database, reconciling it with the bucket if requested or if it's been a while.
+    state = None
+    object_index = None
+    if args.state_file is not None:
+        state = BackupState(args.state_file)
+        if args.reconcile or state.needs_reconcile(args.bucket_name, args.bucket_dir, args.reconcile_interval):
+            print('Reconciling the state database with the bucket...')
+            with metrics.phase('reconcile'):
+                object_index = list_bucket_directory(args.bucket_name, args.bucket_dir, s3_client, args.jobs)
+                stale_entries = state.reconcile(args.bucket_name, args.bucket_dir, object_index)
+            print(f'Removed {stale_entries} stale entries.')
+    # Prepare to record a snapshot of the backup, filling in unchanged files from the previous snapshot.
+    snapshot = None
+    previous_snapshot = None
+    if args.snapshot:
+        snapshot = Snapshot()
+        with metrics.phase('get_snapshot'):
+            try:
+                previous_snapshot = get_snapshot(args.bucket_name, args.bucket_dir, LATEST_SNAPSHOT, s3_client)
+            except ClientError:
+                pass
+    # Start watching before the backup, so that no changes made during it are missed.
+    # Ignore the state database and the snapshot cache, in case they are in the directory (e.g. watching ~),
+    # as backing up each change writes to them, which would otherwise be found as another change, forever.
+    watcher = None
+    if args.watch:
+        ignored_paths = [DEFAULT_SNAPSHOT_CACHE] + ([] if state is None else state.file_paths)
+        watcher = create_watcher(args.source_dir, args.poll_interval, ignored_paths)
     # Prepare the progress logger and print a cool sounding message for the user to read.
-    print('Calculating the size of the directory...')
-    directory_info = directory_summary(args.source_dir)
-    progress = ProgressLogger(directory_info.file_count, directory_info.total_size)
-    formatted_directory_size = format_size(directory_info.total_size)
-    print(f'Backing up {directory_info.file_count} files ({formatted_directory_size}).')
+    if args.stream:
+        # Scan in the background, backing up files as soon as they're found.
+        progress = ProgressLogger(scanning=True)
+        files = prefetch(progress.discover(scan_directory(args.source_dir)))
+        print('Backing up files as they are found...')
+    else:
+        print('Calculating the size of the directory...')
+        with metrics.phase('scan'):
+            files = list(scan_directory(args.source_dir))
+            directory_info = files_summary(files)
+        progress = ProgressLogger(directory_info.file_count, directory_info.total_size)
+        formatted_directory_size = format_size(directory_info.total_size)
+        print(f'Backing up {directory_info.file_count} files ({formatted_directory_size}).')
     progress.print_progress_info()
-    # Begin the backup.
-    backup_directory(args.source_dir, args.bucket_name, args.bucket_dir,
-                     s3_client=s3_client, callback=progress.complete_file)
-    print('\nBackup completed.')
+    # Begin the backup. When streaming, scanning happens during this phase.
+    try:
+        with metrics.phase('backup'):
+            backup_directory(args.source_dir, args.bucket_name, args.bucket_dir,
+                             s3_client=s3_client, jobs=args.jobs, object_index=object_index, state=state,
+                             files=files, progress=progress, pack_threshold=args.pack_threshold,
+                             pack_size=args.pack_size, compression=args.compression,
+                             compression_level=args.compression_level, dedup=args.dedup,
+                             hash_processes=args.hash_processes, delta_threshold=args.delta_threshold,
+                             concurrency=concurrency, snapshot=snapshot, previous_snapshot=previous_snapshot)
+        # Redraw the final progress, in case the last redraw was skipped.
+        progress.print_progress_info()
+        print()
+        if snapshot is not None:
+            with metrics.phase('put_snapshot'):
+                try:
+                    put_snapshot(args.bucket_name, args.bucket_dir, snapshot, s3_client)
+                    print(f'Recorded the snapshot {snapshot.snapshot_id}.')
+                except (ClientError, OSError):
+                    print('Failed to record the snapshot.', file=sys.stderr)
+        # Delete the objects of files that no longer exist, once every file that does exist is backed up.
+        if args.mirror:
+            print('Deleting objects whose files no longer exist...')
+            with metrics.phase('mirror'):
+                mirror_directory(args.source_dir, args.bucket_name, args.bucket_dir, s3_client, args.jobs,
+                                 state=state)
+        print('Backup completed.')
+        # Keep backing up changes as they're made, if watching.
+        if watcher is not None:
+            if isinstance(watcher, InotifyWatcher):
+                print('Watching for changes (press Ctrl+C to stop)...')
+            else:
+                print(f'Scanning for changes every {args.poll_interval:g} seconds (press Ctrl+C to stop)...')
+            with metrics.phase('watch'):
+                watch_directory(watcher, args.bucket_name, args.bucket_dir, s3_client, args.jobs, state,
+                                args.mirror, args.debounce, args.compression, args.compression_level, concurrency)
+    except KeyboardInterrupt:
+        if watcher is None:
+            raise
+        print('\nStopped watching.')
+    finally:
+        if watcher is not None:
+            watcher.close()
+        if state is not None:
+            state.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,229 @@
+import os
+import sys
+from threading import Lock
+from typing import Iterable, Iterator, Optional
+
+import boto3
+from botocore.exceptions import ClientError
+
+from .state import BackupState
+from ..utils.chunks import CHUNK_MANIFEST_SUFFIX
+from ..utils.deletion import delete_objects
+from ..utils.listing import ObjectIndex, ObjectInfo, list_objects
+from ..utils.manifest import is_metadata_path, metadata_key
+from ..utils.size import format_size
+from ..utils.snapshots import get_snapshot_references
+from ..utils.workers import run_workers
+
+
+def has_local_file(directory: str, relative_path: str) -> bool:
+    """
+    Determines if a file (or anything else) exists at the relative path in the directory.
+
+    :param directory: The backed up directory on this machine.
+    :param relative_path: The path of the file, relative to the directory.
+    :return: False if nothing exists at the path, True if something does or if it can't be checked
+             (e.g. the path is in a directory that can't be read).
+    """
+    try:
+        os.lstat(os.path.join(directory, relative_path))
+    except (FileNotFoundError, NotADirectoryError):
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def find_removed_objects(directory: str, bucket_directory: str, object_index: ObjectIndex
+                         ) -> Iterator[tuple[ObjectInfo, str]]:
+    """
+    Finds the objects in the bucket directory whose files no longer exist in the directory.
+
+    Both backed up files and the chunk manifests named after delta backed up files (by older backups) are found.
+    Other metadata (such as pack and dedup indexes, and the chunk manifests named after their digests) is left alone,
+    as the next backup with the same options rewrites it without the removed files.
+
+    :param directory: The backed up directory on this machine.
+    :param bucket_directory: The name of the backed up directory in the bucket.
+    :param object_index: The objects in the bucket directory.
+                         Must be listed with the bucket directory followed by a separator as its prefix,
+                         so that it doesn't include other bucket directories that start with the same name.
+    :return: Each removed object, and the relative path of its file.
+    """
+    chunk_manifest_prefix = metadata_key(bucket_directory, 'deltas', 'files', '')
+    for object_info in object_index:
+        if object_info.key.startswith(chunk_manifest_prefix) and object_info.key.endswith(CHUNK_MANIFEST_SUFFIX):
+            relative_path = object_info.key[len(chunk_manifest_prefix):-len(CHUNK_MANIFEST_SUFFIX)]
+        else:
+            relative_path = object_info.key[len(object_index.prefix):]
+            if is_metadata_path(relative_path):
+                continue
+        if not has_local_file(directory, relative_path):
+            yield object_info, relative_path
+
+
+def get_retained_keys(bucket_name: str, bucket_directory: str, s3_client=None) -> set[str]:
+    """
+    Finds the objects that must not be deleted even though their files were removed, because a snapshot refers to them
+    and the bucket doesn't keep versions of deleted objects, so that the snapshot could no longer be restored.
+    Unless versioning is known to be enabled, every object a snapshot refers to is retained.
+
+    :param bucket_name: The name of the bucket.
+    :param bucket_directory: The name of the backed up directory in the bucket.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :return: The keys of the retained objects.
+    """
+    # Create a simple S3 Client if none was specified.
+    if s3_client is None:
+        s3_client = boto3.client('s3')
+    try:
+        if s3_client.get_bucket_versioning(Bucket=bucket_name).get('Status') == 'Enabled':
+            return set()
+    except ClientError:
+        pass
+    return set(get_snapshot_references(bucket_name, bucket_directory, s3_client))
+
+
+def skip_retained_objects(removed_objects: Iterable[tuple[ObjectInfo, str]], retained_keys: set[str],
+                          dry_run: bool = False) -> Iterator[tuple[ObjectInfo, str]]:
+    """
+    Leaves out the removed objects that are retained for snapshots (see get_retained_keys()), printing each one.
+
+    :param removed_objects: Each removed object, and the relative path of its file (see find_removed_objects()).
+    :param retained_keys: The keys of the retained objects.
+    :param dry_run: True if the other objects are only printed, not deleted.
+    :return: Each removed object that isn't retained, and the relative path of its file.
+    """
+    for object_info, relative_path in removed_objects:
+        if object_info.key in retained_keys:
+            print(f'{"Would keep" if dry_run else "Keeping":<19}{relative_path}    (a snapshot refers to it)')
+        else:
+            yield object_info, relative_path
+
+
+def mirror_directory(directory: str, bucket_name: str, bucket_directory: str, s3_client=None, jobs: int = 1,
+                     dry_run: bool = False, state: Optional[BackupState] = None) -> int:
+    """
+    Deletes the objects in the bucket directory whose files no longer exist in the directory,
+    so that the bucket directory mirrors the directory.
+    Prints each object that is deleted, and a summary at the end.
+    Objects that a snapshot refers to are kept, unless the bucket is versioned (see get_retained_keys()).
+
+    Objects are deleted with batched requests, several requests at a time (see delete_objects()).
+
+    :param directory: The backed up directory on this machine.
+    :param bucket_name: The name of the bucket.
+    :param bucket_directory: The name of the backed up directory in the bucket.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :param jobs: The number of delete requests to make concurrently.
+    :param dry_run: True to only print the objects that would be deleted, False to delete them.
+    :param state: The state database to forget the deleted files in, if any.
+    :return: The number of objects deleted, or that would be deleted if this is a dry run.
+    """
+    # Create a simple S3 Client if none was specified.
+    if s3_client is None:
+        s3_client = boto3.client('s3')
+    object_index = list_objects(bucket_name, os.path.join(bucket_directory, ''), s3_client, jobs)
+    removed_objects = skip_retained_objects(find_removed_objects(directory, bucket_directory, object_index),
+                                            get_retained_keys(bucket_name, bucket_directory, s3_client), dry_run)
+    if dry_run:
+        removed_count = 0
+        removed_size = 0
+        for object_info, relative_path in removed_objects:
+            print(f'Would delete       {relative_path}')
+            removed_count += 1
+            removed_size += object_info.size
+        print(f'Would delete {removed_count} objects ({format_size(removed_size)}).')
+        return removed_count
+    return delete_removed_objects(bucket_name, removed_objects, s3_client, jobs, state)
+
+
+def mirror_paths(directory: str, bucket_name: str, bucket_directory: str, relative_paths: Iterable[str],
+                 s3_client=None, jobs: int = 1, state: Optional[BackupState] = None) -> int:
+    """
+    Deletes the objects of only some files that no longer exist in the directory, such as ones known to be removed,
+    without listing the whole bucket directory.
+    A removed path may also be a directory, in which case the objects of every file that was in it are deleted.
+    Prints each object that is deleted, and a summary at the end.
+    Objects that a snapshot refers to are kept, unless the bucket is versioned (see get_retained_keys()).
+
+    :param directory: The backed up directory on this machine.
+    :param bucket_name: The name of the bucket.
+    :param bucket_directory: The name of the backed up directory in the bucket.
+    :param relative_paths: The removed paths, relative to the directory.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :param jobs: The number of list and delete requests to make concurrently.
+    :param state: The state database to forget the deleted files in, if any.
+    :return: The number of objects deleted.
+    """
+    # Create a simple S3 Client if none was specified.
+    if s3_client is None:
+        s3_client = boto3.client('s3')
+    removed_objects = []
+    lock = Lock()
+
+    def find_path_objects(relative_path: str) -> None:
+        # List the path as a prefix, which finds both the object of a file and the objects of a directory's files.
+        object_key = os.path.join(bucket_directory, relative_path)
+        for object_info in list_objects(bucket_name, object_key, s3_client):
+            if object_info.key != object_key and not object_info.key.startswith(os.path.join(object_key, '')):
+                continue
+            relative_file_path = object_info.key[len(os.path.join(bucket_directory, '')):]
+            if not is_metadata_path(relative_file_path) and not has_local_file(directory, relative_file_path):
+                with lock:
+                    removed_objects.append((object_info, relative_file_path))
+
+    run_workers(find_path_objects, relative_paths, jobs)
+    retained_keys = get_retained_keys(bucket_name, bucket_directory, s3_client)
+    return delete_removed_objects(bucket_name, skip_retained_objects(removed_objects, retained_keys), s3_client, jobs,
+                                  state)
+
+
+def delete_removed_objects(bucket_name: str, removed_objects: Iterable[tuple[ObjectInfo, str]], s3_client=None,
+                           jobs: int = 1, state: Optional[BackupState] = None) -> int:
+    """
+    Deletes the objects of removed files, printing each object that is deleted, and a summary at the end.
+
+    :param bucket_name: The name of the bucket.
+    :param removed_objects: Each removed object, and the relative path of its file (see find_removed_objects()).
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :param jobs: The number of delete requests to make concurrently.
+    :param state: The state database to forget the deleted files in, if any.
+    :return: The number of objects deleted.
+    """
+    # Create a simple S3 Client if none was specified.
+    if s3_client is None:
+        s3_client = boto3.client('s3')
+    # Remember the removed objects until their batch is deleted, so that they can be reported.
+    pending_objects = {}
+    removed_count = 0
+    removed_size = 0
+    lock = Lock()
+
+    def removed_keys() -> Iterator[str]:
+        for object_info, relative_path in removed_objects:
+            with lock:
+                pending_objects[object_info.key] = object_info, relative_path
+            yield object_info.key
+
+    def report(deleted_keys: list[str], failed_keys: list[str]) -> None:
+        nonlocal removed_count, removed_size
+        if state is not None:
+            state.forget(bucket_name, deleted_keys)
+        with lock:
+            for object_key in deleted_keys:
+                object_info, relative_path = pending_objects.pop(object_key)
+                print(f'Deleting           {relative_path}')
+                removed_count += 1
+                removed_size += object_info.size
+            for object_key in failed_keys:
+                object_info, relative_path = pending_objects.pop(object_key)
+                print(f'Deleting           {relative_path}', end='')
+                print('    failed', file=sys.stderr)
+
+    try:
+        delete_objects(bucket_name, removed_keys(), s3_client, jobs, callback=report)
+    except ClientError:
+        print('\nFailed to delete some objects.', file=sys.stderr)
+    print(f'Deleted {removed_count} objects ({format_size(removed_size)}).')
+    return removed_count
@@ -0,0 +1,257 @@
+import os
+import sqlite3
+import time
+from threading import Lock
+from typing import Iterable, NamedTuple, Optional
+
+from ..utils.listing import ObjectIndex
+from ..utils.scanner import FileEntry
+
+
+# The default location of the state database.
+DEFAULT_STATE_PATH: str = os.path.join(os.path.expanduser('~'), '.aws-backup', 'state.sqlite3')
+
+
+# The return type for BackupState.get_upload().
+class UploadState(NamedTuple):
+    upload_id: str
+    size: int
+    mtime_ns: int
+    part_size: int
+
+
+class BackupState:
+    """
+    A local database of files that have been backed up,
+    used to skip unchanged files without making any requests to S3.
+
+    A file is considered unchanged if its path, size, modification time, and inode
+    all match the entry recorded when it was last backed up.
+    Unfinished multipart uploads are also recorded, so that they can be resumed by the next backup.
+    Safe to use from multiple threads.
+    """
+
+    path: str
+    commit_interval: int
+    _connection: sqlite3.Connection
+    _lock: Lock
+    _pending_writes: int
+
+    def __init__(self, path: str = DEFAULT_STATE_PATH, commit_interval: int = 1000) -> None:
+        """
+        Opens the state database, creating it if it doesn't exist.
+
+        :param path: The path to the state database.
+        :param commit_interval: The number of writes to batch into each commit.
+        """
+        self.path = path
+        self.commit_interval = commit_interval
+        parent_directories = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent_directories, exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('''
+            CREATE TABLE IF NOT EXISTS files (
+                bucket     TEXT    NOT NULL,
+                object_key TEXT    NOT NULL,
+                path       TEXT    NOT NULL,
+                size       INTEGER NOT NULL,
+                mtime_ns   INTEGER NOT NULL,
+                inode      INTEGER NOT NULL,
+                etag       TEXT    NOT NULL,
+                PRIMARY KEY (bucket, object_key)
+            )''')
+        self._connection.execute('''
+            CREATE TABLE IF NOT EXISTS reconciliations (
+                bucket           TEXT NOT NULL,
+                bucket_directory TEXT NOT NULL,
+                reconciled_at    REAL NOT NULL,
+                PRIMARY KEY (bucket, bucket_directory)
+            )''')
+        self._connection.execute('''
+            CREATE TABLE IF NOT EXISTS uploads (
+                bucket     TEXT    NOT NULL,
+                object_key TEXT    NOT NULL,
+                upload_id  TEXT    NOT NULL,
+                size       INTEGER NOT NULL,
+                mtime_ns   INTEGER NOT NULL,
+                part_size  INTEGER NOT NULL,
+                PRIMARY KEY (bucket, object_key)
+            )''')
+        self._connection.commit()
+        self._lock = Lock()
+        self._pending_writes = 0
+
+    @property
+    def file_paths(self) -> list[str]:
+        """The paths of every file of the state database: the database, and its write-ahead log and shared memory."""
+        return [self.path, f'{self.path}-wal', f'{self.path}-shm']
+
+    def __enter__(self) -> 'BackupState':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def commit(self) -> None:
+        """Commits any pending writes, such as at the end of a batch of files."""
+        with self._lock:
+            self._connection.commit()
+            self._pending_writes = 0
+
+    def close(self) -> None:
+        """Commits any pending writes and closes the state database."""
+        with self._lock:
+            self._connection.commit()
+            self._connection.close()
+
+    def get_unchanged_etag(self, bucket_name: str, object_key: str, file: FileEntry) -> Optional[str]:
+        """
+        Determines if the file is unchanged since it was last backed up to the object_key,
+        and if so, gets the ETag of the object it was backed up to.
+
+        :param bucket_name: The name of the bucket.
+        :param object_key: The name/key of the file/object in the bucket.
+        :param file: The file, from scan_directory().
+        :return: The recorded ETag of the object if the file matches its recorded entry, None otherwise.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT path, size, mtime_ns, inode, etag FROM files WHERE bucket = ? AND object_key = ?',
+                (bucket_name, object_key)).fetchone()
+        if row is None or row[:4] != (file.path, file.size, file.mtime_ns, file.inode):
+            return None
+        return row[4]
+
+    def record(self, bucket_name: str, object_key: str, file: FileEntry, etag: str) -> None:
+        """
+        Records that the file has been backed up to the object_key.
+
+        :param bucket_name: The name of the bucket.
+        :param object_key: The name/key of the file/object in the bucket.
+        :param file: The file, from a scan_directory() made before it was backed up.
+        :param etag: The ETag of the backed up object.
+        """
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (bucket_name, object_key, file.path, file.size, file.mtime_ns, file.inode, etag))
+            self._pending_writes += 1
+            if self._pending_writes >= self.commit_interval:
+                self._connection.commit()
+                self._pending_writes = 0
+
+    def forget(self, bucket_name: str, object_keys: Iterable[str]) -> None:
+        """
+        Forgets the files that were backed up to the object_keys, such as once their objects are deleted.
+
+        :param bucket_name: The name of the bucket.
+        :param object_keys: The names/keys of the files/objects in the bucket.
+        """
+        with self._lock:
+            self._connection.executemany('DELETE FROM files WHERE bucket = ? AND object_key = ?',
+                                         ((bucket_name, object_key) for object_key in object_keys))
+            self._connection.commit()
+            self._pending_writes = 0
+
+    def get_upload(self, bucket_name: str, object_key: str) -> Optional[UploadState]:
+        """
+        Gets the unfinished multipart upload to the object_key, if any.
+
+        :param bucket_name: The name of the bucket.
+        :param object_key: The name/key of the object in the bucket.
+        :return: The multipart upload, and the size and modification time of the file it was uploading,
+                 or None if there is no unfinished upload.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT upload_id, size, mtime_ns, part_size FROM uploads WHERE bucket = ? AND object_key = ?',
+                (bucket_name, object_key)).fetchone()
+        return None if row is None else UploadState(*row)
+
+    def record_upload(self, bucket_name: str, object_key: str, upload: UploadState) -> None:
+        """
+        Records that a multipart upload to the object_key has started, so that it can be resumed if it doesn't finish.
+        Committed immediately, as the upload is only worth resuming if it survives the program stopping.
+
+        :param bucket_name: The name of the bucket.
+        :param object_key: The name/key of the object in the bucket.
+        :param upload: The multipart upload, and the size and modification time of the file it is uploading.
+        """
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?, ?)',
+                                     (bucket_name, object_key, *upload))
+            self._connection.commit()
+            self._pending_writes = 0
+
+    def forget_upload(self, bucket_name: str, object_key: str) -> None:
+        """
+        Forgets the multipart upload to the object_key, such as once it has finished.
+
+        :param bucket_name: The name of the bucket.
+        :param object_key: The name/key of the object in the bucket.
+        """
+        with self._lock:
+            self._connection.execute('DELETE FROM uploads WHERE bucket = ? AND object_key = ?',
+                                     (bucket_name, object_key))
+            self._pending_writes += 1
+            if self._pending_writes >= self.commit_interval:
+                self._connection.commit()
+                self._pending_writes = 0
+
+    def needs_reconcile(self, bucket_name: str, bucket_directory: str, interval: float) -> bool:
+        """
+        Determines if the bucket directory has not been reconciled within the interval.
+
+        :param bucket_name: The name of the bucket.
+        :param bucket_directory: The name of the backed up directory in the bucket.
+        :param interval: The maximum time between reconciliations, in seconds.
+        :return: True if the bucket directory should be reconciled, False otherwise.
+        """
+        reconciled_at = self.last_reconciled(bucket_name, bucket_directory)
+        return reconciled_at is None or time.time() - reconciled_at >= interval
+
+    def last_reconciled(self, bucket_name: str, bucket_directory: str) -> Optional[float]:
+        """
+        Gets when the bucket directory was last reconciled.
+
+        :param bucket_name: The name of the bucket.
+        :param bucket_directory: The name of the backed up directory in the bucket.
+        :return: The time of the last reconciliation (seconds since the epoch),
+                 or None if it has never been reconciled.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT reconciled_at FROM reconciliations WHERE bucket = ? AND bucket_directory = ?',
+                (bucket_name, bucket_directory)).fetchone()
+        return None if row is None else row[0]
+
+    def reconcile(self, bucket_name: str, bucket_directory: str, object_index: ObjectIndex) -> int:
+        """
+        Removes every entry under the bucket directory whose object is missing from the bucket
+        or has a different ETag than the one recorded, so that those files are checked again on the next backup.
+
+        :param bucket_name: The name of the bucket.
+        :param bucket_directory: The name of the backed up directory in the bucket.
+        :param object_index: The objects currently in the bucket directory.
+        :return: The number of entries removed.
+        """
+        # Match keys under the bucket directory followed by a separator,
+        # so that other bucket directories that start with the same name aren't reconciled against this one.
+        prefix = os.path.join(bucket_directory, '')
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT object_key, etag FROM files WHERE bucket = ? AND substr(object_key, 1, ?) = ?',
+                (bucket_name, len(prefix), prefix))
+            stale_keys = []
+            for object_key, etag in rows:
+                object_info = object_index.get(object_key)
+                if object_info is None or object_info.etag != etag:
+                    stale_keys.append((bucket_name, object_key))
+            self._connection.executemany('DELETE FROM files WHERE bucket = ? AND object_key = ?', stale_keys)
+            self._connection.execute('INSERT OR REPLACE INTO reconciliations VALUES (?, ?, ?)',
+                                     (bucket_name, bucket_directory, time.time()))
+            self._connection.commit()
+            self._pending_writes = 0
+        return len(stale_keys)
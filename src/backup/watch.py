@@ -0,0 +1,75 @@
+from typing import Optional
+
+from .backup import backup_directory
+from .mirror import mirror_directory, mirror_paths
+from .state import BackupState
+from ..utils.concurrency import AdaptiveConcurrency
+from ..utils.listing import ObjectIndex
+from ..utils.scanner import scan_paths
+from ..utils.watcher import DirectoryWatcher, collect_changes
+
+
+# The default number of seconds without changes that ends a burst of changes.
+DEFAULT_DEBOUNCE: float = 2
+# The most seconds a batch of changes is collected for before it's backed up, even if changes are still being made.
+MAX_BATCH_DELAY: float = 30
+
+
+def watch_directory(watcher: DirectoryWatcher, bucket_name: str, bucket_directory: str, s3_client=None,
+                    jobs: int = 1, state: Optional[BackupState] = None, mirror: bool = False,
+                    debounce: float = DEFAULT_DEBOUNCE, compression: Optional[str] = None,
+                    compression_level: Optional[int] = None,
+                    concurrency: Optional[AdaptiveConcurrency] = None) -> None:
+    """
+    Backs up the changes made to a directory as they are made, until interrupted (e.g. with Ctrl+C).
+
+    Changes are collected until none are made for the debounce time (see collect_changes()),
+    then only the changed files are backed up, in one batch with backup_directory().
+    As the changed files are known to have changed, the bucket directory is never listed to check them.
+    If the watcher loses changes (e.g. inotify's queue overflowed), the whole directory is backed up again,
+    skipping unchanged files with the state database.
+    The directory should already be backed up when watching starts, and the watcher started before that backup,
+    so that no changes are missed between them.
+
+    Packing, deduplication, and delta backups aren't supported,
+    as their indexes are rewritten by each backup with only the files it backed up.
+
+    :param watcher: The DirectoryWatcher of the directory to back up.
+    :param bucket_name: The name of the bucket to back up the directory to.
+    :param bucket_directory: The name of the backed up directory in the bucket.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :param jobs: The number of files to back up concurrently.
+    :param state: The state database to check files against and record backed up files in, if any.
+                  Changes are committed after each batch.
+    :param mirror: True to also delete the objects of files removed from the directory, False to keep them.
+    :param debounce: The number of seconds without changes that ends a batch.
+    :param compression: The codec to compress files with (see CODECS), or None to not compress files.
+    :param compression_level: The compression level. The codec's default level is used if none is specified.
+    :param concurrency: The AdaptiveConcurrency to limit uploads in flight with.
+    """
+    directory = watcher.directory
+    options = dict(s3_client=s3_client, jobs=jobs, state=state, compression=compression,
+                   compression_level=compression_level, concurrency=concurrency)
+    while True:
+        changes = collect_changes(watcher, debounce, MAX_BATCH_DELAY)
+        if changes.overflowed:
+            print('Some changes were lost, so backing up the whole directory again...')
+            backup_directory(directory, bucket_name, bucket_directory, **options)
+            if mirror:
+                mirror_directory(directory, bucket_name, bucket_directory, s3_client, jobs, state=state)
+        else:
+            # Scan only the changed paths, sorted so that files are backed up in the same order as a full scan.
+            # A file may be both changed itself and in a changed directory, but is only backed up once.
+            # Changed directories may contain ignored paths, which aren't backed up either.
+            files = list({file.relative_path: file for file in scan_paths(directory, sorted(changes.changed))
+                          if not watcher.is_ignored(file.relative_path)}.values())
+            if files:
+                print(f'Backing up {len(files)} changed files...')
+                backup_directory(directory, bucket_name, bucket_directory, files=files,
+                                 object_index=ObjectIndex(bucket_directory), **options)
+            if mirror and changes.removed:
+                print(f'Deleting the objects of {len(changes.removed)} removed paths...')
+                mirror_paths(directory, bucket_name, bucket_directory, sorted(changes.removed), s3_client, jobs,
+                             state)
+        if state is not None:
+            state.commit()
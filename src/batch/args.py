@@ -0,0 +1,87 @@
+from argparse import ArgumentParser, ArgumentTypeError, Namespace
+from typing import Optional
+
+from ..backup.state import DEFAULT_STATE_PATH
+from ..utils.throttle import BandwidthRule, parse_bandwidth_rule
+
+
+class Arguments:
+    """Data class for storing command line arguments."""
+
+    def __init__(self, args: Namespace) -> None:
+        """
+        Initializes the object from the Namespace object.
+        :param args: The Namespace from ArgumentParser.parse_args().
+        """
+        self.job_file: str = args.job_file
+        self.jobs: int = args.jobs
+        self.parallel_jobs: int = args.parallel
+        self.hash_processes: Optional[int] = args.hash_processes
+        self.state_file: Optional[str] = None if args.no_state else args.state
+        self.reconcile_interval: float = args.reconcile_interval * 24 * 60 * 60
+        self.report_file: Optional[str] = args.report
+        self.profile_file: Optional[str] = args.profile
+        self.bandwidth_rules: list[BandwidthRule] = args.max_bandwidth
+
+
+def parse_arguments() -> Arguments:
+    """
+    Parses command line arguments.
+    Exits the program if the arguments are invalid.
+    :return: The parsed arguments.
+    """
+    parser = ArgumentParser(description='Runs many backups to and restores from AWS in one process.')
+    parser.add_argument('job_file', metavar='job-file',
+                        help='JSON (or YAML, if PyYAML is installed) list of backup and restore jobs')
+    parser.add_argument('-j', '--jobs', type=positive_integer, default=1,
+                        help='number of files to transfer concurrently, across every job (default: 1)')
+    parser.add_argument('-p', '--parallel', metavar='count', type=positive_integer, default=4,
+                        help='number of jobs to run at once (default: 4)')
+    parser.add_argument('--hash-processes', metavar='count', type=positive_integer,
+                        help='number of processes to hash files in when deduplicating or chunking '
+                             '(default: number of CPUs)')
+    parser.add_argument('--state', metavar='file', default=DEFAULT_STATE_PATH,
+                        help='state database used to skip unchanged files (default: %(default)s)')
+    parser.add_argument('--no-state', action='store_true',
+                        help='check every file against the bucket instead of using a state database')
+    parser.add_argument('--reconcile-interval', metavar='days', type=non_negative_number, default=7,
+                        help='reconcile the state database if it has not been for this many days (default: 7)')
+    parser.add_argument('--max-bandwidth', metavar='rate[@start-end]', type=bandwidth_rule, action='append',
+                        default=[],
+                        help='limit the bandwidth of all transfers combined (e.g. 50Mbps or 5MB/s), optionally only '
+                             'between two times of day (e.g. 50Mbps@9-17); repeat to schedule several limits')
+    parser.add_argument('--report', metavar='file',
+                        help='write metrics of the run (requests, latencies, and time spent in each phase) as JSON')
+    parser.add_argument('--profile', metavar='file',
+                        help='write a cProfile profile of the run, which can be read with pstats')
+    return Arguments(parser.parse_args())
+
+
+def positive_integer(raw_integer: str) -> int:
+    """Meant to be used a type converter for ArgumentParser.add_argument()."""
+    try:
+        integer = int(raw_integer)
+    except ValueError:
+        raise ArgumentTypeError('not an integer')
+    if integer < 1:
+        raise ArgumentTypeError('must be at least 1')
+    return integer
+
+
+def non_negative_number(raw_number: str) -> float:
+    """Meant to be used a type converter for ArgumentParser.add_argument()."""
+    try:
+        number = float(raw_number)
+    except ValueError:
+        raise ArgumentTypeError('not a number')
+    if number < 0:
+        raise ArgumentTypeError('must not be negative')
+    return number
+
+
+def bandwidth_rule(raw_rule: str) -> BandwidthRule:
+    """Meant to be used a type converter for ArgumentParser.add_argument()."""
+    try:
+        return parse_bandwidth_rule(raw_rule)
+    except ValueError as e:
+        raise ArgumentTypeError(str(e))
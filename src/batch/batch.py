@@ -0,0 +1,249 @@
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from threading import Lock
+from typing import NamedTuple, Optional
+
+from botocore.exceptions import ClientError
+
+from .jobs import BACKUP, Job
+from ..backup.backup import backup_directory, create_bucket
+from ..backup.mirror import mirror_directory
+from ..backup.state import BackupState
+from ..restore.restore import bucket_exists, restore_directory, restore_summary
+from ..utils.chunks import DeltaIndex, get_delta_index
+from ..utils.concurrency import AdaptiveConcurrency
+from ..utils.dedup import DedupManifest, get_dedup_manifest
+from ..utils.listing import ObjectIndex, list_bucket_directory
+from ..utils.packs import PackIndex, get_pack_index
+from ..utils.progress import ProgressLogger
+from ..utils.scanner import FileEntry, scan_directory
+from ..utils.size import DirectoryInfo, files_summary
+from ..utils.snapshots import LATEST_SNAPSHOT, Snapshot, get_snapshot, put_snapshot
+
+
+# The result of a job. The error is None if the job completed (even if some of its files failed).
+class JobResult(NamedTuple):
+    job: Job
+    file_count: int
+    total_size: int
+    changed_count: int
+    duration: float
+    error: Optional[str] = None
+
+
+# What a job needs to run, found before any job starts so that the progress of every job can be shown together.
+@dataclass
+class PreparedJob:
+    job: Job
+    directory_info: DirectoryInfo
+    started_at: float
+    files: Optional[list[FileEntry]] = None
+    object_index: Optional[ObjectIndex] = None
+    pack_index: Optional[PackIndex] = None
+    dedup_manifest: Optional[DedupManifest] = None
+    delta_index: Optional[DeltaIndex] = None
+    snapshot: Optional[Snapshot] = None
+    previous_snapshot: Optional[Snapshot] = None
+
+
+def check_buckets(jobs: list[Job], s3_client) -> set[str]:
+    """
+    Checks every bucket the jobs use once, however many jobs use it.
+    Buckets that are backed up to are created if they don't exist.
+
+    :param jobs: The jobs.
+    :param s3_client: The S3 Client to use.
+    :return: The names of the buckets that exist.
+    """
+    bucket_names = {}
+    for job in jobs:
+        # A bucket that any job backs up to is created, even if other jobs only restore from it.
+        bucket_names[job.bucket_name] = bucket_names.get(job.bucket_name, False) or job.kind == BACKUP
+    existing_buckets = set()
+    for bucket_name, backed_up in bucket_names.items():
+        if create_bucket(bucket_name, s3_client) if backed_up else bucket_exists(bucket_name, s3_client):
+            existing_buckets.add(bucket_name)
+        elif not backed_up:
+            print(f'Error: The bucket {bucket_name} does not exist.', file=sys.stderr)
+    return existing_buckets
+
+
+def prepare_job(job: Job, s3_client, jobs: int, state: Optional[BackupState] = None,
+                reconcile_interval: Optional[float] = None) -> PreparedJob:
+    """
+    Prepares a job: scans the directory of a backup, or lists (or gets the snapshot of) the backup of a restore.
+
+    :param job: The job.
+    :param s3_client: The S3 Client to use.
+    :param jobs: The number of list requests to make concurrently.
+    :param state: The state database of backups, if any.
+    :param reconcile_interval: The number of seconds after which the state database is reconciled with a bucket
+                               directory before backing it up, or None to never reconcile it.
+    :return: The prepared job.
+    :raises ClientError: If listing or getting something fails.
+    :raises ValueError: If the snapshot to restore doesn't exist.
+    """
+    started_at = time.monotonic()
+    if job.kind == BACKUP:
+        prepared_job = PreparedJob(job, DirectoryInfo(0, 0), started_at)
+        if state is not None and reconcile_interval is not None \
+                and state.needs_reconcile(job.bucket_name, job.bucket_dir, reconcile_interval):
+            prepared_job.object_index = list_bucket_directory(job.bucket_name, job.bucket_dir, s3_client, jobs)
+            state.reconcile(job.bucket_name, job.bucket_dir, prepared_job.object_index)
+        if job.snapshot:
+            prepared_job.snapshot = Snapshot()
+            try:
+                prepared_job.previous_snapshot = get_snapshot(job.bucket_name, job.bucket_dir, LATEST_SNAPSHOT,
+                                                              s3_client)
+            except ClientError:
+                pass
+        prepared_job.files = list(scan_directory(job.directory))
+        prepared_job.directory_info = files_summary(prepared_job.files)
+        return prepared_job
+    if job.snapshot_id is not None:
+        snapshot = get_snapshot(job.bucket_name, job.bucket_dir, job.snapshot_id, s3_client)
+        if snapshot is None:
+            raise ValueError(f'no snapshot {job.snapshot_id}')
+        return PreparedJob(job, DirectoryInfo(len(snapshot), snapshot.total_size), started_at, snapshot=snapshot)
+    object_index = list_bucket_directory(job.bucket_name, job.bucket_dir, s3_client, jobs)
+    pack_index = get_pack_index(job.bucket_name, job.bucket_dir, s3_client)
+    dedup_manifest = get_dedup_manifest(job.bucket_name, job.bucket_dir, s3_client)
+    delta_index = get_delta_index(job.bucket_name, job.bucket_dir, s3_client)
+    directory_info = restore_summary(object_index, pack_index, dedup_manifest, delta_index)
+    return PreparedJob(job, directory_info, started_at, object_index=object_index, pack_index=pack_index,
+                       dedup_manifest=dedup_manifest, delta_index=delta_index)
+
+
+def run_job(prepared_job: PreparedJob, s3_client, jobs: int, concurrency: AdaptiveConcurrency,
+            progress: ProgressLogger, state: Optional[BackupState] = None,
+            hash_processes: Optional[int] = None) -> int:
+    """
+    Runs a prepared job, printing only the files that fail.
+
+    :param prepared_job: The prepared job (see prepare_job()).
+    :param s3_client: The S3 Client to use.
+    :param jobs: The number of files to transfer concurrently in the job.
+    :param concurrency: The AdaptiveConcurrency shared by every job, which limits the transfers of all of them.
+    :param progress: The ProgressLogger shared by every job.
+    :param state: The state database of backups, if any.
+    :param hash_processes: The number of processes to hash files in, when deduplicating or chunking.
+    :return: The number of files that were backed up or restored, rather than already being up to date.
+    """
+    job = prepared_job.job
+    changed_count = 0
+    lock = Lock()
+
+    def count(file_path: str, changed: bool) -> None:
+        nonlocal changed_count
+        if changed:
+            with lock:
+                changed_count += 1
+
+    if job.kind == BACKUP:
+        backup_directory(job.directory, job.bucket_name, job.bucket_dir, s3_client=s3_client, callback=count,
+                         object_index=prepared_job.object_index, jobs=jobs, state=state, files=prepared_job.files,
+                         progress=progress, pack_threshold=job.pack_threshold, pack_size=job.pack_size,
+                         compression=job.compression, compression_level=job.compression_level, dedup=job.dedup,
+                         hash_processes=hash_processes, delta_threshold=job.delta_threshold,
+                         concurrency=concurrency, snapshot=prepared_job.snapshot,
+                         previous_snapshot=prepared_job.previous_snapshot, quiet=True)
+        if prepared_job.snapshot is not None:
+            try:
+                put_snapshot(job.bucket_name, job.bucket_dir, prepared_job.snapshot, s3_client)
+            except (ClientError, OSError):
+                print(f'Failed to record the snapshot of {job.name}.', file=sys.stderr)
+        if job.mirror:
+            mirror_directory(job.directory, job.bucket_name, job.bucket_dir, s3_client, jobs, state=state)
+    else:
+        restore_directory(job.bucket_name, job.bucket_dir, job.directory, s3_client=s3_client, callback=count,
+                          jobs=jobs, pack_index=prepared_job.pack_index, progress=progress,
+                          dedup_manifest=prepared_job.dedup_manifest, incremental=job.incremental,
+                          compare_etags=job.compare_etags, delta_index=prepared_job.delta_index,
+                          object_index=prepared_job.object_index, concurrency=concurrency,
+                          snapshot=prepared_job.snapshot, quiet=True)
+    return changed_count
+
+
+def run_jobs(jobs: list[Job], s3_client, concurrent_transfers: int = 1, parallel_jobs: int = 1,
+             state: Optional[BackupState] = None, reconcile_interval: Optional[float] = None,
+             hash_processes: Optional[int] = None,
+             concurrency: Optional[AdaptiveConcurrency] = None) -> list[JobResult]:
+    """
+    Runs many backups and restores in one process, sharing one S3 Client (and its connection pool),
+    so that each job doesn't pay for starting a program, creating a client, and opening connections.
+
+    Every bucket is checked once (see check_buckets()), then every job is prepared, several at a time,
+    so that the progress of every job can be shown together in one ProgressLogger.
+    Then several jobs run at a time, with the transfers of all of them limited by one AdaptiveConcurrency,
+    so that the total number of transfers in flight stays within one budget however many jobs run at once.
+    A job that fails doesn't stop the others.
+
+    :param jobs: The jobs (see load_jobs()).
+    :param s3_client: The S3 Client to share between every job, such as one from create_client().
+    :param concurrent_transfers: The most transfers in flight at once, across every job.
+    :param parallel_jobs: The number of jobs to prepare and run at once.
+    :param state: The state database of backups, if any.
+    :param reconcile_interval: The number of seconds after which the state database is reconciled with a bucket
+                               directory before backing it up, or None to never reconcile it.
+    :param hash_processes: The number of processes to hash files in, when deduplicating or chunking.
+    :param concurrency: The AdaptiveConcurrency to limit transfers with, such as one instrumenting the client.
+                        Defaults to one allowing concurrent_transfers transfers at once.
+    :return: The result of each job, in the order of the jobs.
+    """
+    if concurrency is None:
+        concurrency = AdaptiveConcurrency(concurrent_transfers)
+    results = {}
+
+    def fail(job: Job, error: str, started_at: float, directory_info: Optional[DirectoryInfo] = None) -> None:
+        results[id(job)] = JobResult(job, 0 if directory_info is None else directory_info.file_count,
+                                     0 if directory_info is None else directory_info.total_size, 0,
+                                     time.monotonic() - started_at, error)
+
+    # Check every bucket once, and skip the jobs whose bucket doesn't exist.
+    print('Checking the buckets...')
+    existing_buckets = check_buckets(jobs, s3_client)
+    runnable_jobs = []
+    for job in jobs:
+        if job.bucket_name in existing_buckets:
+            runnable_jobs.append(job)
+        else:
+            fail(job, 'the bucket does not exist', time.monotonic())
+
+    def prepare(job: Job) -> Optional[PreparedJob]:
+        started_at = time.monotonic()
+        try:
+            return prepare_job(job, s3_client, concurrent_transfers, state, reconcile_interval)
+        except (ClientError, OSError, ValueError) as e:
+            fail(job, str(e), started_at)
+            return None
+
+    print(f'Preparing {len(runnable_jobs)} jobs...')
+    with ThreadPoolExecutor(parallel_jobs) as executor:
+        prepared_jobs = [prepared_job for prepared_job in executor.map(prepare, runnable_jobs)
+                         if prepared_job is not None]
+    # Show the progress of every job together.
+    progress = ProgressLogger(sum(prepared_job.directory_info.file_count for prepared_job in prepared_jobs),
+                              sum(prepared_job.directory_info.total_size for prepared_job in prepared_jobs))
+    print(f'Running {len(prepared_jobs)} jobs ({progress.total_files} files).')
+    progress.print_progress_info()
+
+    def run(prepared_job: PreparedJob) -> None:
+        job = prepared_job.job
+        try:
+            changed_count = run_job(prepared_job, s3_client, concurrent_transfers, concurrency, progress, state,
+                                    hash_processes)
+        except (ClientError, OSError, ValueError) as e:
+            fail(job, str(e), prepared_job.started_at, prepared_job.directory_info)
+            return
+        results[id(job)] = JobResult(job, prepared_job.directory_info.file_count,
+                                     prepared_job.directory_info.total_size, changed_count,
+                                     time.monotonic() - prepared_job.started_at)
+
+    with ThreadPoolExecutor(parallel_jobs) as executor:
+        list(executor.map(run, prepared_jobs))
+    # Redraw the final progress, in case the last redraw was skipped.
+    progress.print_progress_info()
+    print()
+    return [results[id(job)] for job in jobs]
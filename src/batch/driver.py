@@ -0,0 +1,70 @@
+import sys
+from functools import partial
+
+from .args import Arguments, parse_arguments
+from .batch import JobResult, run_jobs
+from .jobs import load_jobs
+from ..backup.state import BackupState
+from ..utils.client import create_client
+from ..utils.concurrency import AdaptiveConcurrency
+from ..utils.metrics import Metrics, run_with_metrics
+from ..utils.size import format_size
+from ..utils.throttle import RateLimiter, throttle_client
+
+
+def main():
+    args = parse_arguments()
+    run_with_metrics(partial(run_batch, args), args.report_file, args.profile_file)
+
+
+def run_batch(args: Arguments, metrics: Metrics) -> None:
+    """
+    Runs the batch program. Exits with status 1 if any job fails.
+
+    :param args: The parsed command line arguments.
+    :param metrics: The Metrics to record the phases of the program and the requests of its client in.
+    """
+    try:
+        jobs = load_jobs(args.job_file)
+    except (OSError, ValueError) as e:
+        print(f'Error: Could not load the job file: {e}', file=sys.stderr)
+        sys.exit(1)
+    # Create one reusable client for every job, with a connection pool large enough for every transfer at once.
+    s3_client = create_client(args.jobs)
+    metrics.instrument(s3_client)
+    # Adapt the number of transfers in flight to throttling and latency, up to the number of jobs, across every job.
+    concurrency = AdaptiveConcurrency(args.jobs)
+    concurrency.instrument(s3_client)
+    # Share one bandwidth limit between every transfer, if any was specified.
+    if args.bandwidth_rules:
+        throttle_client(s3_client, RateLimiter(args.bandwidth_rules))
+    state = None if args.state_file is None else BackupState(args.state_file)
+    try:
+        with metrics.phase('jobs'):
+            results = run_jobs(jobs, s3_client, args.jobs, args.parallel_jobs, state,
+                               None if state is None else args.reconcile_interval, args.hash_processes, concurrency)
+    finally:
+        if state is not None:
+            state.close()
+    print_summary(results)
+    if any(result.error is not None for result in results):
+        sys.exit(1)
+
+
+def print_summary(results: list[JobResult]) -> None:
+    """
+    Prints the result of every job for a person to read.
+
+    :param results: The results, from run_jobs().
+    """
+    print('Summary:')
+    for result in results:
+        outcome = 'completed' if result.error is None else f'failed: {result.error}'
+        print(f'  {result.job.kind:<8}{result.file_count:>9} files {format_size(result.total_size):>10}'
+              f'{result.changed_count:>9} changed {result.duration:9.2f} s   {result.job.name}   {outcome}')
+    failed_count = sum(result.error is not None for result in results)
+    print(f'{len(results) - failed_count} jobs completed, {failed_count} failed.')
+
+
+if __name__ == '__main__':
+    main()
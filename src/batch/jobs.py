@@ -0,0 +1,169 @@
+import json
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+from ..utils.compression import check_codec
+from ..utils.packs import DEFAULT_PACK_SIZE
+from ..utils.size import parse_size
+
+
+# The kinds of jobs. Each job names its kind as the key of its source.
+BACKUP: str = 'backup'
+RESTORE: str = 'restore'
+# The options each kind of job accepts, other than its kind and destination ("to").
+BACKUP_OPTIONS: frozenset[str] = frozenset({'pack', 'pack-size', 'dedup', 'delta', 'compress', 'compression-level',
+                                            'mirror', 'snapshot'})
+RESTORE_OPTIONS: frozenset[str] = frozenset({'incremental', 'compare-etags', 'snapshot'})
+# The file extensions of YAML job files. Other job files are JSON.
+YAML_EXTENSIONS: tuple[str, ...] = ('.yaml', '.yml')
+
+
+# A backup or restore in a job file.
+# The directory is the local directory: the source of a backup, or the destination of a restore.
+@dataclass
+class Job:
+    kind: str
+    directory: str
+    bucket_name: str
+    bucket_dir: str
+    pack_threshold: int = 0
+    pack_size: int = DEFAULT_PACK_SIZE
+    dedup: bool = False
+    delta_threshold: int = 0
+    compression: Optional[str] = None
+    compression_level: Optional[int] = None
+    mirror: bool = False
+    snapshot: bool = True
+    incremental: bool = False
+    compare_etags: bool = False
+    snapshot_id: Optional[str] = None
+
+    @property
+    def name(self) -> str:
+        """Describes the job, such as in its summary."""
+        if self.kind == BACKUP:
+            return f'{self.directory} -> {self.bucket_name}::{self.bucket_dir}'
+        return f'{self.bucket_name}::{self.bucket_dir} -> {self.directory}'
+
+
+def load_jobs(path: str) -> list[Job]:
+    """
+    Loads the jobs in a job file: a JSON (or, if PyYAML is installed, YAML) list of jobs.
+    Each job has its kind as the key of its source, its destination as "to", and optionally the long names of the
+    command line options of its kind's program (without the dashes), with "snapshot" enabling or disabling
+    snapshots of backups, or naming the snapshot to restore.
+
+    Example::
+
+        - backup: /home/alice
+          to: my-bucket::alice
+          dedup: true
+        - restore: my-bucket::bob
+          to: /srv/bob
+          incremental: true
+
+    :param path: The path of the job file.
+    :return: The jobs, in order.
+    :raises ValueError: If the job file can't be parsed, or a job is invalid.
+    :raises OSError: If the job file can't be read.
+    """
+    with open(path) as f:
+        if path.lower().endswith(YAML_EXTENSIONS):
+            if yaml is None:
+                raise ValueError('YAML job files require the PyYAML package (pip install pyyaml)')
+            try:
+                raw_jobs = yaml.safe_load(f)
+            except yaml.YAMLError as e:
+                raise ValueError(f'invalid YAML: {e}')
+        else:
+            try:
+                raw_jobs = json.load(f)
+            except json.JSONDecodeError as e:
+                raise ValueError(f'invalid JSON: {e}')
+    if not isinstance(raw_jobs, list):
+        raise ValueError('the job file must be a list of jobs')
+    jobs = []
+    for number, raw_job in enumerate(raw_jobs, 1):
+        try:
+            jobs.append(parse_job(raw_job))
+        except ValueError as e:
+            raise ValueError(f'job {number}: {e}')
+    return jobs
+
+
+def parse_job(raw_job: dict) -> Job:
+    """
+    Parses a job from a job file (see load_jobs()).
+
+    :param raw_job: The job, as loaded from JSON or YAML.
+    :return: The job.
+    :raises ValueError: If the job is invalid.
+    """
+    if not isinstance(raw_job, dict):
+        raise ValueError('must be a mapping')
+    kinds = [kind for kind in (BACKUP, RESTORE) if kind in raw_job]
+    if len(kinds) != 1:
+        raise ValueError(f'must have exactly one of "{BACKUP}" or "{RESTORE}"')
+    kind = kinds[0]
+    if 'to' not in raw_job:
+        raise ValueError('missing "to"')
+    unknown_options = raw_job.keys() - {kind, 'to'} - (BACKUP_OPTIONS if kind == BACKUP else RESTORE_OPTIONS)
+    if unknown_options:
+        raise ValueError(f'unknown options for a {kind}: {", ".join(sorted(unknown_options))}')
+    if kind == BACKUP:
+        directory, bucket = str(raw_job[BACKUP]), str(raw_job['to'])
+    else:
+        bucket, directory = str(raw_job[RESTORE]), str(raw_job['to'])
+    bucket_name, separator, bucket_dir = bucket.partition('::')
+    if not separator or '::' in bucket_dir:
+        raise ValueError(f'missing bucket directory: {bucket}')
+    job = Job(kind, os.path.expanduser(directory), bucket_name, bucket_dir)
+    if kind == BACKUP:
+        if not os.path.isdir(job.directory):
+            raise ValueError(f'no such directory: {job.directory}')
+        job.pack_threshold = _size_option(raw_job, 'pack', 0)
+        job.pack_size = _size_option(raw_job, 'pack-size', DEFAULT_PACK_SIZE)
+        job.dedup = _bool_option(raw_job, 'dedup', False)
+        job.delta_threshold = _size_option(raw_job, 'delta', 0)
+        job.compression = raw_job.get('compress')
+        if job.compression is not None:
+            check_codec(job.compression)
+        job.compression_level = raw_job.get('compression-level')
+        if job.compression_level is not None and not isinstance(job.compression_level, int):
+            raise ValueError('"compression-level" must be an integer')
+        job.mirror = _bool_option(raw_job, 'mirror', False)
+        job.snapshot = _bool_option(raw_job, 'snapshot', True)
+        if job.dedup and (job.pack_threshold or job.delta_threshold):
+            raise ValueError('"dedup" is not allowed with "pack" or "delta"')
+    else:
+        job.incremental = _bool_option(raw_job, 'incremental', False)
+        job.compare_etags = _bool_option(raw_job, 'compare-etags', False)
+        snapshot_id = raw_job.get('snapshot')
+        job.snapshot_id = None if snapshot_id is None else str(snapshot_id)
+    return job
+
+
+def _bool_option(raw_job: dict, option: str, default: bool) -> bool:
+    """Gets an option of a job that is true or false."""
+    value = raw_job.get(option, default)
+    if not isinstance(value, bool):
+        raise ValueError(f'"{option}" must be true or false')
+    return value
+
+
+def _size_option(raw_job: dict, option: str, default: int) -> int:
+    """Gets an option of a job that is a size, either in bytes or with a unit (see parse_size())."""
+    value = raw_job.get(option, default)
+    if isinstance(value, bool):
+        raise ValueError(f'"{option}" must be a size')
+    if isinstance(value, int):
+        if value < 0:
+            raise ValueError(f'"{option}" must not be negative')
+        return value
+    return parse_size(str(value))
@@ -0,0 +1,94 @@
+from argparse import ArgumentParser, ArgumentTypeError, Namespace
+from typing import Optional
+
+from .generators import GENERATORS
+from ..utils.size import parse_size
+
+
+# The default file that results are appended to.
+DEFAULT_OUTPUT_PATH: str = 'benchmark-results.jsonl'
+
+
+class Arguments:
+    """Data class for storing command line arguments."""
+
+    def __init__(self, args: Namespace) -> None:
+        """
+        Initializes the object from the Namespace object.
+        :param args: The Namespace from ArgumentParser.parse_args().
+        """
+        self.scenarios: list[str] = args.scenarios
+        self.scale: float = args.scale
+        self.jobs: int = args.jobs
+        self.endpoint_url: Optional[str] = args.endpoint_url
+        self.work_dir: Optional[str] = args.work_dir
+        self.output_file: str = args.output
+        self.label: Optional[str] = args.label
+        self.pack_threshold: int = args.pack
+        self.snapshot: bool = not args.no_snapshot
+
+
+def parse_arguments() -> Arguments:
+    """
+    Parses command line arguments.
+    Exits the program if the arguments are invalid.
+    :return: The parsed arguments.
+    """
+    parser = ArgumentParser(description='Benchmarks backing up and restoring against a local S3 stand-in.')
+    parser.add_argument('scenarios', metavar='scenario', nargs='*', type=scenario, default=list(GENERATORS),
+                        help=f'scenarios to run ({", ".join(GENERATORS)}) (default: all of them)')
+    parser.add_argument('--scale', metavar='factor', type=positive_number, default=1,
+                        help='multiple of the default size of each scenario (e.g. 100 for a million tiny files) '
+                             '(default: 1)')
+    parser.add_argument('-j', '--jobs', type=positive_integer, default=1,
+                        help='number of files to back up and restore concurrently (default: 1)')
+    parser.add_argument('--endpoint-url', metavar='url',
+                        help='endpoint URL of the S3 stand-in to use (default: start a moto server)')
+    parser.add_argument('--work-dir', metavar='directory',
+                        help='directory to generate trees in (default: a temporary directory)')
+    parser.add_argument('-o', '--output', metavar='file', default=DEFAULT_OUTPUT_PATH,
+                        help='file to append results to, as JSON lines (default: %(default)s)')
+    parser.add_argument('--label', metavar='label',
+                        help='label to tag the results with, such as the version being benchmarked')
+    parser.add_argument('--pack', metavar='size', type=size, default=0,
+                        help='back up with files smaller than this size (e.g. 64KB) packed into larger objects')
+    parser.add_argument('--no-snapshot', action='store_true',
+                        help='back up without recording snapshots, unlike the backup program by default')
+    return Arguments(parser.parse_args())
+
+
+def scenario(name: str) -> str:
+    """Meant to be used a type converter for ArgumentParser.add_argument()."""
+    if name not in GENERATORS:
+        raise ArgumentTypeError(f'unknown scenario (choose from {", ".join(GENERATORS)})')
+    return name
+
+
+def size(raw_size: str) -> int:
+    """Meant to be used a type converter for ArgumentParser.add_argument()."""
+    try:
+        return parse_size(raw_size)
+    except ValueError as e:
+        raise ArgumentTypeError(str(e))
+
+
+def positive_integer(raw_integer: str) -> int:
+    """Meant to be used a type converter for ArgumentParser.add_argument()."""
+    try:
+        integer = int(raw_integer)
+    except ValueError:
+        raise ArgumentTypeError('not an integer')
+    if integer < 1:
+        raise ArgumentTypeError('must be at least 1')
+    return integer
+
+
+def positive_number(raw_number: str) -> float:
+    """Meant to be used a type converter for ArgumentParser.add_argument()."""
+    try:
+        number = float(raw_number)
+    except ValueError:
+        raise ArgumentTypeError('not a number')
+    if number <= 0:
+        raise ArgumentTypeError('must be positive')
+    return number
@@ -0,0 +1,226 @@
+import contextlib
+import logging
+import multiprocessing
+import os
+import platform
+import shutil
+import socket
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from threading import Lock
+from typing import Iterator, Optional
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    from moto.server import ThreadedMotoServer
+except ImportError:
+    ThreadedMotoServer = None
+
+from .generators import GENERATORS, modify_files
+from ..backup.backup import backup_directory, create_bucket
+from ..backup.state import BackupState
+from ..restore.restore import restore_directory
+from ..utils.client import create_client
+from ..utils.scanner import scan_directory
+from ..utils.size import bucket_directory_summary, directory_summary, files_summary
+from ..utils.snapshots import LATEST_SNAPSHOT, Snapshot, get_snapshot, put_snapshot
+
+
+# The name of the bucket that benchmarks are run in.
+BENCHMARK_BUCKET: str = 'aws-backup-benchmark'
+# The fraction of files the rerun scenario modifies between its runs.
+RERUN_MODIFIED_FRACTION: float = 0.01
+# The operations that are benchmarked in each scenario, in order.
+OPERATIONS: tuple[str, ...] = ('directory_summary', 'backup', 'bucket_directory_summary', 'restore')
+# The operations that are benchmarked again in the rerun scenario, after a few files are modified.
+RERUN_OPERATIONS: tuple[str, ...] = ('backup', 'restore')
+
+
+class RequestCounter:
+    """
+    Counts the requests an S3 Client makes, by operation (e.g. PutObject).
+    Retried requests are only counted once.
+    Safe to use from multiple threads.
+    """
+
+    counts: dict[str, int]
+    _lock: Lock
+
+    def __init__(self, s3_client) -> None:
+        """
+        Initializes the RequestCounter, and starts counting the requests of the S3 Client.
+
+        :param s3_client: The S3 Client to count the requests of.
+        """
+        self.counts = {}
+        self._lock = Lock()
+        s3_client.meta.events.register('before-call.s3', self._count)
+
+    def _count(self, model, **kwargs) -> None:
+        with self._lock:
+            self.counts[model.name] = self.counts.get(model.name, 0) + 1
+
+
+def start_server():
+    """
+    Starts a moto server on a free local port, as a stand-in for S3.
+    Sets dummy credentials if there are none, as moto accepts any credentials.
+
+    :return: The server (which has a stop() method) and its endpoint URL.
+    :raises ValueError: If moto is not installed.
+    """
+    if ThreadedMotoServer is None:
+        raise ValueError('a local S3 stand-in requires the moto package (pip install "moto[server]"), '
+                         'or specify the endpoint URL of another one')
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    # Don't log every request the server handles.
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+    server.start()
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    return server, f'http://127.0.0.1:{port}'
+
+
+def peak_memory() -> Optional[int]:
+    """
+    Gets the peak resident memory of this process.
+
+    On Linux, the peak is read from /proc, as getrusage() also counts the memory of the process
+    that started this one, before it was replaced by this program.
+
+    :return: The peak memory in bytes, or None if it can't be measured on this platform.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, and macOS reports bytes.
+    return max_rss if platform.system() == 'Darwin' else max_rss * 1024
+
+
+def run_operation(operation: str, endpoint_url: str, directory: str, restore_directory_path: str,
+                  bucket_directory: str, state_path: str, jobs: int = 1, incremental: bool = False,
+                  pack_threshold: int = 0, snapshot_cache: Optional[str] = None) -> dict:
+    """
+    Runs and measures a single operation. Meant to be run in a fresh process, so that its peak memory is its own.
+    The operation's output is discarded, but it is still printed, so its cost is included.
+    Backups are made the way the backup program makes them: with a snapshot by default,
+    taking unchanged files from the previous one, and replacing unreferenced packs if packing.
+
+    :param operation: The operation to run (see OPERATIONS).
+    :param endpoint_url: The endpoint URL of the S3 stand-in.
+    :param directory: The generated directory.
+    :param restore_directory_path: The directory to restore to.
+    :param bucket_directory: The name of the bucket directory to back up to and restore from.
+    :param state_path: The path of the state database to back up with.
+    :param jobs: The number of concurrent jobs.
+    :param incremental: True to restore incrementally.
+    :param pack_threshold: Files smaller than this many bytes are packed. Packing is disabled if this is 0.
+    :param snapshot_cache: The directory to cache snapshots in, or None to back up without recording snapshots.
+    :return: The wall time in seconds, the number of requests by operation, and the peak memory in bytes.
+    """
+    s3_client = create_client(jobs, endpoint_url)
+    counter = RequestCounter(s3_client)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start_time = time.perf_counter()
+        if operation == 'directory_summary':
+            directory_summary(directory)
+        elif operation == 'backup':
+            with BackupState(state_path) as state:
+                snapshot = None
+                previous_snapshot = None
+                if snapshot_cache is not None:
+                    snapshot = Snapshot()
+                    previous_snapshot = get_snapshot(BENCHMARK_BUCKET, bucket_directory, LATEST_SNAPSHOT, s3_client,
+                                                     snapshot_cache)
+                backup_directory(directory, BENCHMARK_BUCKET, bucket_directory, s3_client, jobs=jobs, state=state,
+                                 pack_threshold=pack_threshold, snapshot=snapshot,
+                                 previous_snapshot=previous_snapshot)
+                if snapshot is not None:
+                    put_snapshot(BENCHMARK_BUCKET, bucket_directory, snapshot, s3_client, snapshot_cache)
+        elif operation == 'bucket_directory_summary':
+            bucket_directory_summary(BENCHMARK_BUCKET, bucket_directory, s3_client)
+        elif operation == 'restore':
+            restore_directory(BENCHMARK_BUCKET, bucket_directory, restore_directory_path, s3_client, jobs=jobs,
+                              incremental=incremental)
+        else:
+            raise ValueError(f'unknown operation: {operation}')
+        wall_time = time.perf_counter() - start_time
+    return {'wall_time': wall_time, 'requests': counter.counts, 'peak_memory': peak_memory()}
+
+
+def run_scenario(scenario: str, endpoint_url: str, work_directory: str, scale: float = 1, jobs: int = 1,
+                 label: Optional[str] = None, pack_threshold: int = 0, snapshot: bool = True) -> Iterator[dict]:
+    """
+    Generates the scenario's directory tree, then runs and measures each operation on it in its own process.
+
+    :param scenario: The name of the scenario (see GENERATORS).
+    :param endpoint_url: The endpoint URL of the S3 stand-in.
+    :param work_directory: The directory to generate trees, restore, and keep state databases in.
+    :param scale: The multiple of the scenario's default size to generate.
+    :param jobs: The number of concurrent jobs.
+    :param label: An optional label to tag the results with, such as the version being benchmarked.
+    :param pack_threshold: Files smaller than this many bytes are packed when backed up.
+                           Packing is disabled if this is 0, as it is by default in the backup program.
+    :param snapshot: True to record a snapshot of each backup, as the backup program does by default.
+    :return: A result for each operation, as soon as it finishes.
+    """
+    directory = os.path.join(work_directory, scenario, 'source')
+    restore_directory_path = os.path.join(work_directory, scenario, 'restored')
+    state_path = os.path.join(work_directory, scenario, 'state.sqlite3')
+    snapshot_cache = os.path.join(work_directory, scenario, 'snapshots') if snapshot else None
+    # Back up to a new bucket directory, in case the S3 stand-in is reused between benchmarks.
+    bucket_directory = f'{scenario}-{uuid.uuid4().hex}'
+    GENERATORS[scenario](directory, scale, 0)
+    if not create_bucket(BENCHMARK_BUCKET, create_client(jobs, endpoint_url)):
+        raise ValueError(f'failed to create the bucket "{BENCHMARK_BUCKET}"')
+    operations = [(operation, False) for operation in OPERATIONS]
+    if scenario == 'rerun':
+        operations += [(None, False)] + [(f'{operation}_rerun', True) for operation in RERUN_OPERATIONS]
+    # Use a fresh process for each operation, which is only started once the previous one has finished.
+    context = multiprocessing.get_context('spawn')
+    for operation, rerun in operations:
+        if operation is None:
+            modify_files(directory, RERUN_MODIFIED_FRACTION, seed=1)
+            continue
+        summary = files_summary(scan_directory(directory))
+        with ProcessPoolExecutor(1, mp_context=context) as executor:
+            result = executor.submit(run_operation, operation.removesuffix('_rerun'), endpoint_url, directory,
+                                     restore_directory_path, bucket_directory, state_path, jobs, rerun,
+                                     pack_threshold, snapshot_cache).result()
+        yield {
+            'label': label,
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'scenario': scenario,
+            'operation': operation,
+            'scale': scale,
+            'jobs': jobs,
+            'pack': pack_threshold,
+            'snapshot': snapshot,
+            'files': summary.file_count,
+            'bytes': summary.total_size,
+            'wall_time': result['wall_time'],
+            'files_per_second': summary.file_count / result['wall_time'] if result['wall_time'] else None,
+            'bytes_per_second': summary.total_size / result['wall_time'] if result['wall_time'] else None,
+            'requests': result['requests'],
+            'total_requests': sum(result['requests'].values()),
+            'peak_memory': result['peak_memory'],
+        }
+    shutil.rmtree(os.path.join(work_directory, scenario), ignore_errors=True)
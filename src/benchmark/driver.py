@@ -0,0 +1,53 @@
+import json
+import sys
+import tempfile
+
+from .args import parse_arguments
+from .benchmark import run_scenario, start_server
+from ..utils.size import TRANSMISSION_RATES, format_size
+
+
+def main():
+    args = parse_arguments()
+    # Start a local S3 stand-in, unless one was specified.
+    server = None
+    endpoint_url = args.endpoint_url
+    if endpoint_url is None:
+        try:
+            server, endpoint_url = start_server()
+        except ValueError as e:
+            print(f'Error: {e}.', file=sys.stderr)
+            return
+    print(f'Benchmarking against {endpoint_url}, appending results to {args.output_file}.')
+    try:
+        with tempfile.TemporaryDirectory(dir=args.work_dir) as work_directory:
+            for scenario in args.scenarios:
+                print(f'Generating the {scenario} scenario...')
+                for result in run_scenario(scenario, endpoint_url, work_directory, args.scale, args.jobs, args.label,
+                                           args.pack_threshold, args.snapshot):
+                    print_result(result)
+                    # Append each result as soon as it's measured, so that an interrupted benchmark keeps them.
+                    with open(args.output_file, 'a') as f:
+                        f.write(json.dumps(result) + '\n')
+    finally:
+        if server is not None:
+            server.stop()
+    print('Benchmark completed.')
+
+
+def print_result(result: dict) -> None:
+    """
+    Prints a benchmark result for a person to read.
+
+    :param result: The result, from run_scenario().
+    """
+    rate = format_size(result['bytes_per_second'] * 8, TRANSMISSION_RATES, 1000) \
+        if result['bytes_per_second'] is not None else '-'
+    peak_memory = format_size(result['peak_memory']) if result['peak_memory'] is not None else '-'
+    requests = ', '.join(f'{operation} {count}' for operation, count in sorted(result['requests'].items()))
+    print(f'  {result["operation"]:<26}{result["wall_time"]:9.2f} s {rate:>12} {peak_memory:>10} peak'
+          f'  {result["total_requests"]} requests{f" ({requests})" if requests else ""}')
+
+
+if __name__ == '__main__':
+    main()
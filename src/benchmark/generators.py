@@ -0,0 +1,114 @@
+import os
+import random
+from typing import Callable
+
+
+# The number of tiny files generated at a scale of 1. A scale of 100 generates a million.
+TINY_FILE_COUNT: int = 10000
+# The size of each tiny file in bytes.
+TINY_FILE_SIZE: int = 128
+# The most files generated in a single directory, so that huge trees are split into subdirectories.
+FILES_PER_DIRECTORY: int = 1000
+# The number of huge files generated.
+HUGE_FILE_COUNT: int = 4
+# The size of each huge file in bytes at a scale of 1.
+HUGE_FILE_SIZE: int = 64 * 1024 * 1024
+# The depth of the deeply nested tree. Every directory has two subdirectories, down to this depth.
+DEEP_TREE_DEPTH: int = 10
+# The number of files in each directory of the deeply nested tree at a scale of 1.
+DEEP_TREE_FILES: int = 4
+# The size of each file in the deeply nested tree in bytes.
+DEEP_TREE_FILE_SIZE: int = 4096
+# The size of the blocks that generated contents are written in.
+BLOCK_SIZE: int = 1024 * 1024
+
+
+def write_file(file_path: str, size: int, rng: random.Random) -> None:
+    """
+    Writes a file of random (and so incompressible) contents.
+
+    :param file_path: The path of the file to write.
+    :param size: The size of the file in bytes.
+    :param rng: The random number generator to generate the contents with, so that trees are reproducible.
+    """
+    with open(file_path, 'wb') as f:
+        for offset in range(0, size, BLOCK_SIZE):
+            f.write(rng.randbytes(min(BLOCK_SIZE, size - offset)))
+
+
+def generate_tiny_files(directory: str, scale: float = 1, seed: int = 0) -> None:
+    """
+    Generates many tiny files, split into subdirectories of at most FILES_PER_DIRECTORY files each.
+
+    :param directory: The directory to generate the files in.
+    :param scale: The multiple of TINY_FILE_COUNT files to generate.
+    :param seed: The seed of the generated contents.
+    """
+    rng = random.Random(seed)
+    for i in range(max(1, round(TINY_FILE_COUNT * scale))):
+        subdirectory = os.path.join(directory, f'{i // FILES_PER_DIRECTORY:05d}')
+        if i % FILES_PER_DIRECTORY == 0:
+            os.makedirs(subdirectory, exist_ok=True)
+        write_file(os.path.join(subdirectory, f'{i:08d}.bin'), TINY_FILE_SIZE, rng)
+
+
+def generate_huge_files(directory: str, scale: float = 1, seed: int = 0) -> None:
+    """
+    Generates a few huge files.
+
+    :param directory: The directory to generate the files in.
+    :param scale: The multiple of HUGE_FILE_SIZE bytes to make each file.
+    :param seed: The seed of the generated contents.
+    """
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    for i in range(HUGE_FILE_COUNT):
+        write_file(os.path.join(directory, f'huge-{i}.bin'), max(1, round(HUGE_FILE_SIZE * scale)), rng)
+
+
+def generate_deep_tree(directory: str, scale: float = 1, seed: int = 0) -> None:
+    """
+    Generates a deeply nested tree, in which every directory has two subdirectories down to DEEP_TREE_DEPTH.
+
+    :param directory: The directory to generate the tree in.
+    :param scale: The multiple of DEEP_TREE_FILES files to generate in each directory.
+    :param seed: The seed of the generated contents.
+    """
+    rng = random.Random(seed)
+    files_per_directory = max(1, round(DEEP_TREE_FILES * scale))
+    directories = [(directory, 0)]
+    while directories:
+        path, depth = directories.pop()
+        os.makedirs(path, exist_ok=True)
+        for i in range(files_per_directory):
+            write_file(os.path.join(path, f'file-{i}.bin'), DEEP_TREE_FILE_SIZE, rng)
+        if depth < DEEP_TREE_DEPTH:
+            directories.extend((os.path.join(path, name), depth + 1) for name in ('left', 'right'))
+
+
+def modify_files(directory: str, fraction: float, seed: int = 0) -> int:
+    """
+    Rewrites a fraction of the files in the directory with new contents of the same size,
+    such as between a backup and a mostly unchanged re-run.
+
+    :param directory: The directory to modify the files of.
+    :param fraction: The fraction of files to modify, between 0 and 1.
+    :param seed: The seed that chooses the files and their new contents.
+    :return: The number of files modified.
+    """
+    rng = random.Random(seed)
+    file_paths = sorted(os.path.join(path, name) for path, _, names in os.walk(directory) for name in names)
+    modified_paths = rng.sample(file_paths, max(1, round(len(file_paths) * fraction))) if file_paths else []
+    for file_path in modified_paths:
+        write_file(file_path, os.path.getsize(file_path), rng)
+    return len(modified_paths)
+
+
+# The generator of each scenario's directory tree, by scenario name.
+# The rerun scenario backs up and restores tiny files, then does both again after modifying a few of them.
+GENERATORS: dict[str, Callable[[str, float, int], None]] = {
+    'tiny': generate_tiny_files,
+    'huge': generate_huge_files,
+    'deep': generate_deep_tree,
+    'rerun': generate_tiny_files,
+}
@@ -1,4 +1,7 @@
 from argparse import ArgumentParser, ArgumentTypeError, Namespace
+from typing import Optional
+
+from ..utils.throttle import BandwidthRule, parse_bandwidth_rule
 
 
 class Arguments:
@@ -12,6 +15,14 @@ class Arguments:
         self.bucket_name: str = args.source[0]
         self.bucket_dir: str = args.source[1]
         self.destination_dir: str = args.destination
+        self.jobs: int = args.jobs
+        self.incremental: bool = args.incremental
+        self.compare_etags: bool = args.compare_etags
+        self.snapshot_id: Optional[str] = args.snapshot
+        self.stream: bool = args.stream
+        self.report_file: Optional[str] = args.report
+        self.profile_file: Optional[str] = args.profile
+        self.bandwidth_rules: list[BandwidthRule] = args.max_bandwidth
 
 
 def parse_arguments() -> Arguments:
@@ -25,7 +36,30 @@ def parse_arguments() -> Arguments:
                         help='bucket and directory to restore from')
     parser.add_argument('destination', metavar='directory',
                         help='directory to restore to')
-    return Arguments(parser.parse_args())
+    parser.add_argument('-j', '--jobs', type=positive_integer, default=1,
+                        help='number of files to restore concurrently (default: 1)')
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help='skip files that are already restored, such as after an interrupted restore')
+    parser.add_argument('--compare-etags', action='store_true',
+                        help='when restoring incrementally, also compare files against their ETags')
+    parser.add_argument('--snapshot', metavar='id',
+                        help='restore the directory as it was in a snapshot (an ID, or "latest"), '
+                             'without listing the bucket')
+    parser.add_argument('--stream', action='store_true',
+                        help='restore files as soon as they are listed, instead of listing the whole bucket '
+                             'directory first')
+    parser.add_argument('--max-bandwidth', metavar='rate[@start-end]', type=bandwidth_rule, action='append',
+                        default=[],
+                        help='limit the bandwidth of all transfers combined (e.g. 50Mbps or 5MB/s), optionally only '
+                             'between two times of day (e.g. 50Mbps@9-17); repeat to schedule several limits')
+    parser.add_argument('--report', metavar='file',
+                        help='write metrics of the run (requests, latencies, and time spent in each phase) as JSON')
+    parser.add_argument('--profile', metavar='file',
+                        help='write a cProfile profile of the run, which can be read with pstats')
+    args = parser.parse_args()
+    if args.stream and args.snapshot is not None:
+        parser.error('argument --stream: not allowed with argument --snapshot')
+    return Arguments(args)
 
 
 def bucket_and_directory(name: str) -> tuple[str, str]:
@@ -34,3 +68,22 @@ def bucket_and_directory(name: str) -> tuple[str, str]:
     if len(elements) != 2:
         raise ArgumentTypeError('missing bucket directory')
     return elements[0], elements[1]
+
+
+def positive_integer(raw_integer: str) -> int:
+    """Meant to be used a type converter for ArgumentParser.add_argument()."""
+    try:
+        integer = int(raw_integer)
+    except ValueError:
+        raise ArgumentTypeError('not an integer')
+    if integer < 1:
+        raise ArgumentTypeError('must be at least 1')
+    return integer
+
+
+def bandwidth_rule(raw_rule: str) -> BandwidthRule:
+    """Meant to be used a type converter for ArgumentParser.add_argument()."""
+    try:
+        return parse_bandwidth_rule(raw_rule)
+    except ValueError as e:
+        raise ArgumentTypeError(str(e))
@@ -1,27 +1,91 @@
-import boto3
+import sys
+from functools import partial
 
-from .args import parse_arguments
-from .restore import bucket_exists, restore_directory
+from botocore.exceptions import ClientError
+
+from .args import Arguments, parse_arguments
+from .restore import bucket_exists, restore_directory, restore_summary
+from ..utils.chunks import get_delta_index
+from ..utils.client import create_client
+from ..utils.concurrency import AdaptiveConcurrency
+from ..utils.dedup import get_dedup_manifest
+from ..utils.listing import list_bucket_directory
+from ..utils.metrics import Metrics, run_with_metrics
+from ..utils.packs import get_pack_index
 from ..utils.progress import ProgressLogger
-from ..utils.size import bucket_directory_summary, format_size
+from ..utils.size import DirectoryInfo, format_size
+from ..utils.snapshots import get_snapshot
+from ..utils.throttle import RateLimiter, throttle_client
 
 
 def main():
     args = parse_arguments()
+    run_with_metrics(partial(restore, args), args.report_file, args.profile_file)
+
+
+def restore(args: Arguments, metrics: Metrics) -> None:
+    """
+    Runs the restore program.
+
+    :param args: The parsed command line arguments.
+    :param metrics: The Metrics to record the phases of the program and the requests of its client in.
+    """
     # Create a reusable client.
-    s3_client = boto3.client('s3')
-    if not bucket_exists(args.bucket_name):
+    s3_client = create_client(args.jobs)
+    metrics.instrument(s3_client)
+    # Adapt the number of transfers in flight to throttling and latency, up to the number of jobs.
+    concurrency = AdaptiveConcurrency(args.jobs)
+    concurrency.instrument(s3_client)
+    # Share one bandwidth limit between every transfer, if any was specified.
+    if args.bandwidth_rules:
+        throttle_client(s3_client, RateLimiter(args.bandwidth_rules))
+    if not bucket_exists(args.bucket_name, s3_client):
         return
     # Prepare the progress logger and print a cool sounding message for the user to read.
-    print('Calculating the size of the directory...')
-    directory_info = bucket_directory_summary(args.bucket_name, args.bucket_dir, s3_client=s3_client)
-    progress = ProgressLogger(directory_info.file_count, directory_info.total_size)
-    formatted_directory_size = format_size(directory_info.total_size)
-    print(f'Restoring {directory_info.file_count} files ({formatted_directory_size}).')
+    snapshot = None
+    object_index = pack_index = dedup_manifest = delta_index = None
+    if args.snapshot_id is not None:
+        # Get the snapshot with a single request (or none, if it's cached), instead of listing the bucket directory.
+        print('Getting the snapshot...')
+        with metrics.phase('get_snapshot'):
+            try:
+                snapshot = get_snapshot(args.bucket_name, args.bucket_dir, args.snapshot_id, s3_client)
+            except ClientError:
+                snapshot = None
+        if snapshot is None:
+            print(f'Error: Could not get the snapshot {args.snapshot_id}.', file=sys.stderr)
+            return
+        print(f'Restoring the snapshot {snapshot.snapshot_id}.')
+        directory_info = DirectoryInfo(len(snapshot), snapshot.total_size)
+    else:
+        with metrics.phase('get_indexes'):
+            pack_index = get_pack_index(args.bucket_name, args.bucket_dir, s3_client)
+            dedup_manifest = get_dedup_manifest(args.bucket_name, args.bucket_dir, s3_client)
+            delta_index = get_delta_index(args.bucket_name, args.bucket_dir, s3_client)
+        if not args.stream:
+            # List the bucket directory once, in parallel, for both the summary and the restoration.
+            print('Calculating the size of the directory...')
+            with metrics.phase('list'):
+                object_index = list_bucket_directory(args.bucket_name, args.bucket_dir, s3_client, args.jobs)
+                directory_info = restore_summary(object_index, pack_index, dedup_manifest, delta_index)
+    if args.stream:
+        # List in the background, restoring files as soon as they're listed.
+        progress = ProgressLogger(scanning=True)
+        print('Restoring files as they are listed...')
+    else:
+        progress = ProgressLogger(directory_info.file_count, directory_info.total_size)
+        formatted_directory_size = format_size(directory_info.total_size)
+        print(f'Restoring {directory_info.file_count} files ({formatted_directory_size}).')
+    progress.print_progress_info()
+    # Begin the restoration. When streaming, listing happens during this phase.
+    with metrics.phase('restore'):
+        restore_directory(args.bucket_name, args.bucket_dir, args.destination_dir,
+                          s3_client=s3_client, jobs=args.jobs, pack_index=pack_index, progress=progress,
+                          dedup_manifest=dedup_manifest, incremental=args.incremental,
+                          compare_etags=args.compare_etags, delta_index=delta_index, object_index=object_index,
+                          concurrency=concurrency, snapshot=snapshot)
+    # Redraw the final progress, in case the last redraw was skipped.
     progress.print_progress_info()
-    # Begin the restoration.
-    restore_directory(args.bucket_name, args.bucket_dir, args.destination_dir,
-                      s3_client=s3_client, callback=progress.complete_file)
     print('\nRestoration completed.')
 
 
@@ -1,10 +1,29 @@
 import os
+import shutil
 import sys
-from typing import Callable, Optional
+from datetime import datetime
+from functools import partial
+from itertools import combinations
+from threading import Lock
+from typing import Callable, Iterator, Optional
 
 import boto3
 from botocore.exceptions import ClientError
 
+from ..utils.chunks import (AVERAGE_CHUNK_SIZE, DeltaEntry, DeltaIndex, get_chunk_manifest, get_delta_index,
+                            restore_chunks)
+from ..utils.compression import CHUNK_SIZE, COMPRESSION_METADATA, decompress_stream
+from ..utils.concurrency import AdaptiveConcurrency
+from ..utils.dedup import DedupEntry, DedupManifest, blob_key, file_etag, get_dedup_manifest
+from ..utils.listing import ObjectIndex, ObjectInfo, format_etag, iter_bucket_directory, parse_etag
+from ..utils.manifest import is_metadata_path
+from ..utils.multipart import MULTIPART_THRESHOLD, choose_concurrency, download_ranges
+from ..utils.packs import PackEntry, PackIndex, get_pack_index, read_pack
+from ..utils.progress import FileTransfer, ProgressLogger
+from ..utils.size import DirectoryInfo
+from ..utils.snapshots import OBJECT_KIND, Snapshot
+from ..utils.workers import run_workers
+
 
 def bucket_exists(bucket_name: str, s3_client=None) -> bool:
     """
@@ -27,10 +46,47 @@ def bucket_exists(bucket_name: str, s3_client=None) -> bool:
 
 
 def restore_directory(bucket_name: str, bucket_directory: str, directory: str, s3_client=None,
-                      callback: Optional[Callable[[str, bool], None]] = None) -> None:
+                      callback: Optional[Callable[[str, bool], None]] = None, jobs: int = 1,
+                      pack_index: Optional[PackIndex] = None, progress: Optional[ProgressLogger] = None,
+                      dedup_manifest: Optional[DedupManifest] = None, incremental: bool = False,
+                      compare_etags: bool = False, delta_index: Optional[DeltaIndex] = None,
+                      object_index: Optional[ObjectIndex] = None,
+                      concurrency: Optional[AdaptiveConcurrency] = None, snapshot: Optional[Snapshot] = None,
+                      quiet: bool = False) -> None:
     """
     Restores the directory from the bucket.
 
+    Unless a listing is specified (such as one already used for bucket_directory_summary()),
+    the bucket directory is listed in parallel shards while files are restored,
+    and each object is restored as soon as its page of the listing arrives (see iter_objects()).
+    If the progress logger is scanning, each file is then added to its totals as it's found,
+    and scanning ends once every file has been found.
+    A listing that is specified up front gives exact totals from the start,
+    but no object is downloaded until the whole bucket directory has been listed.
+    Packed, deduplicated, and delta backed up files are restored from their packs, blobs, and chunks
+    after the listed objects.
+    If a file was backed up in more than one way (e.g. on its own, and later packed),
+    the most recently uploaded of its object, the pack index, the dedup manifest, and the delta index wins.
+    Each blob is only downloaded once, then copied to every other file with the same contents.
+    Each delta backed up file is reassembled from the chunks listed in its chunk manifest.
+    Objects that were compressed when they were backed up are decompressed as they are downloaded.
+    Each file restored from an object is given the object's last modified date as its modification time,
+    and each file restored from a pack, blob, or chunks is given the modification time it was backed up with.
+    Downloads that S3 throttles (e.g. with SlowDown) are retried with backoff,
+    and the number of them in flight adapts to throttling (see AdaptiveConcurrency).
+
+    If a snapshot is specified, the directory is restored as it was when the snapshot was taken,
+    from the objects (and versions, if the bucket is versioned) the snapshot recorded,
+    instead of from the listing and indexes, so nothing needs to be listed or downloaded before restoring.
+    Files in their own objects are given their modification times from the snapshot.
+    In an unversioned bucket, files whose objects have been overwritten since the snapshot fail to restore,
+    rather than being restored with their newer contents.
+
+    If the restore is incremental, files that are already restored are skipped (see is_restored() and
+    is_entry_restored()),
+    so that an interrupted restore can be resumed, or a mostly current directory brought up to date.
+    Files are only compared against the listing and the indexes, so skipping a file makes no requests.
+
     :param bucket_name: The name of the bucket the directory to restore from is in.
     :param bucket_directory: The name of the directory to restore from.
     :param directory: The directory to restore to.
@@ -38,41 +94,391 @@ def restore_directory(bucket_name: str, bucket_directory: str, directory: str, s
     :param callback: An optional callback function that will be called after each file is restored.
                      The parameters are the restored file's path,
                      and whether the file was restored or not.
+                     Calls to the callback are never made concurrently, even if jobs is greater than 1.
+    :param jobs: The number of files to restore concurrently.
+    :param pack_index: The pack index of the bucket directory.
+                       The pack index will be downloaded if none is specified.
+    :param progress: An optional ProgressLogger to complete each file in after it is restored.
+                     Files are completed with the size of their object in the bucket,
+                     matching the totals from bucket_directory_summary() even if the object was compressed.
+                     If one is specified, only the files that fail to restore are printed.
+    :param dedup_manifest: The dedup manifest of the bucket directory.
+                           The dedup manifest will be downloaded if none is specified.
+    :param incremental: True to skip files that are already restored, False to restore every file.
+    :param compare_etags: True to also compare files restored from objects against the objects' ETags,
+                          which reads every file that would otherwise be skipped.
+                          Only used if the restore is incremental.
+    :param delta_index: The delta index of the bucket directory.
+                        The delta index will be downloaded if none is specified.
+    :param object_index: The objects in the bucket directory (see list_bucket_directory()).
+                         The bucket directory will be listed while restoring if none is specified.
+    :param concurrency: The AdaptiveConcurrency to limit downloads in flight with, such as one shared with other
+                        directories, or one instrumenting the client. Defaults to one allowing jobs downloads at once.
+    :param snapshot: The Snapshot to restore (see get_snapshot()), or None to restore the current backup.
+    :param quiet: True to only print the files that fail to restore, by their full path,
+                  such as when several directories are restored at once.
     """
     # Create a simple S3 Client if none was specified.
     if s3_client is None:
         s3_client = boto3.client('s3')
-    # Use a paginator to get the list of all objects in the bucket and directory.
-    paginator = s3_client.get_paginator('list_objects_v2')
-    page_iterator = paginator.paginate(Bucket=bucket_name, Prefix=bucket_directory)
-    # Iterate over all the returned objects.
-    for page in page_iterator:
-        for bucket_object in page.get('Contents', []):
-            # Get the object key, relative path, and absolute path of the file.
-            object_key = bucket_object['Key']
-            relative_file_path = os.path.relpath(object_key, bucket_directory)
-            file_path = os.path.join(directory, relative_file_path)
+    # Pin each object to the version and ETag the snapshot recorded, if restoring a snapshot.
+    pinned_objects = {}
+    if snapshot is not None:
+        object_index, pack_index, dedup_manifest, delta_index = snapshot.to_indexes(bucket_directory)
+        pinned_objects = {entry.key: (entry.version_id, entry.etag) for entry in snapshot.entries.values()
+                          if entry.kind == OBJECT_KIND}
+    if pack_index is None:
+        pack_index = get_pack_index(bucket_name, bucket_directory, s3_client)
+    if dedup_manifest is None:
+        dedup_manifest = get_dedup_manifest(bucket_name, bucket_directory, s3_client)
+    if delta_index is None:
+        delta_index = get_delta_index(bucket_name, bucket_directory, s3_client)
+    if object_index is None:
+        objects = iter_bucket_directory(bucket_name, bucket_directory, s3_client, jobs)
+        objects_prefix = os.path.join(bucket_directory, '')
+    else:
+        objects = object_index
+        objects_prefix = object_index.prefix
+    # Add each file to the totals of the progress logger as it's found, if they aren't known up front.
+    discovering = progress is not None and progress.scanning
+    if concurrency is None:
+        concurrency = AdaptiveConcurrency(jobs)
+    # Only one thread at a time may print or call the callback, so that their output doesn't interleave.
+    # Printing also holds the progress logger's lock, so that the output doesn't interleave with its redraws.
+    output_lock = Lock() if progress is None else progress.lock
+
+    def report(relative_file_path: str, file_path: str, restored: bool, size: int, failed: bool = True,
+               transfer: Optional[FileTransfer] = None) -> None:
+        # Print the result and call the callback if there is one.
+        with output_lock:
+            if (quiet or progress is not None) and (restored or not failed):
+                # Only failures are printed quietly, or when the progress logger is counting the files instead.
+                pass
+            elif restored:
+                print(f'Restoring         {relative_file_path}')
+            elif failed:
+                print(f'Restoring         {file_path if quiet else relative_file_path}', end='')
+                print('    failed', file=sys.stderr)
+            else:
+                print(f'Already restored  {relative_file_path}')
+            if callback is not None:
+                callback(file_path, restored)
+            if progress is not None:
+                progress.complete(size, 0 if transfer is None else transfer.transferred_size)
+
+    def restore_file(object_info: ObjectInfo) -> None:
+        # Get the object key, relative path, and absolute path of the file.
+        object_key = object_info.key
+        relative_file_path = object_key[len(objects_prefix):]
+        file_path = os.path.join(directory, relative_file_path)
+        last_modified = object_info.last_modified
+        if incremental and is_restored(file_path, object_info.size, last_modified,
+                                       object_info.etag if compare_etags else None):
+            report(relative_file_path, file_path, False, object_info.size, failed=False)
+            return
+        # Restore the file, then stamp it with the object's last modified date.
+        transfer = FileTransfer(progress)
+        try:
             create_parent_directories(file_path)
-            # Restore the file.
-            print(f'Restoring  {relative_file_path}', end='')
+            version_id, etag = pinned_objects.get(object_key, (None, None))
+            concurrency.call(download_file, bucket_name, object_key, file_path, s3_client, size=object_info.size,
+                             callback=transfer, version_id=version_id, etag=etag)
+            os.utime(file_path, (last_modified.timestamp(), last_modified.timestamp()))
+            restored = True
+        except (ClientError, ValueError, OSError):
+            restored = False
+        report(relative_file_path, file_path, restored, object_info.size, transfer=transfer)
+
+    def restore_pack(pack_name: str, entries: list[tuple[str, PackEntry]]) -> None:
+        # Skip the files that are already restored, so that they aren't read from the pack.
+        if incremental:
+            remaining_entries = []
+            for relative_file_path, entry in entries:
+                file_path = os.path.join(directory, relative_file_path)
+                if is_entry_restored(file_path, entry.length, entry.mtime_ns):
+                    report(relative_file_path, file_path, False, entry.length, failed=False)
+                else:
+                    remaining_entries.append((relative_file_path, entry))
+            entries = remaining_entries
+            if not entries:
+                return
+        # Restore every needed file in the pack, then report any that couldn't be read from the pack as failed.
+        unrestored = dict(entries)
+        try:
+            for relative_file_path, data in read_pack(bucket_name, bucket_directory, pack_name, entries, s3_client):
+                entry = unrestored.pop(relative_file_path)
+                file_path = os.path.join(directory, relative_file_path)
+                try:
+                    create_parent_directories(file_path)
+                    with open(file_path, 'wb') as f:
+                        f.write(data)
+                    os.utime(file_path, ns=(entry.mtime_ns, entry.mtime_ns))
+                    restored = True
+                except OSError:
+                    restored = False
+                report(relative_file_path, file_path, restored, len(data))
+        except ClientError:
+            pass
+        for relative_file_path, entry in unrestored.items():
+            report(relative_file_path, os.path.join(directory, relative_file_path), False, entry.length)
+
+    def restore_blob(digest: str, entries: list[tuple[str, DedupEntry]]) -> None:
+        # Download the blob to the first file, then copy that file to the rest.
+        # If any file is already restored, the blob isn't downloaded at all, and that file is copied instead.
+        first_file_path = None
+        if incremental:
+            remaining_entries = []
+            for relative_file_path, entry in entries:
+                file_path = os.path.join(directory, relative_file_path)
+                if is_entry_restored(file_path, entry.size, entry.mtime_ns):
+                    first_file_path = file_path
+                    report(relative_file_path, file_path, False, entry.size, failed=False)
+                else:
+                    remaining_entries.append((relative_file_path, entry))
+            entries = remaining_entries
+        for relative_file_path, entry in entries:
+            file_path = os.path.join(directory, relative_file_path)
+            transfer = FileTransfer(progress)
             try:
-                s3_client.download_file(bucket_name, object_key, file_path)
+                create_parent_directories(file_path)
+                if first_file_path is None:
+                    concurrency.call(download_file, bucket_name, blob_key(digest), file_path, s3_client,
+                                     size=entry.size, callback=transfer)
+                    first_file_path = file_path
+                else:
+                    shutil.copyfile(first_file_path, file_path)
+                os.utime(file_path, ns=(entry.mtime_ns, entry.mtime_ns))
                 restored = True
-                print()
-            except ClientError:
+            except (ClientError, ValueError, OSError):
                 restored = False
-                print('    failed', file=sys.stderr)
-            # Call the callback if there is one.
-            if callback is not None:
-                callback(file_path, restored)
+            report(relative_file_path, file_path, restored, entry.size, transfer=transfer)
+
+    def restore_delta(relative_file_path: str, entry: DeltaEntry) -> None:
+        file_path = os.path.join(directory, relative_file_path)
+        if incremental and is_entry_restored(file_path, entry.size, entry.mtime_ns):
+            report(relative_file_path, file_path, False, entry.size, failed=False)
+            return
+        # Reassemble the file from the chunks in its chunk manifest.
+        transfer = FileTransfer(progress)
+        try:
+            chunks = get_chunk_manifest(bucket_name, bucket_directory, relative_file_path, s3_client, entry.manifest)
+            if chunks is None:
+                raise ValueError(f'missing chunk manifest for {relative_file_path}')
+            create_parent_directories(file_path)
+            concurrency.call(restore_chunks, bucket_name, chunks, file_path, entry.size, s3_client,
+                             choose_concurrency(entry.size, AVERAGE_CHUNK_SIZE), transfer)
+            os.utime(file_path, ns=(entry.mtime_ns, entry.mtime_ns))
+            restored = True
+        except (ClientError, ValueError, OSError):
+            restored = False
+        report(relative_file_path, file_path, restored, entry.size, transfer=transfer)
+
+    def tasks() -> Iterator[Callable[[], None]]:
+        # Between copies of the same file in more than one index, keep the copy from the newest index.
+        indexes = [pack_index, dedup_manifest, delta_index]
+        superseded = [set() for _ in indexes]
+        for (i, index), (j, other_index) in combinations(enumerate(indexes), 2):
+            for relative_file_path in index.entries.keys() & other_index.entries.keys():
+                superseded[i if index.last_modified < other_index.last_modified else j].add(relative_file_path)
+        # Restore every object in the bucket directory, skipping metadata and files with newer copies in an index.
+        for object_info in objects:
+            relative_file_path = object_info.key[len(objects_prefix):]
+            if is_metadata_path(relative_file_path):
+                continue
+            containing_indexes = [i for i, index in enumerate(indexes) if relative_file_path in index]
+            if any(object_info.last_modified < indexes[i].last_modified for i in containing_indexes):
+                continue
+            for i in containing_indexes:
+                superseded[i].add(relative_file_path)
+            if discovering:
+                progress.add_file(object_info.size)
+            yield partial(restore_file, object_info)
+        # Then restore every packed file, every deduplicated file, and every delta backed up file.
+        superseded_packs, superseded_blobs, superseded_deltas = superseded
+        for pack_name, entries in pack_index.packs(exclude=superseded_packs).items():
+            if discovering:
+                for _, entry in entries:
+                    progress.add_file(entry.length)
+            yield partial(restore_pack, pack_name, entries)
+        for digest, entries in dedup_manifest.blobs(exclude=superseded_blobs).items():
+            if discovering:
+                for _, entry in entries:
+                    progress.add_file(entry.size)
+            yield partial(restore_blob, digest, entries)
+        for relative_file_path, entry in delta_index.entries.items():
+            if relative_file_path not in superseded_deltas:
+                if discovering:
+                    progress.add_file(entry.size)
+                yield partial(restore_delta, relative_file_path, entry)
+        if discovering:
+            with progress.lock:
+                progress.scanning = False
+
+    run_workers(run_task, tasks(), jobs)
+
+
+def restore_summary(object_index: ObjectIndex, pack_index: PackIndex, dedup_manifest: DedupManifest,
+                    delta_index: DeltaIndex) -> DirectoryInfo:
+    """
+    Counts the files restore_directory() restores from the listing and indexes of a bucket directory,
+    and their total size.
+    Like restore_directory(), a file in more than one of them is only counted once, with the size of its copy
+    from whichever was updated last, so that files superseded by a later backup aren't counted twice.
+
+    :param object_index: The objects in the bucket directory (see list_bucket_directory()).
+    :param pack_index: The pack index of the bucket directory.
+    :param dedup_manifest: The dedup manifest of the bucket directory.
+    :param delta_index: The delta index of the bucket directory.
+    :return: The number of files, and their total size.
+    """
+    # Take each file in an index from the most recently updated index that has it.
+    indexed_files = {}
+
+    def add(relative_path: str, last_modified: datetime, size: int) -> None:
+        current = indexed_files.get(relative_path)
+        if current is None or current[0] < last_modified:
+            indexed_files[relative_path] = last_modified, size
+
+    for relative_path, entry in pack_index.entries.items():
+        add(relative_path, pack_index.last_modified, entry.length)
+    for relative_path, entry in dedup_manifest.entries.items():
+        add(relative_path, dedup_manifest.last_modified, entry.size)
+    for relative_path, entry in delta_index.entries.items():
+        add(relative_path, delta_index.last_modified, entry.size)
+    # Then count every object, unless an index was updated after it, in which case its copy there is counted instead.
+    file_count = 0
+    total_size = 0
+    for relative_key, size in object_index.sizes():
+        if is_metadata_path(relative_key):
+            continue
+        indexed_file = indexed_files.get(relative_key)
+        if indexed_file is not None:
+            if object_index.get(object_index.prefix + relative_key).last_modified < indexed_file[0]:
+                continue
+            del indexed_files[relative_key]
+        file_count += 1
+        total_size += size
+    file_count += len(indexed_files)
+    total_size += sum(size for _, size in indexed_files.values())
+    return DirectoryInfo(file_count, total_size)
+
+
+def is_restored(file_path: str, size: int, last_modified: datetime, etag: Optional[str] = None) -> bool:
+    """
+    Determines if the file is already restored from its object, using only what the listing says about the object.
+
+    The file is restored if it was modified no earlier than its backup, and is the same size as its backup.
+    A file whose modification time is exactly its backup's last modified date was stamped by restore_directory(),
+    so it is restored even if its size differs, as its backup was compressed.
+    If an ETag is specified, the file must also match the ETag, unless its backup was compressed.
+
+    :param file_path: The file path on this machine.
+    :param size: The size of the backup in bytes.
+    :param last_modified: When the backup was uploaded.
+    :param etag: The ETag of the backup's object, or None to not compare ETags.
+    :return: True if the file is already restored, False otherwise.
+    """
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return False
+    if stat.st_mtime < last_modified.timestamp():
+        return False
+    if stat.st_size != size:
+        return stat.st_mtime == last_modified.timestamp()
+    if etag is None:
+        return True
+    digest, parts = parse_etag(etag)
+    if digest is None:
+        # The ETag isn't an MD5 digest (e.g. the object is encrypted with KMS), so it can't be compared.
+        return True
+    try:
+        return file_etag(file_path, parts) == format_etag(digest, parts)
+    except OSError:
+        return False
+
+
+def is_entry_restored(file_path: str, size: int, mtime_ns: int) -> bool:
+    """
+    Determines if the file is already restored from its entry in an index (e.g. the pack index).
+
+    Files restored from an index are stamped with the modification time they had when they were backed up,
+    so the file is restored if it has exactly that modification time, and is the same size as it was.
+    Unlike comparing against when the index was uploaded, this doesn't restore every file again after each backup.
+
+    :param file_path: The file path on this machine.
+    :param size: The size of the file when it was backed up, from its entry.
+    :param mtime_ns: The modification time of the file when it was backed up, from its entry, in nanoseconds.
+    :return: True if the file is already restored, False otherwise.
+    """
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return False
+    return stat.st_size == size and stat.st_mtime_ns == mtime_ns
+
+
+def download_file(bucket_name: str, object_key: str, file_path: str, s3_client=None,
+                  size: Optional[int] = None, callback: Optional[Callable[[int], None]] = None,
+                  version_id: Optional[str] = None, etag: Optional[str] = None) -> None:
+    """
+    Downloads the object to the file, decompressing it if it was compressed when it was backed up.
+
+    Small objects are fetched with a single get_object() request, which also reveals whether they were compressed.
+    Large objects are checked with head_object() first, so that uncompressed ones can still be downloaded
+    with several ranged requests at a time (see download_ranges()),
+    with the range size and concurrency chosen from the size of the object.
+
+    :param bucket_name: The name of the bucket.
+    :param object_key: The name/key of the object in the bucket.
+    :param file_path: The file path on this machine.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :param size: The size of the object, if known (e.g. from a listing).
+    :param callback: An optional callback function that will be called as the object is downloaded.
+                     The parameter is the number of bytes of the object downloaded since the last call
+                     (before decompression, so that they add up to the size of the object).
+    :param version_id: The version of the object to download. Defaults to the current version.
+    :param etag: The ETag the object must have, if any, such as when restoring a snapshot from an unversioned bucket.
+    :raises ValueError: If the object can't be decompressed.
+    :raises ClientError: If the object doesn't have the ETag (a PreconditionFailed error).
+    """
+    # Create a simple S3 Client if none was specified.
+    if s3_client is None:
+        s3_client = boto3.client('s3')
+    extra_args = {}
+    if version_id is not None:
+        extra_args['VersionId'] = version_id
+    if etag is not None:
+        extra_args['IfMatch'] = etag
+    if size is None or size >= MULTIPART_THRESHOLD:
+        response = s3_client.head_object(Bucket=bucket_name, Key=object_key, **extra_args)
+        if COMPRESSION_METADATA not in response['Metadata']:
+            download_ranges(bucket_name, object_key, file_path, response['ContentLength'], s3_client,
+                            etag=response['ETag'], callback=callback, version_id=version_id)
+            return
+    response = s3_client.get_object(Bucket=bucket_name, Key=object_key, **extra_args)
+    codec = response['Metadata'].get(COMPRESSION_METADATA)
+    with open(file_path, 'wb') as f:
+        if codec is None:
+            for chunk in response['Body'].iter_chunks(CHUNK_SIZE):
+                f.write(chunk)
+                if callback is not None:
+                    callback(len(chunk))
+        else:
+            decompress_stream(response['Body'], f, codec, callback)
+
+
+def run_task(task: Callable[[], None]) -> None:
+    """Calls the task. Meant to be used as the worker for run_workers()."""
+    task()
 
 
 def create_parent_directories(file_path: str) -> None:
     """
     Creates the directories containing the file_path,
     if they don't already exist.
+    Safe to call from multiple threads.
     :param file_path: The path to the file.
     """
     parent_directories = os.path.dirname(file_path)
-    if not os.path.exists(parent_directories):
-        os.makedirs(parent_directories)
+    os.makedirs(parent_directories, exist_ok=True)
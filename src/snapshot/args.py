@@ -0,0 +1,56 @@
+from argparse import ArgumentParser, ArgumentTypeError, Namespace
+from typing import Optional
+
+
+class Arguments:
+    """Data class for storing command line arguments."""
+
+    def __init__(self, args: Namespace) -> None:
+        """
+        Initializes the object from the Namespace object.
+        :param args: The Namespace from ArgumentParser.parse_args().
+        """
+        self.bucket_name: str = args.source[0]
+        self.bucket_dir: str = args.source[1]
+        self.diff: Optional[tuple[str, str]] = None if args.diff is None else tuple(args.diff)
+        self.prune: Optional[int] = args.prune
+
+
+def parse_arguments() -> Arguments:
+    """
+    Parses command line arguments.
+    Exits the program if the arguments are invalid.
+    :return: The parsed arguments.
+    """
+    parser = ArgumentParser(description='Lists, compares, or prunes the snapshots of a backup in AWS.')
+    parser.add_argument('source', metavar='bucket::directory', type=bucket_and_directory,
+                        help='bucket and directory whose snapshots to list, compare, or prune')
+    parser.add_argument('--diff', metavar='id', nargs=2,
+                        help='compare two snapshots (IDs, or "latest") instead of listing them; '
+                             'cached snapshots are compared without contacting AWS')
+    parser.add_argument('--prune', metavar='count', type=positive_integer,
+                        help='delete every snapshot but the most recent count, '
+                             'and the packs only the deleted snapshots referred to')
+    args = parser.parse_args()
+    if args.diff is not None and args.prune is not None:
+        parser.error('argument --prune: not allowed with argument --diff')
+    return Arguments(args)
+
+
+def bucket_and_directory(name: str) -> tuple[str, str]:
+    """Meant to be used a type converter for ArgumentParser.add_argument()."""
+    elements = name.split('::')
+    if len(elements) != 2:
+        raise ArgumentTypeError('missing bucket directory')
+    return elements[0], elements[1]
+
+
+def positive_integer(raw_integer: str) -> int:
+    """Meant to be used a type converter for ArgumentParser.add_argument()."""
+    try:
+        integer = int(raw_integer)
+    except ValueError:
+        raise ArgumentTypeError('not an integer')
+    if integer < 1:
+        raise ArgumentTypeError('must be at least 1')
+    return integer
@@ -0,0 +1,86 @@
+import sys
+
+import boto3
+from botocore.exceptions import ClientError
+
+from .args import Arguments, parse_arguments
+from ..utils.size import format_size
+from ..utils.snapshots import diff_snapshots, get_snapshot, list_snapshots, prune_snapshots
+
+
+def main():
+    args = parse_arguments()
+    if args.diff is not None:
+        diff_command(args)
+    elif args.prune is not None:
+        prune_command(args)
+    else:
+        list_command(args)
+
+
+def list_command(args: Arguments) -> None:
+    """
+    Lists the snapshots of the backed up directory.
+
+    :param args: The parsed command line arguments.
+    """
+    try:
+        snapshot_ids = list_snapshots(args.bucket_name, args.bucket_dir, boto3.client('s3'))
+    except ClientError as e:
+        print(f'Error: {e}.', file=sys.stderr)
+        return
+    for snapshot_id in snapshot_ids:
+        print(snapshot_id)
+    print(f'{len(snapshot_ids)} snapshots.')
+
+
+def diff_command(args: Arguments) -> None:
+    """
+    Prints the files that were added, removed, or modified between two snapshots of the backed up directory.
+
+    :param args: The parsed command line arguments.
+    """
+    # Snapshots that are cached are compared without making any requests.
+    s3_client = boto3.client('s3')
+    snapshots = []
+    for snapshot_id in args.diff:
+        try:
+            snapshot = get_snapshot(args.bucket_name, args.bucket_dir, snapshot_id, s3_client)
+        except ClientError as e:
+            print(f'Error: {e}.', file=sys.stderr)
+            return
+        if snapshot is None:
+            print(f'Error: There is no snapshot {snapshot_id}.', file=sys.stderr)
+            return
+        snapshots.append(snapshot)
+    old_snapshot, new_snapshot = snapshots
+    counts = {'added': 0, 'removed': 0, 'modified': 0}
+    size_change = 0
+    for change in diff_snapshots(old_snapshot, new_snapshot):
+        print(f'{change.change.capitalize():<10}{change.relative_path}')
+        counts[change.change] += 1
+        size_change += (0 if change.new_entry is None else change.new_entry.size) \
+            - (0 if change.old_entry is None else change.old_entry.size)
+    sign = '-' if size_change < 0 else '+'
+    print(f'{counts["added"]} added, {counts["removed"]} removed, {counts["modified"]} modified '
+          f'({sign}{format_size(abs(size_change))}) from {old_snapshot.snapshot_id} to {new_snapshot.snapshot_id}.')
+
+
+def prune_command(args: Arguments) -> None:
+    """
+    Deletes every snapshot of the backed up directory but the most recent ones, and the packs only they referred to.
+
+    :param args: The parsed command line arguments.
+    """
+    try:
+        pruned_ids = prune_snapshots(args.bucket_name, args.bucket_dir, args.prune, boto3.client('s3'))
+    except ClientError as e:
+        print(f'Error: {e}.', file=sys.stderr)
+        return
+    for snapshot_id in pruned_ids:
+        print(f'Deleted {snapshot_id}')
+    print(f'Deleted {len(pruned_ids)} snapshots.')
+
+
+if __name__ == '__main__':
+    main()
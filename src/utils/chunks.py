@@ -0,0 +1,418 @@
+import hashlib
+import io
+import os
+from concurrent.futures import Executor
+from datetime import datetime
+from typing import Callable, Iterable, Iterator, NamedTuple, Optional
+
+import boto3
+
+from .compression import COMPRESSION_METADATA, decompress_stream, get_compressor
+from .dedup import blob_key
+from .manifest import get_manifest, metadata_key, put_manifest
+from .workers import run_workers
+
+
+# The kind of blob (see blob_key()) that chunks are stored as.
+CHUNK_KIND: str = 'chunks'
+# Chunks are never smaller than this, except for the last chunk of a file.
+MIN_CHUNK_SIZE: int = 256 * 1024
+# Chunks are 1 MiB on average.
+AVERAGE_CHUNK_SIZE: int = 1024 * 1024
+# Chunks are never larger than this.
+MAX_CHUNK_SIZE: int = 4 * 1024 * 1024
+# Files are split into segments of this size, which are searched for chunk boundaries and hashed in parallel.
+SEGMENT_SIZE: int = 64 * 1024 * 1024
+# The name of the delta index object, inside the deltas metadata directory.
+DELTA_INDEX_NAME: str = 'index.jsonl.gz'
+# The suffix of every chunk manifest's key.
+CHUNK_MANIFEST_SUFFIX: str = '.jsonl.gz'
+
+# The gear table of the rolling hash: a fixed, pseudorandom 64-bit value for each byte value.
+# Derived from SHA-256 rather than a random number generator, so that it never changes.
+_GEAR: tuple[int, ...] = tuple(int.from_bytes(hashlib.sha256(bytes([byte])).digest()[:8], 'big')
+                               for byte in range(256))
+# The rolling hash only depends on this many of the most recent bytes, as older bytes are shifted out of it.
+_WINDOW_SIZE: int = 64
+# A position is a chunk boundary candidate if the rolling hash is below this,
+# which happens once every AVERAGE_CHUNK_SIZE bytes on average.
+_BOUNDARY_THRESHOLD: int = (1 << 64) // AVERAGE_CHUNK_SIZE
+
+
+# A chunk of a file.
+class Chunk(NamedTuple):
+    offset: int
+    length: int
+    digest: str
+
+
+def find_boundary_candidates(file_path: str, start: int, end: int) -> list[int]:
+    """
+    Finds the content-defined chunk boundary candidates in a segment of the file, using a gear rolling hash.
+
+    The rolling hash at each position only depends on the bytes just before it,
+    so the same content produces the same candidates wherever it is in the file, and whichever segment it is in.
+    Meant to be run in another process, as it is pure Python and CPU bound.
+
+    :param file_path: The file path on this machine.
+    :param start: The offset of the segment.
+    :param end: The offset of the end of the segment.
+    :return: The offsets of the candidates in the segment, in order.
+             Each candidate is the offset just after the byte that ends a chunk.
+    """
+    warm_up_start = max(0, start - _WINDOW_SIZE)
+    with open(file_path, 'rb') as f:
+        f.seek(warm_up_start)
+        data = f.read(end - warm_up_start)
+    gear = _GEAR
+    threshold = _BOUNDARY_THRESHOLD
+    rolling_hash = 0
+    # Warm up the rolling hash with the bytes before the segment, so that it matches scanning from the start.
+    for byte in data[:start - warm_up_start]:
+        rolling_hash = ((rolling_hash << 1) + gear[byte]) & 0xFFFFFFFFFFFFFFFF
+    candidates = []
+    offset = start
+    for byte in data[start - warm_up_start:]:
+        rolling_hash = ((rolling_hash << 1) + gear[byte]) & 0xFFFFFFFFFFFFFFFF
+        offset += 1
+        if rolling_hash < threshold:
+            candidates.append(offset)
+    return candidates
+
+
+def choose_boundaries(candidates: list[int], size: int) -> list[int]:
+    """
+    Chooses the chunk boundaries from the candidates, so that every chunk is between the minimum and maximum sizes.
+
+    :param candidates: The offsets of the boundary candidates in the file, in order.
+    :param size: The size of the file.
+    :return: The offset of the end of each chunk, in order. The last is always the size of the file.
+    """
+    boundaries = []
+    last_boundary = 0
+    for candidate in candidates + [size]:
+        # Cut chunks that would be too large at the maximum size.
+        while candidate - last_boundary > MAX_CHUNK_SIZE:
+            last_boundary += MAX_CHUNK_SIZE
+            boundaries.append(last_boundary)
+        # Skip candidates that would make a chunk too small, except at the end of the file.
+        if candidate - last_boundary >= MIN_CHUNK_SIZE or (candidate == size and candidate > last_boundary):
+            boundaries.append(candidate)
+            last_boundary = candidate
+    return boundaries
+
+
+def hash_chunks(file_path: str, chunks: list[tuple[int, int]]) -> list[str]:
+    """
+    Hashes consecutive chunks of the file with SHA-256.
+    Meant to be run in another process.
+
+    :param file_path: The file path on this machine.
+    :param chunks: The offset and length of each chunk, in order.
+    :return: The hex digest of each chunk.
+    """
+    digests = []
+    with open(file_path, 'rb') as f:
+        for offset, length in chunks:
+            f.seek(offset)
+            digests.append(hashlib.sha256(f.read(length)).hexdigest())
+    return digests
+
+
+def chunk_file(file_path: str, size: int, executor: Executor) -> list[Chunk]:
+    """
+    Splits the file into content-defined chunks, so that a change to part of the file only changes the chunks
+    around it, even if the change inserts or removes bytes.
+
+    The file's segments are searched for boundaries in parallel, then its chunks are hashed in parallel,
+    so chunking a large file uses every core of the executor.
+
+    :param file_path: The file path on this machine.
+    :param size: The size of the file.
+    :param executor: The executor (usually a ProcessPoolExecutor) to search for boundaries and hash chunks in.
+    :return: The chunks of the file, in order.
+    """
+    segments = range(0, size, SEGMENT_SIZE)
+    candidate_futures = [executor.submit(find_boundary_candidates, file_path, start, min(start + SEGMENT_SIZE, size))
+                         for start in segments]
+    candidates = [candidate for future in candidate_futures for candidate in future.result()]
+    # Hash the chunks in batches of about one segment, so that each task is worth sending to another process.
+    batches = []
+    batch = []
+    batch_length = 0
+    offset = 0
+    for boundary in choose_boundaries(candidates, size):
+        batch.append((offset, boundary - offset))
+        batch_length += boundary - offset
+        offset = boundary
+        if batch_length >= SEGMENT_SIZE:
+            batches.append(batch)
+            batch = []
+            batch_length = 0
+    if batch:
+        batches.append(batch)
+    digest_futures = [executor.submit(hash_chunks, file_path, batch) for batch in batches]
+    chunks = []
+    for batch, future in zip(batches, digest_futures):
+        for (offset, length), digest in zip(batch, future.result()):
+            chunks.append(Chunk(offset, length, digest))
+    return chunks
+
+
+def chunk_key(digest: str) -> str:
+    """Gets the key of the chunk with the given digest. Chunks are shared by every backed up directory in the bucket."""
+    return blob_key(digest, CHUNK_KIND)
+
+
+def put_chunk(bucket_name: str, object_key: str, data: bytes, s3_client=None, compression: Optional[str] = None,
+              compression_level: Optional[int] = None) -> None:
+    """
+    Uploads a chunk, optionally compressing it.
+    The codec of a compressed chunk is recorded in the object's metadata, like any other compressed object.
+
+    :param bucket_name: The name of the bucket.
+    :param object_key: The key of the chunk.
+    :param data: The contents of the chunk.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :param compression: The codec to compress the chunk with (see CODECS), or None to not compress the chunk.
+    :param compression_level: The compression level. The codec's default level is used if none is specified.
+    """
+    # Create a simple S3 Client if none was specified.
+    if s3_client is None:
+        s3_client = boto3.client('s3')
+    if compression is None:
+        s3_client.put_object(Bucket=bucket_name, Key=object_key, Body=data)
+        return
+    compressor = get_compressor(compression, compression_level)
+    s3_client.put_object(Bucket=bucket_name, Key=object_key, Body=compressor.compress(data) + compressor.flush(),
+                         Metadata={COMPRESSION_METADATA: compression})
+
+
+def get_chunk(bucket_name: str, digest: str, s3_client=None) -> bytes:
+    """
+    Downloads a chunk, decompressing it if it was compressed.
+
+    :param bucket_name: The name of the bucket.
+    :param digest: The hex digest of the chunk.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :return: The contents of the chunk.
+    :raises ValueError: If the chunk can't be decompressed, or doesn't match its digest.
+    """
+    # Create a simple S3 Client if none was specified.
+    if s3_client is None:
+        s3_client = boto3.client('s3')
+    response = s3_client.get_object(Bucket=bucket_name, Key=chunk_key(digest))
+    codec = response['Metadata'].get(COMPRESSION_METADATA)
+    if codec is None:
+        data = response['Body'].read()
+    else:
+        buffer = io.BytesIO()
+        decompress_stream(response['Body'], buffer, codec)
+        data = buffer.getvalue()
+    if hashlib.sha256(data).hexdigest() != digest:
+        raise ValueError(f'chunk {digest} is corrupt')
+    return data
+
+
+# A file backed up as chunks, and the digest of its chunk manifest (see chunk_manifest_digest()).
+# The digest is None for files backed up before chunk manifests were named after their digests.
+# A NamedTuple rather than a dataclass, as a delta index may hold millions of them.
+class DeltaEntry(NamedTuple):
+    size: int
+    mtime_ns: int
+    manifest: Optional[str] = None
+
+
+class DeltaIndex:
+    """Maps the relative path of each file backed up as chunks to its size, modification time, and chunk manifest."""
+
+    entries: dict[str, DeltaEntry]
+    last_modified: Optional[datetime]
+
+    def __init__(self, entries: Optional[dict[str, DeltaEntry]] = None,
+                 last_modified: Optional[datetime] = None) -> None:
+        """
+        Initializes the DeltaIndex.
+
+        :param entries: The size, modification time, and chunk manifest of each file backed up as chunks,
+                        by relative path.
+        :param last_modified: When the index was uploaded, or None if it hasn't been.
+        """
+        self.entries = {} if entries is None else entries
+        self.last_modified = last_modified
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, relative_path: str) -> bool:
+        return relative_path in self.entries
+
+    def get(self, relative_path: str) -> Optional[DeltaEntry]:
+        return self.entries.get(relative_path)
+
+    @property
+    def total_size(self) -> int:
+        """The total size of every file backed up as chunks in bytes."""
+        return sum(entry.size for entry in self.entries.values())
+
+
+def get_delta_index(bucket_name: str, bucket_directory: str, s3_client=None) -> DeltaIndex:
+    """
+    Downloads the delta index of the backed up directory.
+
+    :param bucket_name: The name of the bucket.
+    :param bucket_directory: The name of the backed up directory in the bucket.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :return: The delta index, which is empty if no files in the directory were ever backed up as chunks.
+    """
+    manifest = get_manifest(bucket_name, metadata_key(bucket_directory, 'deltas', DELTA_INDEX_NAME), s3_client)
+    if manifest is None:
+        return DeltaIndex()
+    entries, response = manifest
+    delta_index = DeltaIndex(last_modified=response['LastModified'])
+    for entry in entries:
+        delta_index.entries[entry['path']] = DeltaEntry(entry['size'], entry['mtime_ns'], entry.get('manifest'))
+    return delta_index
+
+
+def put_delta_index(bucket_name: str, bucket_directory: str, delta_index: DeltaIndex, s3_client=None) -> None:
+    """
+    Uploads the delta index of the backed up directory, replacing the previous one.
+
+    :param bucket_name: The name of the bucket.
+    :param bucket_directory: The name of the backed up directory in the bucket.
+    :param delta_index: The delta index.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    """
+    entries = ({'path': relative_path, **entry._asdict()} for relative_path, entry in delta_index.entries.items())
+    put_manifest(bucket_name, metadata_key(bucket_directory, 'deltas', DELTA_INDEX_NAME), entries, s3_client)
+
+
+def chunk_manifest_digest(chunks: list[Chunk]) -> str:
+    """
+    Computes the digest of a chunk manifest: the SHA-256 digest of the digests of its chunks, in order.
+
+    :param chunks: The chunks of the file, in order.
+    :return: The hex digest.
+    """
+    return hashlib.sha256(b''.join(bytes.fromhex(chunk.digest) for chunk in chunks)).hexdigest()
+
+
+def chunk_manifest_key(bucket_directory: str, relative_path: str, manifest: Optional[str] = None) -> str:
+    """
+    Gets the key of the chunk manifest of a file.
+
+    Chunk manifests are named after their digests, so they never change once uploaded,
+    and the manifest a delta index or snapshot refers to always lists the chunks of that version of the file.
+    Files backed up before that have no digest, and instead have a manifest named after their relative path,
+    which each backup of the file replaced.
+
+    :param bucket_directory: The name of the backed up directory in the bucket.
+    :param relative_path: The relative path of the file.
+    :param manifest: The digest of the chunk manifest, or None if the file's entry has none.
+    :return: The key of the chunk manifest.
+    """
+    if manifest is None:
+        return metadata_key(bucket_directory, 'deltas', 'files', f'{relative_path}{CHUNK_MANIFEST_SUFFIX}')
+    return metadata_key(bucket_directory, 'deltas', 'manifests', f'{manifest}{CHUNK_MANIFEST_SUFFIX}')
+
+
+def put_chunk_manifest(bucket_name: str, bucket_directory: str, chunks: list[Chunk], s3_client=None) -> str:
+    """
+    Uploads the chunk manifest of a file, which lists its chunks in order, named after its digest.
+
+    :param bucket_name: The name of the bucket.
+    :param bucket_directory: The name of the backed up directory in the bucket.
+    :param chunks: The chunks of the file, in order.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :return: The digest of the chunk manifest, to record in the file's entry.
+    """
+    manifest = chunk_manifest_digest(chunks)
+    entries = ({'digest': chunk.digest, 'length': chunk.length} for chunk in chunks)
+    put_manifest(bucket_name, chunk_manifest_key(bucket_directory, '', manifest), entries, s3_client)
+    return manifest
+
+
+def get_chunk_manifest(bucket_name: str, bucket_directory: str, relative_path: str, s3_client=None,
+                       manifest: Optional[str] = None) -> Optional[Iterator[Chunk]]:
+    """
+    Downloads the chunk manifest of a file, streaming its chunks.
+
+    :param bucket_name: The name of the bucket.
+    :param bucket_directory: The name of the backed up directory in the bucket.
+    :param relative_path: The relative path of the file.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :param manifest: The digest of the chunk manifest, from the file's entry (see chunk_manifest_key()).
+    :return: The chunks of the file in order, or None if there is no such chunk manifest.
+    """
+    downloaded_manifest = get_manifest(bucket_name, chunk_manifest_key(bucket_directory, relative_path, manifest),
+                                       s3_client)
+    if downloaded_manifest is None:
+        return None
+    entries = downloaded_manifest[0]
+
+    def chunks() -> Iterator[Chunk]:
+        offset = 0
+        for entry in entries:
+            yield Chunk(offset, entry['length'], entry['digest'])
+            offset += entry['length']
+
+    return chunks()
+
+
+def restore_chunks(bucket_name: str, chunks: Iterable[Chunk], file_path: str, size: int, s3_client=None,
+                   concurrency: int = 1, callback: Optional[Callable[[int], None]] = None) -> None:
+    """
+    Reassembles a file from its chunks, downloading several chunks at a time
+    and writing each one straight into its place in a file preallocated to the size of the file.
+
+    The file is reassembled in a temporary file next to the file, which replaces the file once it is complete,
+    so that an incomplete file is never mistaken for a restored file.
+
+    :param bucket_name: The name of the bucket.
+    :param chunks: The chunks of the file, from its chunk manifest.
+    :param file_path: The file path on this machine.
+    :param size: The size of the file.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :param concurrency: The number of chunks to download concurrently.
+    :param callback: An optional callback function that will be called after each chunk is written.
+                     The parameter is the length of the chunk.
+    :raises ValueError: If a chunk is corrupt, or the chunks don't add up to the size of the file.
+    """
+    # Create a simple S3 Client if none was specified.
+    if s3_client is None:
+        s3_client = boto3.client('s3')
+    temporary_file_path = f'{file_path}.aws-backup-part'
+    # Preallocate the file, so that chunks can be written at their offsets in any order.
+    with open(temporary_file_path, 'wb') as f:
+        f.truncate(size)
+    restored_size = 0
+
+    def restore_chunk(chunk: Chunk) -> None:
+        data = get_chunk(bucket_name, chunk.digest, s3_client)
+        if len(data) != chunk.length:
+            raise ValueError(f'chunk {chunk.digest} is the wrong length')
+        # Each chunk writes through its own file object, so chunks don't share a file position.
+        with open(temporary_file_path, 'r+b') as chunk_file:
+            chunk_file.seek(chunk.offset)
+            chunk_file.write(data)
+        if callback is not None:
+            callback(chunk.length)
+
+    def counted_chunks() -> Iterator[Chunk]:
+        nonlocal restored_size
+        for chunk in chunks:
+            restored_size = chunk.offset + chunk.length
+            yield chunk
+
+    try:
+        run_workers(restore_chunk, counted_chunks(), concurrency)
+        if restored_size != size:
+            raise ValueError(f'the chunks of {file_path} are {restored_size} bytes, not {size} bytes')
+        os.replace(temporary_file_path, file_path)
+    except BaseException:
+        try:
+            os.remove(temporary_file_path)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,26 @@
+from typing import Optional
+
+import boto3
+from botocore.config import Config
+
+from .multipart import MAX_CONCURRENCY
+
+
+# The default size of a botocore connection pool.
+DEFAULT_MAX_POOL_CONNECTIONS: int = 10
+
+
+def create_client(jobs: int = 1, endpoint_url: Optional[str] = None):
+    """
+    Creates an S3 Client that can be shared by every concurrent transfer.
+
+    Clients are thread safe, so one client (and its connection pool) is shared rather than creating one per thread.
+    The connection pool is made large enough that concurrent transfers don't wait on each other for a connection,
+    even if every transfer is of a large file whose parts are transferred concurrently.
+
+    :param jobs: The number of concurrent transfers the client will be used for.
+    :param endpoint_url: The URL of the S3 service to use, such as a local stand-in. Defaults to AWS.
+    :return: An S3 Client.
+    """
+    max_pool_connections = max(DEFAULT_MAX_POOL_CONNECTIONS, jobs * MAX_CONCURRENCY)
+    return boto3.client('s3', endpoint_url=endpoint_url, config=Config(max_pool_connections=max_pool_connections))
@@ -0,0 +1,139 @@
+import zlib
+from typing import BinaryIO, Callable, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# The object metadata key that records which codec (if any) an object was compressed with.
+COMPRESSION_METADATA: str = 'compression'
+# The supported codecs, and their default compression levels.
+CODECS: dict[str, int] = {'gzip': 6, 'zstd': 3}
+# The size of the chunks that are read and compressed or decompressed at a time.
+CHUNK_SIZE: int = 1024 * 1024
+
+
+def check_codec(codec: str) -> None:
+    """
+    Checks that the codec is supported and available.
+
+    :param codec: The name of the codec.
+    :raises ValueError: If the codec is unsupported, or its package is not installed.
+    """
+    if codec not in CODECS:
+        raise ValueError(f'unsupported codec: {codec}')
+    if codec == 'zstd' and zstandard is None:
+        raise ValueError('zstd requires the zstandard package (pip install zstandard)')
+
+
+def get_compressor(codec: str, level: Optional[int] = None):
+    """
+    Creates a streaming compressor.
+
+    :param codec: The name of the codec.
+    :param level: The compression level. The codec's default level is used if none is specified.
+    :return: An object with compress(data) and flush() methods, each returning compressed bytes.
+    """
+    check_codec(codec)
+    if level is None:
+        level = CODECS[codec]
+    if codec == 'gzip':
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return zstandard.ZstdCompressor(level=level).compressobj()
+
+
+def get_decompressor(codec: str):
+    """
+    Creates a streaming decompressor.
+
+    :param codec: The name of the codec.
+    :return: An object with a decompress(data) method, returning decompressed bytes.
+    """
+    check_codec(codec)
+    if codec == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+class CompressingReader:
+    """
+    A readable, non-seekable stream of the compressed contents of another stream.
+    Compresses as it is read, so the compressed contents are never written to disk or held in memory all at once.
+    """
+
+    codec: str
+    _source: BinaryIO
+    _buffer: bytearray
+    _finished: bool
+    _callback: Optional[Callable[[int], None]]
+
+    def __init__(self, source: BinaryIO, codec: str, level: Optional[int] = None,
+                 callback: Optional[Callable[[int], None]] = None) -> None:
+        """
+        Initializes the CompressingReader.
+
+        :param source: The stream to compress, such as a file opened in binary mode.
+        :param codec: The name of the codec.
+        :param level: The compression level. The codec's default level is used if none is specified.
+        :param callback: An optional callback function that will be called after each chunk of the source is read.
+                         The parameter is the number of uncompressed bytes read.
+        """
+        self.codec = codec
+        self._source = source
+        self._callback = callback
+        self._compressor = get_compressor(codec, level)
+        self._buffer = bytearray()
+        self._finished = False
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        Reads compressed bytes.
+
+        :param size: The maximum number of bytes to read, or -1 to read until the end of the stream.
+        :return: The compressed bytes, which are empty once the end of the stream is reached.
+        """
+        while not self._finished and (size < 0 or len(self._buffer) < size):
+            data = self._source.read(CHUNK_SIZE)
+            if data:
+                self._buffer += self._compressor.compress(data)
+                if self._callback is not None:
+                    self._callback(len(data))
+            else:
+                self._buffer += self._compressor.flush()
+                self._finished = True
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+def decompress_stream(source, destination: BinaryIO, codec: str,
+                      callback: Optional[Callable[[int], None]] = None) -> None:
+    """
+    Decompresses a stream into another stream, one chunk at a time.
+
+    :param source: The compressed stream, such as the body of a get_object() response.
+    :param destination: The stream to write the decompressed contents to, such as a file opened in binary mode.
+    :param codec: The name of the codec the source was compressed with.
+    :param callback: An optional callback function that will be called after each chunk is decompressed.
+                     The parameter is the number of compressed bytes read.
+    :raises ValueError: If the codec is unavailable, or the source is not valid compressed data.
+    """
+    decompressor = get_decompressor(codec)
+    errors = (zlib.error,) if zstandard is None else (zlib.error, zstandard.ZstdError)
+    while True:
+        data = source.read(CHUNK_SIZE)
+        if not data:
+            break
+        try:
+            destination.write(decompressor.decompress(data))
+        except errors as e:
+            raise ValueError(f'invalid {codec} data') from e
+        if callback is not None:
+            callback(len(data))
@@ -0,0 +1,226 @@
+import random
+import time
+from contextlib import contextmanager
+from threading import Condition
+from typing import Callable, Iterator, Optional, TypeVar
+
+from botocore.exceptions import ClientError
+
+
+T = TypeVar('T')
+
+# The error codes S3 (and S3 compatible services) respond with when requests are being made too quickly.
+THROTTLING_ERROR_CODES: frozenset[str] = frozenset({
+    'SlowDown', 'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottled',
+    'RequestLimitExceeded', 'TooManyRequests', 'TooManyRequestsException', 'ServiceUnavailable', '503', '429',
+})
+# The HTTP status codes of responses to requests that are being made too quickly.
+THROTTLING_STATUS_CODES: frozenset[int] = frozenset({429, 503})
+# The number of times a throttled transfer is retried before it fails.
+MAX_THROTTLED_RETRIES: int = 8
+# The delay before the first retry of a throttled transfer, in seconds. Each retry waits up to twice as long.
+BACKOFF_BASE: float = 0.5
+# The longest delay before retrying a throttled transfer, in seconds.
+BACKOFF_CAP: float = 30
+# The factor the number of transfers is multiplied by when throttled.
+THROTTLED_DECREASE: float = 0.5
+# The factor the number of transfers is multiplied by when latency rises.
+LATENCY_DECREASE: float = 0.9
+# How many times its lowest latency an operation's latency may rise to before the number of transfers decreases.
+LATENCY_TOLERANCE: float = 3
+# The weight of each request's latency in an operation's smoothed latency.
+LATENCY_SMOOTHING: float = 0.1
+# The factor an operation's lowest latency rises by with each request, in case it was lower than normal.
+LATENCY_DRIFT: float = 1.01
+# The shortest time between decreases, in seconds,
+# so that the requests failing or slowing down together from one overload only decrease the number of transfers once.
+DECREASE_INTERVAL: float = 1
+
+
+def is_throttling_error(error: BaseException) -> bool:
+    """
+    Determines if an exception was caused by S3 throttling requests (e.g. a SlowDown error).
+    Exceptions raised while handling a throttling error (e.g. S3UploadFailedError) are also throttling errors.
+
+    :param error: The exception.
+    :return: True if the exception was caused by throttling, False otherwise.
+    """
+    while error is not None:
+        if isinstance(error, ClientError):
+            code = error.response.get('Error', {}).get('Code')
+            status_code = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+            return code in THROTTLING_ERROR_CODES or status_code in THROTTLING_STATUS_CODES
+        error = error.__cause__ or error.__context__
+    return False
+
+
+def backoff_delay(attempt: int) -> float:
+    """
+    Chooses how long to wait before retrying a throttled transfer,
+    with exponential backoff and full jitter, so that throttled transfers don't all retry at once.
+
+    :param attempt: The number of times the transfer has been throttled, starting at 0.
+    :return: The delay in seconds.
+    """
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+class AdaptiveConcurrency:
+    """
+    Limits the number of transfers in flight, adjusting the limit AIMD-style
+    (additive increase, multiplicative decrease) to stay near the highest throughput S3 sustains without throttling.
+
+    Each successful transfer increases the limit by about one transfer per limit's worth of transfers.
+    Throttled transfers halve the limit, and are retried with exponential backoff.
+    If the client is instrumented (see instrument()), throttled attempts of requests that botocore retries
+    also halve the limit, and requests (other than uploads) whose latency rises well above the lowest seen
+    for their operation decrease it slightly, before S3 starts throttling.
+    Safe to use from multiple threads.
+    """
+
+    min_limit: int
+    max_limit: int
+    _limit: float
+    _in_flight: int
+    _condition: Condition
+    _last_decrease: float
+    _latencies: dict[str, float]
+    _lowest_latencies: dict[str, float]
+
+    def __init__(self, max_limit: int, min_limit: int = 1, initial_limit: Optional[int] = None) -> None:
+        """
+        Initializes the AdaptiveConcurrency.
+
+        :param max_limit: The most transfers in flight at once, typically the number of worker threads.
+        :param min_limit: The fewest transfers in flight at once that the limit decreases to.
+        :param initial_limit: The limit to start at. Defaults to the maximum.
+        """
+        self.min_limit = min_limit
+        self.max_limit = max(min_limit, max_limit)
+        self._limit = self.max_limit if initial_limit is None else min(self.max_limit, max(min_limit, initial_limit))
+        self._in_flight = 0
+        self._condition = Condition()
+        self._last_decrease = 0
+        self._latencies = {}
+        self._lowest_latencies = {}
+
+    @property
+    def limit(self) -> int:
+        """The number of transfers currently allowed in flight at once."""
+        return int(self._limit)
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        """Waits until another transfer is allowed in flight, then holds its place until the transfer finishes."""
+        with self._condition:
+            while self._in_flight >= int(self._limit):
+                self._condition.wait()
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._condition.notify()
+
+    def call(self, transfer: Callable[..., T], *args, **kwargs) -> T:
+        """
+        Calls a transfer once it is allowed in flight, retrying it with backoff if it is throttled.
+        Never call this from within another transfer, as the outer one holds a place that the inner one may wait for.
+
+        :param transfer: The function that transfers something, such as upload_file().
+        :param args: The positional arguments of the function.
+        :param kwargs: The keyword arguments of the function.
+        :return: The return value of the function.
+        :raises Exception: Whatever the function raises, if it isn't throttled or it is throttled too many times.
+        """
+        attempt = 0
+        while True:
+            try:
+                with self.slot():
+                    result = transfer(*args, **kwargs)
+            except Exception as e:
+                if not is_throttling_error(e) or attempt >= MAX_THROTTLED_RETRIES:
+                    raise
+                self.throttled()
+                # Wait without holding a place, so that other transfers can use it.
+                time.sleep(backoff_delay(attempt))
+                attempt += 1
+                continue
+            self.succeeded()
+            return result
+
+    def succeeded(self) -> None:
+        """Records a successful transfer, increasing the limit."""
+        with self._condition:
+            previous_limit = int(self._limit)
+            self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            if int(self._limit) > previous_limit:
+                self._condition.notify()
+
+    def throttled(self) -> None:
+        """Records a throttled request or transfer, halving the limit."""
+        self._decrease(THROTTLED_DECREASE)
+
+    def record_latency(self, operation: str, latency: float) -> None:
+        """
+        Records the latency of a successful request, decreasing the limit slightly if latency has risen.
+
+        :param operation: The name of the S3 operation (e.g. PutObject), as latencies are only compared within one.
+        :param latency: The latency in seconds.
+        """
+        with self._condition:
+            smoothed = self._latencies.get(operation, latency)
+            smoothed += (latency - smoothed) * LATENCY_SMOOTHING
+            self._latencies[operation] = smoothed
+            # Let the lowest latency rise slowly, so that the limit recovers once S3 settles at a new normal.
+            lowest = min(self._lowest_latencies.get(operation, smoothed) * LATENCY_DRIFT, smoothed)
+            self._lowest_latencies[operation] = lowest
+            congested = smoothed > lowest * LATENCY_TOLERANCE
+        if congested:
+            self._decrease(LATENCY_DECREASE)
+
+    def instrument(self, s3_client) -> None:
+        """
+        Adjusts the limit from the requests the S3 Client makes from now on, through botocore's event hooks.
+        Covers every request made through the client, including the parts of transfers made by its transfer manager,
+        and every attempt of requests that botocore retries itself.
+
+        :param s3_client: The S3 Client to instrument.
+        """
+        events = s3_client.meta.events
+        events.register('before-call.s3', self._before_call)
+        events.register('after-call.s3', self._after_call)
+        events.register('needs-retry.s3', self._needs_retry)
+
+    def _decrease(self, factor: float) -> None:
+        """Multiplies the limit by the factor, unless it was decreased too recently."""
+        with self._condition:
+            now = time.monotonic()
+            if now - self._last_decrease < DECREASE_INTERVAL:
+                return
+            self._last_decrease = now
+            self._limit = max(self.min_limit, self._limit * factor)
+
+    def _before_call(self, context: dict, **kwargs) -> None:
+        # The context is unique to each call, so it carries the start time to the call's after-call event.
+        context['concurrency_start_time'] = time.perf_counter()
+
+    def _after_call(self, model, http_response, parsed: dict, context: dict, **kwargs) -> None:
+        # Skip requests that were retried, as their latency includes botocore's backoff,
+        # and uploads (e.g. PutObject), as their latency grows with their size and their share of the bandwidth.
+        # The latency of downloads is only until their response starts, so it reflects how busy S3 is.
+        start_time = context.get('concurrency_start_time')
+        retried = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0) > 0
+        if start_time is not None and http_response.status_code < 300 and not retried \
+                and not model.has_streaming_input:
+            self.record_latency(model.name, time.perf_counter() - start_time)
+
+    def _needs_retry(self, response=None, **kwargs) -> None:
+        # Called after each attempt of a request. Returns None, leaving the decision to retry to botocore.
+        if response is None:
+            return
+        http_response, parsed = response
+        code = parsed.get('Error', {}).get('Code')
+        if code in THROTTLING_ERROR_CODES or http_response.status_code in THROTTLING_STATUS_CODES:
+            self.throttled()
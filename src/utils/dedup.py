@@ -0,0 +1,291 @@
+import hashlib
+import mmap
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from threading import Event, Lock
+from typing import Callable, Iterable, Iterator, NamedTuple, Optional
+
+import boto3
+from boto3.exceptions import S3UploadFailedError
+from botocore.exceptions import ClientError
+
+from .listing import ObjectIndex, format_etag, list_objects
+from .manifest import get_manifest, metadata_key, put_manifest
+from .multipart import guess_part_size
+from .scanner import FileEntry
+
+
+# Files at least this large are hashed through mmap rather than read in chunks.
+MMAP_THRESHOLD: int = 1024 * 1024
+# The size of the chunks that smaller files are read in.
+HASH_CHUNK_SIZE: int = 1024 * 1024
+# The name of the dedup manifest object, inside the dedup metadata directory.
+DEDUP_MANIFEST_NAME: str = 'manifest.jsonl.gz'
+
+
+def hash_file(file_path: str) -> str:
+    """
+    Hashes the contents of the file with SHA-256.
+    Large files are mapped into memory rather than read, so they are never copied into Python.
+
+    :param file_path: The file path on this machine.
+    :return: The hex digest of the file.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+                digest.update(mapped_file)
+        else:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_etag(file_path: str, parts: int = 0, part_size: Optional[int] = None) -> str:
+    """
+    Computes the ETag that S3 would give the file if it was uploaded unchanged, without compression.
+    A single part upload's ETag is the MD5 digest of the file,
+    and a multipart upload's ETag is the MD5 digest of the concatenated MD5 digests of its parts.
+
+    :param file_path: The file path on this machine.
+    :param parts: The number of parts the file was uploaded in, or 0 if it wasn't uploaded in multiple parts.
+    :param part_size: The size of each part. Guessed from the size of the file and the number of parts
+                      if none is specified (see guess_part_size()).
+    :return: The ETag, including the surrounding quotes.
+    """
+    with open(file_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file, \
+                    memoryview(mapped_file) as data:
+                return _etag(data, parts, part_size)
+        return _etag(memoryview(f.read()), parts, part_size)
+
+
+def _etag(data: memoryview, parts: int, part_size: Optional[int]) -> str:
+    """Computes the ETag of the data. See file_etag()."""
+    if parts == 0:
+        return format_etag(hashlib.md5(data).digest())
+    if part_size is None:
+        part_size = guess_part_size(len(data), parts)
+    digests = b''.join(hashlib.md5(data[i:i + part_size]).digest() for i in range(0, len(data), part_size))
+    return format_etag(hashlib.md5(digests).digest(), parts)
+
+
+def hash_files(files: Iterable[FileEntry], processes: Optional[int] = None,
+               known_digest: Optional[Callable[[FileEntry], Optional[str]]] = None
+               ) -> Iterator[tuple[FileEntry, Optional[str]]]:
+    """
+    Hashes the files in a pool of processes, so that hashing uses every core.
+
+    Only a bounded number of files are queued for hashing at a time, so files can be an unbounded stream.
+    Files are yielded in the order they were given, except files with a known digest, which are yielded immediately.
+
+    :param files: The files to hash.
+    :param processes: The number of processes. Defaults to the number of CPUs.
+    :param known_digest: An optional function that returns a file's digest if it is already known (e.g. unchanged),
+                         or None if the file needs to be hashed.
+    :return: Each file and its hex digest, or None if the file could not be read.
+    """
+    if processes is None:
+        processes = os.cpu_count() or 1
+    backlog = processes * 4
+    with ProcessPoolExecutor(processes) as executor:
+        pending = deque()
+        for file in files:
+            digest = None if known_digest is None else known_digest(file)
+            if digest is not None:
+                yield file, digest
+                continue
+            pending.append((file, executor.submit(hash_file, file.path)))
+            if len(pending) >= backlog:
+                yield _hash_result(*pending.popleft())
+        while pending:
+            yield _hash_result(*pending.popleft())
+
+
+def _hash_result(file: FileEntry, future) -> tuple[FileEntry, Optional[str]]:
+    """Waits for the hash of the file, returning None as its digest if the file could not be read."""
+    try:
+        return file, future.result()
+    except OSError:
+        return file, None
+
+
+def blob_key(digest: str, kind: str = 'blobs') -> str:
+    """
+    Gets the key of the blob with the given digest.
+    Blobs are kept at the root of the bucket, so that they are shared by every backed up directory in it.
+
+    :param digest: The hex digest of the blob.
+    :param kind: The kind of blob, which is the metadata directory it is kept in (e.g. 'blobs' or 'chunks').
+    :return: The key of the blob.
+    """
+    return metadata_key('', kind, digest[:2], digest)
+
+
+def blob_prefix(kind: str = 'blobs') -> str:
+    """Gets the prefix of the key of every blob of the given kind."""
+    return metadata_key('', kind, '')
+
+
+# The content of a deduplicated file.
+# A NamedTuple rather than a dataclass, as a dedup manifest may hold millions of them.
+class DedupEntry(NamedTuple):
+    digest: str
+    size: int
+    mtime_ns: int
+
+
+class DedupManifest:
+    """Maps the relative path of each deduplicated file to the digest of its contents."""
+
+    entries: dict[str, DedupEntry]
+    last_modified: Optional[datetime]
+
+    def __init__(self, entries: Optional[dict[str, DedupEntry]] = None,
+                 last_modified: Optional[datetime] = None) -> None:
+        """
+        Initializes the DedupManifest.
+
+        :param entries: The content of each deduplicated file, by relative path.
+        :param last_modified: When the manifest was uploaded, or None if it hasn't been.
+        """
+        self.entries = {} if entries is None else entries
+        self.last_modified = last_modified
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, relative_path: str) -> bool:
+        return relative_path in self.entries
+
+    def get(self, relative_path: str) -> Optional[DedupEntry]:
+        return self.entries.get(relative_path)
+
+    @property
+    def total_size(self) -> int:
+        """The total size of every deduplicated file in bytes."""
+        return sum(entry.size for entry in self.entries.values())
+
+    def blobs(self, exclude: Iterable[str] = ()) -> dict[str, list[tuple[str, DedupEntry]]]:
+        """
+        Groups the deduplicated files by the digest of their contents.
+
+        :param exclude: The relative paths of deduplicated files to leave out.
+        :return: The relative path and entry of each deduplicated file, by digest.
+        """
+        exclude = set(exclude)
+        blobs = {}
+        for relative_path, entry in self.entries.items():
+            if relative_path not in exclude:
+                blobs.setdefault(entry.digest, []).append((relative_path, entry))
+        return blobs
+
+
+def get_dedup_manifest(bucket_name: str, bucket_directory: str, s3_client=None) -> DedupManifest:
+    """
+    Downloads the dedup manifest of the backed up directory.
+
+    :param bucket_name: The name of the bucket.
+    :param bucket_directory: The name of the backed up directory in the bucket.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :return: The dedup manifest, which is empty if the directory was never backed up with deduplication.
+    """
+    manifest = get_manifest(bucket_name, metadata_key(bucket_directory, 'dedup', DEDUP_MANIFEST_NAME), s3_client)
+    if manifest is None:
+        return DedupManifest()
+    entries, response = manifest
+    dedup_manifest = DedupManifest(last_modified=response['LastModified'])
+    for entry in entries:
+        dedup_manifest.entries[entry['path']] = DedupEntry(entry['digest'], entry['size'], entry['mtime_ns'])
+    return dedup_manifest
+
+
+def put_dedup_manifest(bucket_name: str, bucket_directory: str, dedup_manifest: DedupManifest,
+                       s3_client=None) -> None:
+    """
+    Uploads the dedup manifest of the backed up directory, replacing the previous one.
+
+    :param bucket_name: The name of the bucket.
+    :param bucket_directory: The name of the backed up directory in the bucket.
+    :param dedup_manifest: The dedup manifest.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    """
+    entries = ({'path': relative_path, **entry._asdict()}
+               for relative_path, entry in dedup_manifest.entries.items())
+    put_manifest(bucket_name, metadata_key(bucket_directory, 'dedup', DEDUP_MANIFEST_NAME), entries, s3_client)
+
+
+class BlobStore:
+    """
+    Stores contents (such as whole files, or chunks of files) under the digest of the contents,
+    uploading each distinct content only once.
+    Safe to use from multiple threads.
+    """
+
+    bucket_name: str
+    kind: str
+    _blob_index: Optional[ObjectIndex]
+    _lock: Lock
+    _uploads: dict[str, tuple[Event, list[bool]]]
+
+    def __init__(self, bucket_name: str, s3_client=None, blob_index: Optional[ObjectIndex] = None,
+                 kind: str = 'blobs') -> None:
+        """
+        Initializes the BlobStore.
+
+        :param bucket_name: The name of the bucket.
+        :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+        :param blob_index: The blobs already in the bucket.
+                           The blobs will be listed (once, when first needed) if none is specified.
+        :param kind: The kind of blobs to store (see blob_key()).
+        """
+        # Create a simple S3 Client if none was specified.
+        if s3_client is None:
+            s3_client = boto3.client('s3')
+        self.bucket_name = bucket_name
+        self.kind = kind
+        self._s3_client = s3_client
+        self._blob_index = blob_index
+        self._lock = Lock()
+        self._uploads = {}
+
+    def store(self, digest: str, upload: Callable[[str], None]) -> tuple[bool, bool]:
+        """
+        Stores contents under their digest, unless a blob with that digest is already stored.
+        If another thread is already storing the same digest, waits for it instead.
+
+        :param digest: The hex digest of the contents.
+        :param upload: The function that uploads the contents, if they need to be.
+                       The parameter is the key of the blob.
+        :return: Whether the blob is stored, and whether this call uploaded it.
+        """
+        object_key = blob_key(digest, self.kind)
+        with self._lock:
+            if self._blob_index is None:
+                self._blob_index = list_objects(self.bucket_name, blob_prefix(self.kind), self._s3_client)
+            if object_key in self._blob_index:
+                return True, False
+            pending_upload = self._uploads.get(digest)
+            uploader = pending_upload is None
+            if uploader:
+                pending_upload = self._uploads[digest] = (Event(), [False])
+        finished, result = pending_upload
+        if not uploader:
+            finished.wait()
+            return result[0], False
+        try:
+            upload(object_key)
+            result[0] = True
+        except (ClientError, S3UploadFailedError, OSError):
+            # Let a later file with the same contents try again.
+            with self._lock:
+                del self._uploads[digest]
+        finally:
+            finished.set()
+        return result[0], result[0]
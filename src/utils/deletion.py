@@ -0,0 +1,57 @@
+from typing import Callable, Iterable, Iterator, Optional
+
+import boto3
+
+from .workers import run_workers
+
+
+# The most keys delete_objects() accepts in a single request.
+MAX_DELETE_BATCH: int = 1000
+
+
+def batch_keys(object_keys: Iterable[str], batch_size: int = MAX_DELETE_BATCH) -> Iterator[list[str]]:
+    """
+    Groups keys into batches, without ever holding more than one batch in memory.
+
+    :param object_keys: The keys to group.
+    :param batch_size: The most keys in each batch.
+    :return: Each batch of keys, in order.
+    """
+    batch = []
+    for object_key in object_keys:
+        batch.append(object_key)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def delete_objects(bucket_name: str, object_keys: Iterable[str], s3_client=None, jobs: int = 1,
+                   callback: Optional[Callable[[list[str], list[str]], None]] = None) -> None:
+    """
+    Deletes objects with batched delete_objects() requests of up to MAX_DELETE_BATCH keys each,
+    several requests at a time.
+
+    :param bucket_name: The name of the bucket.
+    :param object_keys: The keys of the objects to delete. May be an unbounded stream.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :param jobs: The number of requests to make concurrently.
+    :param callback: An optional callback function that will be called after each batch is deleted.
+                     The parameters are the keys that were deleted, and the keys that could not be deleted.
+    :raises ClientError: If a request fails, once every other batch has been deleted.
+    """
+    # Create a simple S3 Client if none was specified.
+    if s3_client is None:
+        s3_client = boto3.client('s3')
+
+    def delete_batch(batch: list[str]) -> None:
+        # Quiet mode only reports the keys that could not be deleted.
+        response = s3_client.delete_objects(Bucket=bucket_name, Delete={
+            'Objects': [{'Key': object_key} for object_key in batch], 'Quiet': True})
+        failed_keys = [error['Key'] for error in response.get('Errors', [])]
+        if callback is not None:
+            failed = set(failed_keys)
+            callback([object_key for object_key in batch if object_key not in failed], failed_keys)
+
+    run_workers(delete_batch, batch_keys(object_keys), jobs)
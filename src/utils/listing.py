@@ -0,0 +1,370 @@
+import os
+from array import array
+from bisect import bisect_left
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from queue import Queue
+from threading import Lock, Thread
+from typing import Callable, Iterable, Iterator, Optional
+
+import boto3
+
+from .manifest import metadata_key
+
+
+# The delimiter between the levels of a key, which list_objects() discovers shards of a listing with.
+DELIMITER: str = '/'
+# How many levels below the prefix list_objects() discovers shards at, when listing in parallel.
+SHARD_DEPTH: int = 2
+
+
+# The return type for ObjectIndex.get().
+@dataclass
+class ObjectInfo:
+    key: str
+    size: int
+    last_modified: datetime
+    etag: str
+
+
+class ObjectIndex:
+    """
+    A compact, in-memory index of the objects under a prefix in a bucket.
+
+    Keys are stored relative to the prefix in a sorted list, and the rest of the metadata is packed
+    into arrays rather than kept as one dictionary per object,
+    so that an index of millions of objects fits in a reasonable amount of memory.
+    Objects must not be added while the index is read, but it may be read from multiple threads at once.
+    """
+
+    prefix: str
+    _keys: list[str]
+    _sizes: array
+    _last_modified: array
+    _etag_digests: bytearray
+    _etag_parts: array
+    _irregular_etags: dict[int, str]
+    _sorted: bool
+    _sort_lock: Lock
+
+    def __init__(self, prefix: str = '') -> None:
+        """
+        Initializes an empty ObjectIndex.
+
+        :param prefix: The prefix that every key in the index starts with.
+        """
+        self.prefix = prefix
+        self._keys = []
+        self._sizes = array('q')
+        self._last_modified = array('d')
+        self._etag_digests = bytearray()
+        self._etag_parts = array('H')
+        self._irregular_etags = {}
+        self._sorted = True
+        # Held while sorting, so that threads reading the index never see it partly sorted.
+        self._sort_lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, object_key: str) -> bool:
+        return self._find(object_key) is not None
+
+    def __iter__(self) -> Iterator[ObjectInfo]:
+        self._ensure_sorted()
+        for i in range(len(self._keys)):
+            yield self._info(i)
+
+    def sizes(self) -> Iterator[tuple[str, int]]:
+        """
+        Iterates over the key (relative to the prefix) and size of every object,
+        without unpacking the rest of their metadata, in no particular order.
+        """
+        return zip(self._keys, self._sizes)
+
+    def add(self, object_key: str, size: int, last_modified: datetime, etag: str) -> None:
+        """
+        Adds an object to the index.
+
+        :param object_key: The key of the object. Must start with the prefix of the index.
+        :param size: The size of the object in bytes.
+        :param last_modified: The last modified date of the object.
+        :param etag: The ETag of the object.
+        """
+        relative_key = object_key[len(self.prefix):]
+        if self._keys and relative_key < self._keys[-1]:
+            self._sorted = False
+        index = len(self._keys)
+        self._keys.append(relative_key)
+        self._sizes.append(size)
+        self._last_modified.append(last_modified.timestamp())
+        # Pack regular ETags (an MD5 digest, with a part count for multipart uploads) into 16 bytes.
+        digest, parts = parse_etag(etag)
+        if digest is None:
+            digest = bytes(16)
+            self._irregular_etags[index] = etag
+        self._etag_digests += digest
+        self._etag_parts.append(parts)
+
+    def add_object(self, bucket_object: dict) -> None:
+        """
+        Adds an object to the index.
+
+        :param bucket_object: An element of the 'Contents' of a list_objects_v2() response.
+        """
+        self.add(bucket_object['Key'], bucket_object['Size'], bucket_object['LastModified'], bucket_object['ETag'])
+
+    def get(self, object_key: str) -> Optional[ObjectInfo]:
+        """
+        Gets information about an object in the index.
+
+        :param object_key: The key of the object.
+        :return: Information about the object, or None if the object is not in the index.
+        """
+        index = self._find(object_key)
+        if index is None:
+            return None
+        return self._info(index)
+
+    def _find(self, object_key: str) -> Optional[int]:
+        """Gets the position of the object_key in the index, or None if it is not in the index."""
+        if not object_key.startswith(self.prefix):
+            return None
+        self._ensure_sorted()
+        relative_key = object_key[len(self.prefix):]
+        index = bisect_left(self._keys, relative_key)
+        if index < len(self._keys) and self._keys[index] == relative_key:
+            return index
+        return None
+
+    def _info(self, index: int) -> ObjectInfo:
+        """Unpacks the object at the position in the index."""
+        etag = self._irregular_etags.get(index)
+        if etag is None:
+            digest = self._etag_digests[index * 16:(index + 1) * 16]
+            etag = format_etag(bytes(digest), self._etag_parts[index])
+        return ObjectInfo(self.prefix + self._keys[index],
+                          self._sizes[index],
+                          datetime.fromtimestamp(self._last_modified[index], timezone.utc),
+                          etag)
+
+    def _ensure_sorted(self) -> None:
+        """
+        Sorts the index by key, if objects were not added in order.
+        Safe to call from multiple threads: only one sorts, and the others wait until it's done.
+        """
+        if self._sorted:
+            return
+        with self._sort_lock:
+            if self._sorted:
+                return
+            order = sorted(range(len(self._keys)), key=self._keys.__getitem__)
+            self._keys = [self._keys[i] for i in order]
+            self._sizes = array('q', (self._sizes[i] for i in order))
+            self._last_modified = array('d', (self._last_modified[i] for i in order))
+            self._etag_parts = array('H', (self._etag_parts[i] for i in order))
+            digests = bytearray()
+            for i in order:
+                digests += self._etag_digests[i * 16:(i + 1) * 16]
+            self._etag_digests = digests
+            new_positions = {old: new for new, old in enumerate(order) if old in self._irregular_etags}
+            self._irregular_etags = {new_positions[old]: etag for old, etag in self._irregular_etags.items()}
+            # Only mark the index sorted once every array is, as readers that see it sorted don't take the lock.
+            self._sorted = True
+
+
+def list_objects(bucket_name: str, prefix: str, s3_client=None, jobs: int = 1,
+                 exclude_prefixes: Iterable[str] = ()) -> ObjectIndex:
+    """
+    Lists every object under the prefix in the bucket into an ObjectIndex.
+
+    If more than one job is specified, the listing is split into shards that are listed in parallel.
+    The prefix is listed with a delimiter to discover its sub-prefixes (e.g. subdirectories),
+    and so on down to SHARD_DEPTH levels below the prefix, and then each of those is listed in full.
+    Each shard is listed as soon as it is discovered, so discovering and listing overlap.
+
+    :param bucket_name: The name of the bucket.
+    :param prefix: The prefix to list the objects of.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :param jobs: The number of list requests to make concurrently.
+    :param exclude_prefixes: Prefixes of keys to leave out of the index, such as metadata directories.
+                             When listing in parallel, the keys under them aren't even listed,
+                             if they are discovered as shards.
+    :return: An index of every object under the prefix.
+    """
+    object_index = ObjectIndex(prefix)
+    # Only one thread at a time may add to the index.
+    lock = Lock()
+
+    def add_page(bucket_objects: list[dict]) -> None:
+        with lock:
+            for bucket_object in bucket_objects:
+                object_index.add_object(bucket_object)
+
+    _list_pages(bucket_name, prefix, add_page, s3_client, jobs, exclude_prefixes)
+    # Shards are added in the order they finish, so sort the index now, rather than when it's first read.
+    object_index._ensure_sorted()
+    return object_index
+
+
+def iter_objects(bucket_name: str, prefix: str, s3_client=None, jobs: int = 1,
+                 exclude_prefixes: Iterable[str] = ()) -> Iterator[ObjectInfo]:
+    """
+    Lists every object under the prefix in the bucket like list_objects(), but yields each page of objects
+    as soon as it's listed, instead of collecting them into an index,
+    so that working on the objects overlaps with listing the rest of them.
+    The listing runs in the background, at most a few pages ahead of the objects that have been yielded.
+
+    :param bucket_name: The name of the bucket.
+    :param prefix: The prefix to list the objects of.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :param jobs: The number of list requests to make concurrently.
+    :param exclude_prefixes: Prefixes of keys to leave out, such as metadata directories (see list_objects()).
+    :return: Every object under the prefix, in no particular order if more than one job is specified.
+    """
+    # Pages are handed over through a bounded queue, with None once the listing is done.
+    queue = Queue(maxsize=jobs * 2)
+    errors = []
+
+    def list_pages() -> None:
+        try:
+            _list_pages(bucket_name, prefix, queue.put, s3_client, jobs, exclude_prefixes)
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            queue.put(None)
+
+    Thread(target=list_pages, daemon=True).start()
+    while True:
+        bucket_objects = queue.get()
+        if bucket_objects is None:
+            break
+        for bucket_object in bucket_objects:
+            yield ObjectInfo(bucket_object['Key'], bucket_object['Size'], bucket_object['LastModified'],
+                             bucket_object['ETag'])
+    if errors:
+        raise errors[0]
+
+
+def _list_pages(bucket_name: str, prefix: str, add_page: Callable[[list[dict]], None], s3_client=None,
+                jobs: int = 1, exclude_prefixes: Iterable[str] = ()) -> None:
+    """
+    Lists every object under the prefix in the bucket, a page at a time, in parallel shards if more than one job
+    is specified (see list_objects()).
+
+    :param bucket_name: The name of the bucket.
+    :param prefix: The prefix to list the objects of.
+    :param add_page: Called with the objects of each page (elements of its 'Contents'), leaving out excluded keys.
+                     Calls may be made concurrently from multiple threads, in the order the pages are listed.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :param jobs: The number of list requests to make concurrently.
+    :param exclude_prefixes: Prefixes of keys to leave out, such as metadata directories.
+    """
+    # Create a simple S3 Client if none was specified.
+    if s3_client is None:
+        s3_client = boto3.client('s3')
+    exclude_prefixes = tuple(exclude_prefixes)
+    paginator = s3_client.get_paginator('list_objects_v2')
+
+    def list_page(page: dict) -> None:
+        add_page([bucket_object for bucket_object in page.get('Contents', [])
+                  if not bucket_object['Key'].startswith(exclude_prefixes)])
+
+    if jobs <= 1:
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+            list_page(page)
+        return
+
+    def list_shard(shard_prefix: str, depth: int) -> list[tuple[str, int]]:
+        # List the whole shard once it is deep enough.
+        if depth >= SHARD_DEPTH:
+            for page in paginator.paginate(Bucket=bucket_name, Prefix=shard_prefix):
+                list_page(page)
+            return []
+        # Otherwise, only list the objects directly in the shard, and return its sub-prefixes as new shards.
+        shards = []
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=shard_prefix, Delimiter=DELIMITER):
+            list_page(page)
+            for common_prefix in page.get('CommonPrefixes', []):
+                if not common_prefix['Prefix'].startswith(exclude_prefixes):
+                    shards.append((common_prefix['Prefix'], depth + 1))
+        return shards
+
+    with ThreadPoolExecutor(jobs) as executor:
+        pending = {executor.submit(list_shard, prefix, 0)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for shard in future.result():
+                    pending.add(executor.submit(list_shard, *shard))
+
+
+def list_bucket_directory(bucket_name: str, bucket_directory: str, s3_client=None, jobs: int = 1) -> ObjectIndex:
+    """
+    Lists the objects of the files backed up to the bucket directory into an ObjectIndex, leaving out metadata.
+
+    The bucket directory is listed with a separator after it,
+    so that other bucket directories that start with the same name aren't included.
+
+    :param bucket_name: The name of the bucket.
+    :param bucket_directory: The name of the backed up directory in the bucket.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :param jobs: The number of list requests to make concurrently (see list_objects()).
+    :return: An index of the object of every file in the bucket directory.
+    """
+    return list_objects(bucket_name, os.path.join(bucket_directory, ''), s3_client, jobs,
+                        exclude_prefixes=[metadata_key(bucket_directory, '')])
+
+
+def iter_bucket_directory(bucket_name: str, bucket_directory: str, s3_client=None,
+                          jobs: int = 1) -> Iterator[ObjectInfo]:
+    """
+    Lists the objects of the files backed up to the bucket directory like list_bucket_directory(),
+    but yields them as they are listed (see iter_objects()).
+
+    :param bucket_name: The name of the bucket.
+    :param bucket_directory: The name of the backed up directory in the bucket.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :param jobs: The number of list requests to make concurrently (see list_objects()).
+    :return: The object of every file in the bucket directory.
+    """
+    return iter_objects(bucket_name, os.path.join(bucket_directory, ''), s3_client, jobs,
+                        exclude_prefixes=[metadata_key(bucket_directory, '')])
+
+
+def parse_etag(etag: str) -> tuple[Optional[bytes], int]:
+    """
+    Parses an ETag into its MD5 digest and its number of parts.
+
+    Examples::
+
+        parse_etag('"9e107d9d372bb6826bd81d3542a419d6"')   == (b'\\x9e\\x10...', 0)
+        parse_etag('"9e107d9d372bb6826bd81d3542a419d6-3"') == (b'\\x9e\\x10...', 3)
+
+    :param etag: The ETag, with or without the surrounding quotes.
+    :return: The digest (or None if the ETag is not an MD5 digest) and the number of parts
+             (0 if the object was not uploaded in multiple parts).
+    """
+    hex_digest, _, parts = etag.strip('"').partition('-')
+    try:
+        digest = bytes.fromhex(hex_digest)
+        parts = int(parts) if parts else 0
+    except ValueError:
+        return None, 0
+    if len(digest) != 16 or parts > 0xFFFF:
+        return None, 0
+    return digest, parts
+
+
+def format_etag(digest: bytes, parts: int = 0) -> str:
+    """
+    Formats an MD5 digest and number of parts as an ETag. The inverse of parse_etag().
+
+    :param digest: The MD5 digest.
+    :param parts: The number of parts, or 0 if the object was not uploaded in multiple parts.
+    :return: The ETag, including the surrounding quotes.
+    """
+    if parts:
+        return f'"{digest.hex()}-{parts}"'
+    return f'"{digest.hex()}"'
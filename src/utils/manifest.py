@@ -0,0 +1,101 @@
+import gzip
+import io
+import json
+import os
+from typing import Iterable, Iterator, Optional
+
+import boto3
+from botocore.exceptions import ClientError
+
+
+# The directory, inside each backed up directory in the bucket, that holds metadata objects rather than files.
+METADATA_DIRECTORY: str = '.aws-backup'
+
+
+def metadata_key(bucket_directory: str, *names: str) -> str:
+    """
+    Gets the key of a metadata object of the backed up directory.
+    Keys are joined the same way backup_directory() joins the keys of files.
+
+    :param bucket_directory: The name of the backed up directory in the bucket.
+    :param names: The path to the metadata object, inside the metadata directory.
+    :return: The key of the metadata object.
+    """
+    return os.path.join(bucket_directory, METADATA_DIRECTORY, *names)
+
+
+def is_metadata_path(relative_path: str) -> bool:
+    """
+    Determines if the path (relative to the backed up directory) is a metadata object rather than a file.
+
+    :param relative_path: The path of the object, relative to the backed up directory.
+    :return: True if the object is a metadata object, False otherwise.
+    """
+    first_name = relative_path.replace(os.sep, '/').split('/', 1)[0]
+    return first_name == METADATA_DIRECTORY
+
+
+def dump_manifest(entries: Iterable[dict]) -> bytes:
+    """
+    Serializes manifest entries as gzipped JSON lines, one entry per line.
+
+    :param entries: The entries of the manifest.
+    :return: The serialized manifest.
+    """
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb') as gzip_file:
+        for entry in entries:
+            gzip_file.write(json.dumps(entry, separators=(',', ':')).encode())
+            gzip_file.write(b'\n')
+    return buffer.getvalue()
+
+
+def load_manifest(stream) -> Iterator[dict]:
+    """
+    Deserializes manifest entries from a stream of gzipped JSON lines, one entry at a time.
+    The inverse of dump_manifest().
+
+    :param stream: A readable binary stream, such as the body of a get_object() response.
+    :return: The entries of the manifest.
+    """
+    with gzip.GzipFile(fileobj=stream, mode='rb') as gzip_file:
+        for line in gzip_file:
+            yield json.loads(line)
+
+
+def put_manifest(bucket_name: str, object_key: str, entries: Iterable[dict], s3_client=None) -> None:
+    """
+    Uploads a manifest to the bucket.
+
+    :param bucket_name: The name of the bucket.
+    :param object_key: The key of the manifest object.
+    :param entries: The entries of the manifest.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    """
+    # Create a simple S3 Client if none was specified.
+    if s3_client is None:
+        s3_client = boto3.client('s3')
+    s3_client.put_object(Bucket=bucket_name, Key=object_key, Body=dump_manifest(entries),
+                         ContentType='application/gzip')
+
+
+def get_manifest(bucket_name: str, object_key: str, s3_client=None) -> Optional[tuple[Iterator[dict], dict]]:
+    """
+    Downloads a manifest from the bucket, streaming its entries.
+
+    :param bucket_name: The name of the bucket.
+    :param object_key: The key of the manifest object.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :return: The entries of the manifest and the get_object() response,
+             or None if there is no such manifest.
+    """
+    # Create a simple S3 Client if none was specified.
+    if s3_client is None:
+        s3_client = boto3.client('s3')
+    try:
+        response = s3_client.get_object(Bucket=bucket_name, Key=object_key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
+    return load_manifest(response['Body']), response
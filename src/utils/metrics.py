@@ -0,0 +1,251 @@
+import cProfile
+import json
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from threading import Lock
+from typing import Callable, Iterator, Optional
+
+
+# The upper bounds of the latency histogram's buckets, in milliseconds. Slower requests go in a final bucket.
+LATENCY_BUCKETS: tuple[int, ...] = tuple(2 ** i for i in range(17))
+
+
+class OperationMetrics:
+    """The metrics of one type of S3 operation (e.g. PutObject). Must only be updated while holding a lock."""
+
+    requests: int
+    errors: dict[str, int]
+    retries: int
+    bytes_sent: int
+    bytes_received: int
+    total_latency: float
+    min_latency: Optional[float]
+    max_latency: Optional[float]
+    histogram: list[int]
+
+    def __init__(self) -> None:
+        """Initializes the OperationMetrics, with nothing recorded."""
+        self.requests = 0
+        self.errors = {}
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.total_latency = 0
+        self.min_latency = None
+        self.max_latency = None
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def record_latency(self, latency: float) -> None:
+        """
+        Records the latency of a request.
+
+        :param latency: The latency in seconds.
+        """
+        self.total_latency += latency
+        self.min_latency = latency if self.min_latency is None else min(self.min_latency, latency)
+        self.max_latency = latency if self.max_latency is None else max(self.max_latency, latency)
+        milliseconds = latency * 1000
+        bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS) if milliseconds <= bound), len(LATENCY_BUCKETS))
+        self.histogram[bucket] += 1
+
+    def to_dict(self) -> dict:
+        """Converts the metrics to a dictionary that can be serialized as JSON. Latencies are in seconds."""
+        labels = [f'<={bound}ms' for bound in LATENCY_BUCKETS] + [f'>{LATENCY_BUCKETS[-1]}ms']
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'retries': self.retries,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'latency': {
+                'total': self.total_latency,
+                'mean': self.total_latency / self.requests if self.requests else None,
+                'min': self.min_latency,
+                'max': self.max_latency,
+                'histogram': {label: count for label, count in zip(labels, self.histogram) if count},
+            },
+        }
+
+
+class Metrics:
+    """
+    Records metrics of a run of a program: the requests made by S3 Clients, by operation,
+    and the time spent in each phase of the program.
+    Safe to use from multiple threads.
+    """
+
+    started_at: datetime
+    operations: dict[str, OperationMetrics]
+    phases: dict[str, float]
+    _lock: Lock
+
+    def __init__(self) -> None:
+        """Initializes the Metrics, with nothing recorded."""
+        self.started_at = datetime.now(timezone.utc)
+        self.operations = {}
+        self.phases = {}
+        self._lock = Lock()
+        self._start_time = time.perf_counter()
+
+    def instrument(self, s3_client) -> None:
+        """
+        Records the requests the S3 Client makes from now on, through botocore's event hooks.
+        Covers every request made through the client, including the parts of transfers made by its transfer manager.
+
+        :param s3_client: The S3 Client to instrument.
+        """
+        events = s3_client.meta.events
+        events.register('before-call.s3', self._before_call)
+        events.register('after-call.s3', self._after_call)
+        events.register('after-call-error.s3', self._after_call_error)
+        events.register('before-send.s3', self._before_send)
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """
+        Records the time spent in a phase of the program. Time spent in a phase more than once is added up.
+
+        :param name: The name of the phase.
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start_time
+            with self._lock:
+                self.phases[name] = self.phases.get(name, 0) + duration
+
+    def to_dict(self) -> dict:
+        """Converts the metrics to a dictionary that can be serialized as JSON. Times are in seconds."""
+        with self._lock:
+            return {
+                'started_at': self.started_at.isoformat(),
+                'wall_time': time.perf_counter() - self._start_time,
+                'phases': dict(self.phases),
+                'operations': {name: operation.to_dict() for name, operation in sorted(self.operations.items())},
+            }
+
+    def write_report(self, report_path: str) -> None:
+        """
+        Writes the metrics to a file as JSON.
+
+        :param report_path: The path of the file.
+        """
+        with open(report_path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+            f.write('\n')
+
+    def _operation(self, name: str) -> OperationMetrics:
+        """Gets the metrics of the operation, creating them if needed. Must hold the lock."""
+        operation = self.operations.get(name)
+        if operation is None:
+            operation = self.operations[name] = OperationMetrics()
+        return operation
+
+    def _before_call(self, model, context: dict, **kwargs) -> None:
+        # The context is unique to each call, so it carries the start time to the call's after-call event.
+        context['metrics_start_time'] = time.perf_counter()
+
+    def _after_call(self, model, http_response, parsed: dict, context: dict, **kwargs) -> None:
+        latency = time.perf_counter() - context.get('metrics_start_time', time.perf_counter())
+        with self._lock:
+            operation = self._operation(model.name)
+            operation.requests += 1
+            operation.record_latency(latency)
+            operation.retries += parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+            # The responses to HEAD requests have the length of the object, but no body.
+            if model.http.get('method') != 'HEAD':
+                operation.bytes_received += int(http_response.headers.get('content-length', 0))
+            if http_response.status_code >= 300:
+                code = parsed.get('Error', {}).get('Code', str(http_response.status_code))
+                operation.errors[code] = operation.errors.get(code, 0) + 1
+
+    def _after_call_error(self, exception: Exception, context: dict, event_name: str, **kwargs) -> None:
+        # Called when a request fails without a response, such as when the connection fails.
+        # The event name ends with the name of the operation.
+        latency = time.perf_counter() - context.get('metrics_start_time', time.perf_counter())
+        with self._lock:
+            operation = self._operation(event_name.rsplit('.', 1)[-1])
+            operation.requests += 1
+            operation.record_latency(latency)
+            code = type(exception).__name__
+            operation.errors[code] = operation.errors.get(code, 0) + 1
+
+    def _before_send(self, request, event_name: str, **kwargs) -> None:
+        # Called before each attempt of a request is sent, so retried bytes are counted again.
+        content_length = request.headers.get('Content-Length')
+        if content_length is not None:
+            with self._lock:
+                self._operation(event_name.rsplit('.', 1)[-1]).bytes_sent += int(content_length)
+
+
+class Profiler:
+    """
+    Profiles the calling thread with cProfile, and every thread started while profiling,
+    such as worker threads, merging them into a single profile.
+    """
+
+    _profiles: list[cProfile.Profile]
+    _lock: Lock
+
+    def __init__(self) -> None:
+        """Initializes the Profiler."""
+        self._profiles = []
+        self._lock = Lock()
+
+    def start(self) -> None:
+        """Starts profiling."""
+        threading.setprofile(self._profile_thread)
+        self._new_profile().enable()
+
+    def stop(self, profile_path: str) -> None:
+        """
+        Stops profiling, and writes the profile to a file that can be read with pstats.
+
+        :param profile_path: The path of the file.
+        """
+        threading.setprofile(None)
+        self._profiles[0].disable()
+        with self._lock:
+            stats = pstats.Stats(*self._profiles)
+        stats.dump_stats(profile_path)
+
+    def _new_profile(self) -> cProfile.Profile:
+        """Creates a profile for the current thread."""
+        profile = cProfile.Profile()
+        with self._lock:
+            self._profiles.append(profile)
+        return profile
+
+    def _profile_thread(self, frame, event: str, arg) -> None:
+        # Called once at the start of each new thread, which replaces this hook with a profiler of its own.
+        sys.setprofile(None)
+        self._new_profile().enable()
+
+
+def run_with_metrics(run: Callable[[Metrics], None], report_path: Optional[str] = None,
+                     profile_path: Optional[str] = None) -> None:
+    """
+    Runs a program, recording its metrics.
+    The report and profile are written even if the program fails or is interrupted.
+
+    :param run: The program. The parameter is the Metrics to record its phases and instrument its S3 Clients with.
+    :param report_path: The path of the file to write the metrics to as JSON, if any.
+    :param profile_path: The path of the file to write a cProfile profile of the program to, if any.
+    """
+    metrics = Metrics()
+    profiler = None
+    if profile_path is not None:
+        profiler = Profiler()
+        profiler.start()
+    try:
+        run(metrics)
+    finally:
+        if profiler is not None:
+            profiler.stop(profile_path)
+        if report_path is not None:
+            metrics.write_report(report_path)
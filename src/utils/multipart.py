@@ -0,0 +1,338 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Callable, Optional
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from s3transfer.utils import ReadFileChunk
+
+from .compression import CHUNK_SIZE
+from .listing import format_etag
+
+
+# The number of bytes in a MiB.
+MIB: int = 1024 * 1024
+# Files at least this large are uploaded and downloaded in parts. Matches the S3 Client's default.
+MULTIPART_THRESHOLD: int = 8 * MIB
+# The smallest part size that is used. Matches the S3 Client's default.
+MIN_PART_SIZE: int = 8 * MIB
+# The largest part size S3 allows.
+MAX_PART_SIZE: int = 5 * 1024 * MIB
+# The most parts S3 allows in a multipart upload.
+MAX_PARTS: int = 10000
+# Files are split into about this many parts, once their parts would be larger than the smallest part size,
+# so that very large files are transferred with fewer, larger requests.
+TARGET_PARTS: int = 1000
+# The most parts of a single file that are transferred concurrently.
+MAX_CONCURRENCY: int = 16
+
+
+def choose_part_size(size: int) -> int:
+    """
+    Chooses the part size to transfer a file of the given size in.
+
+    Small files use the smallest part size, and larger files are split into about TARGET_PARTS parts,
+    rounded up to a whole number of MiB and kept within S3's limits.
+
+    :param size: The size of the file in bytes.
+    :return: The part size in bytes.
+    """
+    part_size = max(MIN_PART_SIZE, -(-size // TARGET_PARTS), -(-size // MAX_PARTS))
+    part_size = -(-part_size // MIB) * MIB
+    return min(part_size, MAX_PART_SIZE)
+
+
+def choose_concurrency(size: int, part_size: int) -> int:
+    """
+    Chooses how many parts of a file of the given size to transfer concurrently.
+
+    :param size: The size of the file in bytes.
+    :param part_size: The part size in bytes.
+    :return: The number of parts to transfer concurrently.
+    """
+    return max(1, min(MAX_CONCURRENCY, -(-size // part_size)))
+
+
+def transfer_config(size: int) -> TransferConfig:
+    """
+    Creates a transfer configuration for the S3 Client's upload and download methods,
+    with the part size and concurrency chosen for a file of the given size.
+
+    :param size: The size of the file in bytes.
+    :return: The transfer configuration.
+    """
+    part_size = choose_part_size(size)
+    return TransferConfig(multipart_threshold=MULTIPART_THRESHOLD, multipart_chunksize=part_size,
+                          max_concurrency=choose_concurrency(size, part_size))
+
+
+def guess_part_size(size: int, parts: int) -> int:
+    """
+    Guesses the part size a file of the given size was uploaded with, from its number of parts.
+
+    The part size choose_part_size() would choose is tried first, then the S3 Client's default part size,
+    then the smallest whole number of MiB that splits the file into that many parts.
+
+    :param size: The size of the file in bytes.
+    :param parts: The number of parts the file was uploaded in.
+    :return: The part size in bytes.
+    """
+    for part_size in (choose_part_size(size), MIN_PART_SIZE):
+        if -(-size // part_size) == parts:
+            return part_size
+    return -(-size // (parts * MIB)) * MIB
+
+
+def upload_multipart(file_path: str, bucket_name: str, object_key: str, s3_client=None,
+                     part_size: Optional[int] = None, concurrency: Optional[int] = None,
+                     upload_id: Optional[str] = None, on_create: Optional[Callable[[str], None]] = None,
+                     callback: Optional[Callable[[int], None]] = None) -> str:
+    """
+    Uploads the file in parts, several parts at a time, resuming a previous multipart upload if one is specified.
+
+    When resuming, the parts that were already uploaded are listed and only the rest are uploaded.
+    If the previous upload no longer exists (e.g. it was completed or aborted), a new upload is created.
+    If the upload fails and on_create was specified, the upload is left in place so that it can be resumed.
+    Otherwise, it is aborted so that its parts aren't left in the bucket.
+
+    :param file_path: The file path on this machine.
+    :param bucket_name: The name of the bucket.
+    :param object_key: The name/key of the object in the bucket.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :param part_size: The part size in bytes. Must match the part size of the upload being resumed, if any.
+                      Chosen from the size of the file if none is specified.
+    :param concurrency: The number of parts to upload concurrently.
+                        Chosen from the size of the file if none is specified.
+    :param upload_id: The ID of a previous multipart upload of the same file to resume, if any.
+    :param on_create: An optional callback function that will be called if a new multipart upload is created,
+                      before any parts are uploaded. The parameter is the ID of the upload.
+    :param callback: An optional callback function that will be called as the file is uploaded.
+                     The parameter is the number of bytes uploaded since the last call,
+                     including (all at once) the bytes of any parts that were already uploaded.
+    :return: The ETag of the uploaded object.
+    """
+    # Create a simple S3 Client if none was specified.
+    if s3_client is None:
+        s3_client = boto3.client('s3')
+    size = os.path.getsize(file_path)
+    if part_size is None:
+        part_size = choose_part_size(size)
+    if concurrency is None:
+        concurrency = choose_concurrency(size, part_size)
+    # Find the parts that are already uploaded, or create a new upload.
+    uploaded_parts = {}
+    if upload_id is not None:
+        uploaded_parts = list_uploaded_parts(bucket_name, object_key, upload_id, s3_client)
+        if uploaded_parts is None:
+            upload_id = None
+            uploaded_parts = {}
+    if upload_id is None:
+        upload_id = s3_client.create_multipart_upload(Bucket=bucket_name, Key=object_key)['UploadId']
+        if on_create is not None:
+            on_create(upload_id)
+    # Keep the parts that are already uploaded, as long as they are the size they should be.
+    part_count = -(-size // part_size)
+    parts = {}
+    for part_number, offset in enumerate(range(0, size, part_size), start=1):
+        part = uploaded_parts.get(part_number)
+        if part is not None and part['Size'] == min(part_size, size - offset):
+            parts[part_number] = part['ETag']
+    if parts and callback is not None:
+        callback(sum(uploaded_parts[part_number]['Size'] for part_number in parts))
+
+    def upload_part(part_number: int) -> None:
+        offset = (part_number - 1) * part_size
+        # Read the part straight from the file, rewinding the callback's progress if the request is retried.
+        callbacks = [] if callback is None else [lambda bytes_transferred: callback(bytes_transferred)]
+        with ReadFileChunk.from_filename(file_path, offset, part_size, callbacks) as body:
+            response = s3_client.upload_part(Bucket=bucket_name, Key=object_key, UploadId=upload_id,
+                                             PartNumber=part_number, Body=body)
+        parts[part_number] = response['ETag']
+
+    try:
+        remaining_parts = [part_number for part_number in range(1, part_count + 1) if part_number not in parts]
+        with ThreadPoolExecutor(concurrency) as executor:
+            # Consume the results, so that the first failed part raises its exception.
+            for _ in executor.map(upload_part, remaining_parts):
+                pass
+        response = s3_client.complete_multipart_upload(
+            Bucket=bucket_name, Key=object_key, UploadId=upload_id,
+            MultipartUpload={'Parts': [{'PartNumber': part_number, 'ETag': parts[part_number]}
+                                       for part_number in sorted(parts)]})
+    except BaseException:
+        if on_create is None:
+            abort_multipart_upload(bucket_name, object_key, upload_id, s3_client)
+        raise
+    return response['ETag']
+
+
+class EtagReader:
+    """
+    A readable, non-seekable stream of the contents of another stream,
+    which computes the ETag S3 gives them as they are read,
+    for streams that can't be read again afterwards (e.g. ones compressed as they are read).
+
+    The stream must be uploaded the way the S3 Client's upload_fileobj() uploads non-seekable streams:
+    in a single part if it is smaller than MULTIPART_THRESHOLD, otherwise in parts of the part size.
+    """
+
+    part_size: int
+    size: int
+    _source: BinaryIO
+    _part_digests: list[bytes]
+    _part_length: int
+
+    def __init__(self, source: BinaryIO, part_size: int) -> None:
+        """
+        Initializes the EtagReader.
+
+        :param source: The stream to read.
+        :param part_size: The part size the stream is uploaded in, if it is uploaded in parts.
+                          Must be at least MULTIPART_THRESHOLD, like every part size choose_part_size() chooses.
+        """
+        self.part_size = part_size
+        self.size = 0
+        self._source = source
+        self._part_digests = []
+        self._part = hashlib.md5()
+        self._part_length = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._source.read(size)
+        self.size += len(data)
+        # Hash each part separately, as a multipart upload's ETag is made of the MD5 digests of its parts.
+        view = memoryview(data)
+        while view:
+            length = min(len(view), self.part_size - self._part_length)
+            self._part.update(view[:length])
+            self._part_length += length
+            view = view[length:]
+            if self._part_length == self.part_size:
+                self._part_digests.append(self._part.digest())
+                self._part = hashlib.md5()
+                self._part_length = 0
+        return data
+
+    @property
+    def etag(self) -> str:
+        """The ETag of everything read so far, including the surrounding quotes."""
+        if self.size < MULTIPART_THRESHOLD:
+            # Everything read is still in the first part.
+            return format_etag(self._part.digest())
+        digests = self._part_digests + ([self._part.digest()] if self._part_length else [])
+        return format_etag(hashlib.md5(b''.join(digests)).digest(), len(digests))
+
+
+def list_uploaded_parts(bucket_name: str, object_key: str, upload_id: str, s3_client=None) -> Optional[dict]:
+    """
+    Lists the parts that have been uploaded in a multipart upload.
+
+    :param bucket_name: The name of the bucket.
+    :param object_key: The name/key of the object in the bucket.
+    :param upload_id: The ID of the multipart upload.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :return: Each part (as an element of the 'Parts' of a list_parts() response) by part number,
+             or None if there is no such upload.
+    """
+    # Create a simple S3 Client if none was specified.
+    if s3_client is None:
+        s3_client = boto3.client('s3')
+    parts = {}
+    paginator = s3_client.get_paginator('list_parts')
+    try:
+        for page in paginator.paginate(Bucket=bucket_name, Key=object_key, UploadId=upload_id):
+            for part in page.get('Parts', []):
+                parts[part['PartNumber']] = part
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchUpload', '404'):
+            return None
+        raise
+    return parts
+
+
+def abort_multipart_upload(bucket_name: str, object_key: str, upload_id: str, s3_client=None) -> None:
+    """
+    Aborts a multipart upload, deleting the parts that have been uploaded.
+    Does nothing if there is no such upload, or it can't be aborted.
+
+    :param bucket_name: The name of the bucket.
+    :param object_key: The name/key of the object in the bucket.
+    :param upload_id: The ID of the multipart upload.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    """
+    # Create a simple S3 Client if none was specified.
+    if s3_client is None:
+        s3_client = boto3.client('s3')
+    try:
+        s3_client.abort_multipart_upload(Bucket=bucket_name, Key=object_key, UploadId=upload_id)
+    except ClientError:
+        pass
+
+
+def download_ranges(bucket_name: str, object_key: str, file_path: str, size: int, s3_client=None,
+                    part_size: Optional[int] = None, concurrency: Optional[int] = None, etag: Optional[str] = None,
+                    callback: Optional[Callable[[int], None]] = None, version_id: Optional[str] = None) -> None:
+    """
+    Downloads the object with several ranged requests at a time,
+    writing each range straight into its place in a file preallocated to the size of the object.
+
+    The object is downloaded to a temporary file next to the file, which replaces the file once it is complete,
+    so that an incomplete download is never mistaken for a restored file.
+
+    :param bucket_name: The name of the bucket.
+    :param object_key: The name/key of the object in the bucket.
+    :param file_path: The file path on this machine.
+    :param size: The size of the object in bytes.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :param part_size: The size of each range in bytes. Chosen from the size of the object if none is specified.
+    :param concurrency: The number of ranges to download concurrently.
+                        Chosen from the size of the object if none is specified.
+    :param etag: The ETag of the object, if known.
+                 If specified, the download fails if the object changes partway through, rather than mixing versions.
+    :param callback: An optional callback function that will be called as the object is downloaded.
+                     The parameter is the number of bytes downloaded since the last call.
+    :param version_id: The version of the object to download. Defaults to the current version.
+    """
+    # Create a simple S3 Client if none was specified.
+    if s3_client is None:
+        s3_client = boto3.client('s3')
+    if part_size is None:
+        part_size = choose_part_size(size)
+    if concurrency is None:
+        concurrency = choose_concurrency(size, part_size)
+    temporary_file_path = f'{file_path}.aws-backup-part'
+    # Preallocate the file, so that ranges can be written at their offsets in any order.
+    with open(temporary_file_path, 'wb') as f:
+        f.truncate(size)
+    extra_args = {} if etag is None else {'IfMatch': etag}
+    if version_id is not None:
+        extra_args['VersionId'] = version_id
+
+    def download_range(offset: int) -> None:
+        byte_range = f'bytes={offset}-{min(offset + part_size, size) - 1}'
+        response = s3_client.get_object(Bucket=bucket_name, Key=object_key, Range=byte_range, **extra_args)
+        # Each range writes through its own file object, so ranges don't share a file position.
+        with open(temporary_file_path, 'r+b') as range_file:
+            range_file.seek(offset)
+            for chunk in response['Body'].iter_chunks(CHUNK_SIZE):
+                range_file.write(chunk)
+                if callback is not None:
+                    callback(len(chunk))
+
+    try:
+        with ThreadPoolExecutor(concurrency) as executor:
+            # Consume the results, so that the first failed range raises its exception.
+            for _ in executor.map(download_range, range(0, size, part_size)):
+                pass
+        os.replace(temporary_file_path, file_path)
+    except BaseException:
+        try:
+            os.remove(temporary_file_path)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,291 @@
+import io
+import uuid
+from datetime import datetime
+from threading import Lock
+from typing import Callable, Iterable, Iterator, NamedTuple, Optional
+
+import boto3
+from boto3.exceptions import S3UploadFailedError
+from botocore.exceptions import ClientError
+
+from .concurrency import AdaptiveConcurrency
+from .deletion import delete_objects
+from .manifest import get_manifest, metadata_key, put_manifest
+from .scanner import FileEntry
+
+
+# The default target size of a pack object.
+DEFAULT_PACK_SIZE: int = 64 * 1024 * 1024
+# The name of the pack index object, inside the packs metadata directory.
+PACK_INDEX_NAME: str = 'index.jsonl.gz'
+
+
+# The location of a packed file.
+# A NamedTuple rather than a dataclass, as a pack index may hold millions of them.
+class PackEntry(NamedTuple):
+    pack: str
+    offset: int
+    length: int
+    mtime_ns: int
+
+
+class PackIndex:
+    """Maps the relative path of each packed file to its location in a pack object."""
+
+    entries: dict[str, PackEntry]
+    last_modified: Optional[datetime]
+
+    def __init__(self, entries: Optional[dict[str, PackEntry]] = None, last_modified: Optional[datetime] = None):
+        """
+        Initializes the PackIndex.
+
+        :param entries: The location of each packed file, by relative path.
+        :param last_modified: When the index was uploaded, or None if it hasn't been.
+        """
+        self.entries = {} if entries is None else entries
+        self.last_modified = last_modified
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, relative_path: str) -> bool:
+        return relative_path in self.entries
+
+    def get(self, relative_path: str) -> Optional[PackEntry]:
+        return self.entries.get(relative_path)
+
+    @property
+    def total_size(self) -> int:
+        """The total size of every packed file in bytes."""
+        return sum(entry.length for entry in self.entries.values())
+
+    def packs(self, exclude: Iterable[str] = ()) -> dict[str, list[tuple[str, PackEntry]]]:
+        """
+        Groups the packed files by pack, ordered by their offset in the pack.
+
+        :param exclude: The relative paths of packed files to leave out.
+        :return: The relative path and location of each packed file, by pack name.
+        """
+        exclude = set(exclude)
+        packs = {}
+        for relative_path, entry in self.entries.items():
+            if relative_path not in exclude:
+                packs.setdefault(entry.pack, []).append((relative_path, entry))
+        for entries in packs.values():
+            entries.sort(key=lambda item: item[1].offset)
+        return packs
+
+
+def pack_key(bucket_directory: str, pack_name: str) -> str:
+    """Gets the key of the pack object with the given name."""
+    return metadata_key(bucket_directory, 'packs', pack_name)
+
+
+def get_pack_index(bucket_name: str, bucket_directory: str, s3_client=None) -> PackIndex:
+    """
+    Downloads the pack index of the backed up directory.
+
+    :param bucket_name: The name of the bucket.
+    :param bucket_directory: The name of the backed up directory in the bucket.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :return: The pack index, which is empty if the directory was never backed up with packing.
+    """
+    manifest = get_manifest(bucket_name, metadata_key(bucket_directory, 'packs', PACK_INDEX_NAME), s3_client)
+    if manifest is None:
+        return PackIndex()
+    entries, response = manifest
+    pack_index = PackIndex(last_modified=response['LastModified'])
+    for entry in entries:
+        pack_index.entries[entry['path']] = PackEntry(entry['pack'], entry['offset'], entry['length'],
+                                                      entry['mtime_ns'])
+    return pack_index
+
+
+def put_pack_index(bucket_name: str, bucket_directory: str, pack_index: PackIndex, s3_client=None) -> None:
+    """
+    Uploads the pack index of the backed up directory, replacing the previous one.
+
+    :param bucket_name: The name of the bucket.
+    :param bucket_directory: The name of the backed up directory in the bucket.
+    :param pack_index: The pack index.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    """
+    entries = ({'path': relative_path, **entry._asdict()} for relative_path, entry in pack_index.entries.items())
+    put_manifest(bucket_name, metadata_key(bucket_directory, 'packs', PACK_INDEX_NAME), entries, s3_client)
+
+
+def delete_packs(bucket_name: str, bucket_directory: str, pack_names: Iterable[str], s3_client=None) -> None:
+    """
+    Deletes pack objects, such as those no longer referenced by the pack index.
+
+    :param bucket_name: The name of the bucket.
+    :param bucket_directory: The name of the backed up directory in the bucket.
+    :param pack_names: The names of the packs to delete.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    """
+    delete_objects(bucket_name, (pack_key(bucket_directory, pack_name) for pack_name in pack_names), s3_client)
+
+
+class PackWriter:
+    """
+    Appends small files into pack objects, uploading each pack once it reaches the pack size.
+    Safe to use from multiple threads.
+    """
+
+    bucket_name: str
+    bucket_directory: str
+    pack_size: int
+    pack_index: PackIndex
+    _callback: Optional[Callable[[list[FileEntry], bool], None]]
+    _concurrency: Optional[AdaptiveConcurrency]
+    _lock: Lock
+    _buffer: io.BytesIO
+    _pending: list[tuple[FileEntry, PackEntry]]
+    _pack_name: str
+
+    def __init__(self, bucket_name: str, bucket_directory: str, s3_client=None, pack_size: int = DEFAULT_PACK_SIZE,
+                 callback: Optional[Callable[[list[FileEntry], bool], None]] = None,
+                 concurrency: Optional[AdaptiveConcurrency] = None) -> None:
+        """
+        Initializes the PackWriter.
+
+        :param bucket_name: The name of the bucket.
+        :param bucket_directory: The name of the backed up directory in the bucket.
+        :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+        :param pack_size: The size at which a pack is uploaded.
+        :param callback: An optional callback function that will be called after each pack is uploaded.
+                         The parameters are the files in the pack, and whether the pack was uploaded or not.
+        :param concurrency: The AdaptiveConcurrency to limit pack uploads in flight with, such as the one
+                            shared with the backup's other uploads. Packs are uploaded without a limit if none is
+                            specified.
+        """
+        # Create a simple S3 Client if none was specified.
+        if s3_client is None:
+            s3_client = boto3.client('s3')
+        self.bucket_name = bucket_name
+        self.bucket_directory = bucket_directory
+        self.pack_size = pack_size
+        self.pack_index = PackIndex()
+        self._s3_client = s3_client
+        self._callback = callback
+        self._concurrency = concurrency
+        self._lock = Lock()
+        self._start_pack()
+
+    def add(self, file: FileEntry) -> None:
+        """
+        Appends the file to the current pack, uploading the pack if it is full.
+        The file is only added to the pack index once its pack has been uploaded.
+
+        :param file: The file to pack.
+        """
+        with open(file.path, 'rb') as f:
+            data = f.read()
+        with self._lock:
+            entry = PackEntry(self._pack_name, self._buffer.tell(), len(data), file.mtime_ns)
+            self._buffer.write(data)
+            self._pending.append((file, entry))
+            if self._buffer.tell() < self.pack_size:
+                return
+            pack = self._finish_pack()
+        self._upload(*pack)
+
+    def keep(self, relative_path: str, entry: PackEntry) -> None:
+        """
+        Keeps a file that is already packed (e.g. by a previous backup) in the pack index.
+
+        :param relative_path: The relative path of the file.
+        :param entry: The location of the file.
+        """
+        with self._lock:
+            self.pack_index.entries[relative_path] = entry
+
+    def close(self) -> None:
+        """Uploads the current pack, if it has any files."""
+        with self._lock:
+            if not self._pending:
+                return
+            pack = self._finish_pack()
+        self._upload(*pack)
+
+    def _start_pack(self) -> None:
+        """Starts a new, empty pack."""
+        self._buffer = io.BytesIO()
+        self._pending = []
+        self._pack_name = f'{uuid.uuid4().hex}.pack'
+
+    def _finish_pack(self) -> tuple[str, bytes, list[tuple[FileEntry, PackEntry]]]:
+        """Takes the current pack so that it can be uploaded, and starts a new one. Must hold the lock."""
+        pack = self._pack_name, self._buffer.getvalue(), self._pending
+        self._start_pack()
+        return pack
+
+    def _upload(self, pack_name: str, data: bytes, pending: list[tuple[FileEntry, PackEntry]]) -> None:
+        """Uploads a finished pack, adding its files to the pack index if successful."""
+        object_key = pack_key(self.bucket_directory, pack_name)
+
+        def put_pack() -> None:
+            # Upload from a new stream each time, so that a throttled upload is retried from the start of the pack.
+            self._s3_client.upload_fileobj(io.BytesIO(data), self.bucket_name, object_key)
+
+        try:
+            if self._concurrency is None:
+                put_pack()
+            else:
+                self._concurrency.call(put_pack)
+            uploaded = True
+        except (ClientError, S3UploadFailedError):
+            uploaded = False
+        if uploaded:
+            with self._lock:
+                for file, entry in pending:
+                    self.pack_index.entries[file.relative_path] = entry
+        if self._callback is not None:
+            self._callback([file for file, entry in pending], uploaded)
+
+
+def read_pack(bucket_name: str, bucket_directory: str, pack_name: str, entries: list[tuple[str, PackEntry]],
+              s3_client=None, pack_length: Optional[int] = None) -> Iterator[tuple[str, bytes]]:
+    """
+    Reads packed files from a pack object.
+
+    If most of the pack is needed, the whole pack is fetched with a single request and streamed.
+    Otherwise, each file is fetched with its own ranged request.
+
+    :param bucket_name: The name of the bucket.
+    :param bucket_directory: The name of the backed up directory in the bucket.
+    :param pack_name: The name of the pack.
+    :param entries: The relative path and location of each file to read, ordered by offset.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :param pack_length: The length of the pack, if known. Defaults to the end of the last entry.
+    :return: The relative path and contents of each file.
+    """
+    # Create a simple S3 Client if none was specified.
+    if s3_client is None:
+        s3_client = boto3.client('s3')
+    object_key = pack_key(bucket_directory, pack_name)
+    if pack_length is None:
+        pack_length = max((entry.offset + entry.length for relative_path, entry in entries), default=0)
+    needed_length = sum(entry.length for relative_path, entry in entries)
+    if needed_length * 2 >= pack_length:
+        # Stream the whole pack, skipping over any files that aren't needed.
+        body = s3_client.get_object(Bucket=bucket_name, Key=object_key)['Body']
+        position = 0
+        for relative_path, entry in entries:
+            while position < entry.offset:
+                skipped = body.read(min(entry.offset - position, 1024 * 1024))
+                if not skipped:
+                    break
+                position += len(skipped)
+            data = body.read(entry.length)
+            position += len(data)
+            yield relative_path, data
+        body.close()
+    else:
+        for relative_path, entry in entries:
+            if entry.length == 0:
+                yield relative_path, b''
+                continue
+            byte_range = f'bytes={entry.offset}-{entry.offset + entry.length - 1}'
+            response = s3_client.get_object(Bucket=bucket_name, Key=object_key, Range=byte_range)
+            yield relative_path, response['Body'].read()
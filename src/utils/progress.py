@@ -1,12 +1,24 @@
+import math
 import os
+import time
 from decimal import Decimal, ROUND_HALF_UP
-from typing import Optional
+from threading import Lock, RLock
+from typing import Iterable, Iterator, Optional
 
-from .size import format_size, SIZES_ABBRV, SIZES_ALIGNED_ABBRV
+from .scanner import FileEntry
+from .size import format_size, SIZES_ABBRV, SIZES_ALIGNED_ABBRV, TRANSMISSION_RATES
 
 
 class ProgressLogger:
-    """Logs progress made on backing up or restoring files."""
+    """
+    Logs progress made on backing up or restoring files.
+    Safe to use from multiple threads.
+
+    Progress is made both as files complete, and as the bytes of incomplete files are transferred (see transfer()),
+    so that a single large file still shows progress, the transfer rate, and the estimated time remaining.
+    The progress is redrawn at most refresh_rate times per second, no matter how often progress is made,
+    except for the final redraw once every file is complete.
+    """
 
     completed_files: int
     total_files: int
@@ -16,9 +28,19 @@ class ProgressLogger:
     progress_bar_width: int
     progress_bar_complete: str
     progress_bar_incomplete: str
+    scanning: bool
+    transferring_size: int
+    transferred_size: int
+    refresh_rate: float
+    rate_window: float
+    rate: Optional[float]
+    lock: RLock
+    _last_redraw: float
+    _last_sample: tuple[float, int]
 
     def __init__(self, total_files=0, total_size=0, trailing_spaces=4,
-                 progress_bar_width=20, progress_bar_complete='█', progress_bar_incomplete='-'):
+                 progress_bar_width=20, progress_bar_complete='█', progress_bar_incomplete='-', scanning=False,
+                 refresh_rate=10, rate_window=5):
         """
         Initializes the ProgressLogger.
 
@@ -28,6 +50,10 @@ class ProgressLogger:
         :param progress_bar_width: The width of the progress bar (in characters).
         :param progress_bar_complete: The symbol for the complete part of the progress bar.
         :param progress_bar_incomplete: The symbol for the incomplete part of the progress bar.
+        :param scanning: Whether files are still being discovered (see discover()),
+                         in which case total_files and total_size are only running totals.
+        :param refresh_rate: The maximum number of times per second to redraw the progress.
+        :param rate_window: The number of seconds the transfer rate is smoothed over.
         """
         self.completed_files = 0
         self.total_files = total_files
@@ -37,6 +63,18 @@ class ProgressLogger:
         self.progress_bar_width = progress_bar_width
         self.progress_bar_complete = progress_bar_complete
         self.progress_bar_incomplete = progress_bar_incomplete
+        self.scanning = scanning
+        self.transferring_size = 0
+        # Every byte passed to transfer(), which the rate is sampled from, so that skipped files don't inflate it.
+        self.transferred_size = 0
+        self.refresh_rate = refresh_rate
+        self.rate_window = rate_window
+        self.rate = None
+        # Held while printing, so that other output (e.g. the name of each file) doesn't interleave with redraws.
+        # Reentrant, so that complete() can be called while printing that output.
+        self.lock = RLock()
+        self._last_redraw = -math.inf
+        self._last_sample = (time.monotonic(), 0)
 
     def get_progress_info(self) -> str:
         """
@@ -46,11 +84,20 @@ class ProgressLogger:
         * Progress bar
         * Completed Size / Total Size
         * Completed Files / Total Files
+        * Transfer rate
+        * Estimated time remaining
+
+        While scanning, the percentage and progress bar are replaced with "scanning…",
+        as the totals are only running totals.
 
         :return: A string representing the current progress.
         """
         # Get the progress percentage and bar.
-        progress = self.completed_size / self.total_size
+        done_size = self.done_size
+        if self.total_size:
+            progress = min(done_size / self.total_size, 1)
+        else:
+            progress = self.completed_files / self.total_files if self.total_files else 1
         progress_percentage = f'{progress:>4.0%}'
         progress_bar = get_progress_bar(progress,
                                         width=self.progress_bar_width,
@@ -58,7 +105,7 @@ class ProgressLogger:
                                         incomplete=self.progress_bar_incomplete)
         # Get the progress in terms of size.
         units = SIZES_ALIGNED_ABBRV if self.total_size >= 1024 else SIZES_ABBRV
-        formatted_size_complete = format_size(self.completed_size, units=units)
+        formatted_size_complete = format_size(done_size, units=units)
         formatted_size_total = format_size(self.total_size, units=units)
         # Ensure that any size between 0 and total_size will align properly.
         formatted_max_bytes = format_size(1000, units=units)
@@ -67,8 +114,33 @@ class ProgressLogger:
         # Get the progress in terms of files.
         max_files_len = len(str(self.total_files))
         files_progress = f'{self.completed_files:>{max_files_len}}/{self.total_files} files'
+        # Get the transfer rate (in bits, like network speeds) and the estimated time remaining.
+        if self.rate is None:
+            rate_progress = ''
+        else:
+            formatted_rate = format_size(int(self.rate * 8), units=TRANSMISSION_RATES, unit_size=1000)
+            rate_progress = f'   {formatted_rate:>9}'
+            if not self.scanning:
+                rate_progress += f'   ETA {format_duration(self.get_time_remaining())}'
         # Put everything together.
-        return f'{progress_percentage} |{progress_bar}| {size_progress}   {files_progress}'
+        if self.scanning:
+            return f'scanning… {size_progress}   {files_progress}{rate_progress}'
+        return f'{progress_percentage} |{progress_bar}| {size_progress}   {files_progress}{rate_progress}'
+
+    @property
+    def done_size(self) -> int:
+        """The size of every completed file, plus the bytes transferred so far of incomplete files."""
+        return self.completed_size + self.transferring_size
+
+    def get_time_remaining(self) -> Optional[float]:
+        """
+        Estimates the time remaining from the smoothed transfer rate.
+
+        :return: The estimated number of seconds remaining, or None if there is no estimate yet.
+        """
+        if not self.rate:
+            return None
+        return max(self.total_size - self.done_size, 0) / self.rate
 
     def print_progress_info(self, trailing_spaces: Optional[int] = None) -> None:
         """
@@ -79,7 +151,10 @@ class ProgressLogger:
         """
         if trailing_spaces is None:
             trailing_spaces = self.trailing_spaces
-        print(f'{self.get_progress_info()}{" " * trailing_spaces}', end='')
+        # Start with a carriage return, so that redrawing the progress overwrites the previous progress.
+        with self.lock:
+            print(f'\r{self.get_progress_info()}{" " * trailing_spaces}', end='', flush=True)
+            self._last_redraw = time.monotonic()
 
     def complete_file(self, file_path: str, was_updated: bool) -> None:
         """
@@ -91,10 +166,113 @@ class ProgressLogger:
         :param file_path: The file to complete.
         :param was_updated: Whether the local or backup were updated. Not used for now.
         """
-        self.completed_files += 1
-        self.completed_size += os.path.getsize(file_path)
+        self.complete(os.path.getsize(file_path))
+
+    def complete(self, file_size: int, transferred_size: int = 0) -> None:
+        """
+        Complete a file of the given size, updating completed_files and completed_size,
+        then calling print_progress_info() if it is time to redraw.
+
+        Unlike complete_file(), the file is not stat'ed, so its size must already be known.
+
+        :param file_size: The size of the completed file in bytes.
+        :param transferred_size: The bytes of the file that were reported to transfer() before it completed,
+                                 which are now counted as part of the completed file instead.
+        """
+        with self.lock:
+            self.completed_files += 1
+            self.completed_size += file_size
+            self.transferring_size -= transferred_size
+            self._redraw(force=self.completed_files >= self.total_files and not self.scanning)
+
+    def transfer(self, bytes_amount: int) -> None:
+        """
+        Makes progress on an incomplete file, then calls print_progress_info() if it is time to redraw.
+
+        Meant to be called as bytes are transferred, like the Callback of the S3 Client's upload and download methods.
+        The bytes must be passed to complete() as its transferred_size once the file is complete,
+        so use a FileTransfer to count them.
+
+        :param bytes_amount: The number of bytes transferred since the last call (which may be negative on a retry).
+        """
+        with self.lock:
+            self.transferring_size += bytes_amount
+            self.transferred_size += bytes_amount
+            self._redraw()
+
+    def _redraw(self, force: bool = False) -> None:
+        """Updates the transfer rate and redraws the progress, if it has been long enough since the last redraw."""
+        now = time.monotonic()
+        if not force and now - self._last_redraw < 1 / self.refresh_rate:
+            return
+        # Smooth the rate with an exponential moving average over rate_window seconds.
+        last_time, last_size = self._last_sample
+        elapsed = now - last_time
+        if elapsed > 0:
+            current_rate = (self.transferred_size - last_size) / elapsed
+            if self.rate is None:
+                self.rate = current_rate
+            else:
+                weight = 1 - math.exp(-elapsed / self.rate_window)
+                self.rate += weight * (current_rate - self.rate)
+            self._last_sample = (now, self.transferred_size)
         self.print_progress_info()
 
+    def add_file(self, size: int) -> None:
+        """
+        Adds a file to the totals, such as one found while scanning.
+
+        :param size: The size of the file in bytes.
+        """
+        with self.lock:
+            self.total_files += 1
+            self.total_size += size
+
+    def discover(self, files: Iterable[FileEntry]) -> Iterator[FileEntry]:
+        """
+        Adds each file to the totals as it is discovered, yielding it on to be completed.
+        Once every file has been discovered, scanning is set to False.
+
+        Meant to wrap scan_directory(), so that files can be worked on while the directory is still being scanned.
+
+        :param files: The files to add to the totals.
+        :return: The same files.
+        """
+        with self.lock:
+            self.scanning = True
+        for file in files:
+            self.add_file(file.size)
+            yield file
+        with self.lock:
+            self.scanning = False
+
+
+class FileTransfer:
+    """
+    Counts the bytes transferred of a single file, passing them on to a ProgressLogger.
+    Meant to be used as the Callback of the S3 Client's upload and download methods,
+    which may call it from multiple threads at once.
+    """
+
+    transferred_size: int
+    _lock: Lock
+
+    def __init__(self, progress: Optional[ProgressLogger] = None) -> None:
+        """
+        Initializes the FileTransfer.
+
+        :param progress: The ProgressLogger to pass the transferred bytes to, if any.
+        """
+        self.transferred_size = 0
+        self._progress = progress
+        self._lock = Lock()
+
+    def __call__(self, bytes_amount: int) -> None:
+        with self._lock:
+            self.transferred_size += bytes_amount
+        if self._progress is not None:
+            self._progress.transfer(bytes_amount)
+
 
 def get_progress_bar(progress: float, width: int = 10, complete: str = '#', incomplete: str = '.') -> str:
     """
@@ -114,3 +292,23 @@ def get_progress_bar(progress: float, width: int = 10, complete: str = '#', inco
     complete_length = int(complete_decimal)
     incomplete_length = width - complete_length
     return complete * complete_length + incomplete * incomplete_length
+
+
+def format_duration(seconds: Optional[float]) -> str:
+    """
+    Formats a duration as hours, minutes and seconds.
+
+    Examples::
+
+        format_duration(75)     == '0:01:15'
+        format_duration(90061)  == '25:01:01'
+        format_duration(None)   == '-:--:--'
+
+    :param seconds: The duration in seconds, or None if it is unknown.
+    :return: The formatted duration.
+    """
+    if seconds is None or math.isinf(seconds):
+        return '-:--:--'
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02}:{seconds:02}'
@@ -0,0 +1,90 @@
+import os
+import stat
+from typing import Iterable, Iterator, NamedTuple
+
+
+# The type of each file yielded by scan_directory().
+# A NamedTuple rather than a dataclass, as an inventory may hold millions of them.
+class FileEntry(NamedTuple):
+    path: str
+    relative_path: str
+    size: int
+    mtime_ns: int
+    inode: int
+    is_link: bool
+
+    @property
+    def mtime(self) -> float:
+        """The modification time of the file, in seconds since the epoch."""
+        return self.mtime_ns / 1_000_000_000
+
+
+def scan_directory(directory: str, followlinks: bool = False) -> Iterator[FileEntry]:
+    """
+    Scans the directory, yielding every file in it (including in subdirectories).
+
+    Uses os.scandir(), so each file is only stat'ed once,
+    and the result can be reused for summarizing the directory, checking for changes, and logging progress.
+    Like os.walk(), directories that can't be read and files that can't be stat'ed are skipped.
+
+    :param directory: The directory to scan.
+    :param followlinks: True to follow symbolic links, False to skip them.
+    :return: Every file in the directory.
+    """
+    # Scan depth first, keeping the relative path of each directory so that it never needs to be recalculated.
+    directories = [(directory, '')]
+    while directories:
+        path, relative_path = directories.pop()
+        try:
+            entries = os.scandir(path)
+        except OSError:
+            continue
+        subdirectories = []
+        with entries:
+            for entry in entries:
+                relative_entry_path = os.path.join(relative_path, entry.name)
+                try:
+                    is_link = entry.is_symlink()
+                    if is_link and not followlinks:
+                        continue
+                    if entry.is_dir():
+                        subdirectories.append((entry.path, relative_entry_path))
+                        continue
+                    stat_result = entry.stat()
+                except OSError:
+                    continue
+                yield FileEntry(entry.path, relative_entry_path, stat_result.st_size,
+                                stat_result.st_mtime_ns, stat_result.st_ino, is_link)
+        # Reverse the subdirectories, so that they are scanned in the order they were found.
+        directories.extend(reversed(subdirectories))
+
+
+def scan_paths(directory: str, relative_paths: Iterable[str], followlinks: bool = False) -> Iterator[FileEntry]:
+    """
+    Scans only some paths in the directory, such as ones that are known to have changed,
+    yielding the same entries as scan_directory() would for them.
+    Paths of directories yield every file in them (including in subdirectories),
+    and paths that no longer exist or can't be stat'ed are skipped.
+
+    :param directory: The directory the paths are in.
+    :param relative_paths: The paths to scan, relative to the directory.
+    :param followlinks: True to follow symbolic links, False to skip them.
+    :return: Every file at or under the paths.
+    """
+    for relative_path in relative_paths:
+        path = os.path.join(directory, relative_path)
+        try:
+            stat_result = os.lstat(path)
+            is_link = stat.S_ISLNK(stat_result.st_mode)
+            if is_link:
+                if not followlinks:
+                    continue
+                stat_result = os.stat(path)
+        except OSError:
+            continue
+        if stat.S_ISDIR(stat_result.st_mode):
+            for entry in scan_directory(path, followlinks):
+                yield entry._replace(relative_path=os.path.join(relative_path, entry.relative_path))
+        else:
+            yield FileEntry(path, relative_path, stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino,
+                            is_link)
@@ -1,8 +1,11 @@
 import os
 from dataclasses import dataclass
 from math import floor
+from typing import Iterable, Optional
 
-import boto3
+from .listing import ObjectIndex, list_bucket_directory
+from .manifest import is_metadata_path
+from .scanner import FileEntry, scan_directory
 
 
 # Constants for use as format_size() unit labels (the units parameter).
@@ -30,18 +33,26 @@ def directory_summary(directory: str, followlinks: bool = False) -> DirectoryInf
     :param followlinks: True to follow symbolic links, False otherwise.
     :return: Summary information about the directory.
     """
+    return files_summary(scan_directory(directory, followlinks))
+
+
+def files_summary(files: Iterable[FileEntry]) -> DirectoryInfo:
+    """
+    Gets the same summary information as directory_summary(), from an already scanned directory.
+
+    :param files: The files from scan_directory().
+    :return: Summary information about the files.
+    """
     file_count = 0
     size = 0
-    for path, directory_names, file_names in os.walk(directory, followlinks=followlinks):
-        for file_name in file_names:
-            file_path = os.path.join(path, file_name)
-            if followlinks or not os.path.islink(file_path):
-                file_count += 1
-                size += os.path.getsize(file_path)
+    for file in files:
+        file_count += 1
+        size += file.size
     return DirectoryInfo(file_count, size)
 
 
-def bucket_directory_summary(bucket_name: str, directory: str, s3_client=None) -> DirectoryInfo:
+def bucket_directory_summary(bucket_name: str, directory: str, s3_client=None,
+                             object_index: Optional[ObjectIndex] = None) -> DirectoryInfo:
     """
     Gets the following summary information about the directory in the bucket:
 
@@ -51,19 +62,21 @@ def bucket_directory_summary(bucket_name: str, directory: str, s3_client=None) -
     :param bucket_name: The bucket that contains the directory.
     :param directory: The directory to get the summary of.
     :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :param object_index: The objects in the directory, so that a listing shared with other uses
+                         (e.g. restoring the directory) doesn't need to be listed again.
+                         The directory will be listed if none is specified.
     :return: Summary information about the directory.
     """
-    # Create a simple S3 Client if none was specified.
-    if s3_client is None:
-        s3_client = boto3.client('s3')
+    if object_index is None:
+        object_index = list_bucket_directory(bucket_name, directory, s3_client)
     file_count = 0
     size = 0
-    paginator = s3_client.get_paginator('list_objects_v2')
-    page_iterator = paginator.paginate(Bucket=bucket_name, Prefix=directory)
-    for page in page_iterator:
-        for bucket_object in page['Contents']:
-            file_count += 1
-            size += bucket_object['Size']
+    for relative_key, object_size in object_index.sizes():
+        # Skip metadata objects, such as packs, which aren't files themselves.
+        if is_metadata_path(relative_key):
+            continue
+        file_count += 1
+        size += object_size
     return DirectoryInfo(file_count, size)
 
 
@@ -113,3 +126,68 @@ def format_size(size: int, units: tuple[str, ...] = SIZES, unit_size: int = 1024
     size /= 10 ** decimal_places
     # Still include the precision in the f-string, just in case of rounding errors.
     return f'{size:,.{decimal_places}f} {units[unit]}'
+
+
+def parse_size(raw_size: str, units: tuple[str, ...] = SIZES_ABBRV, unit_size: int = 1024) -> int:
+    """
+    Parses a size, such as one given on the command line, into a number of bytes.
+    Units are case-insensitive, and the "B" may be left off of every unit except bytes.
+
+    Examples::
+
+        parse_size('512')    == 512
+        parse_size('512 B')  == 512
+        parse_size('64KB')   == 65_536
+        parse_size('1.5 M')  == 1_572_864
+
+    :param raw_size: The size to parse.
+    :param units: The unit labels to accept.
+    :param unit_size: The size of a unit, typically either 1000 for decimal units or 1024 for binary units.
+    :return: The size in bytes.
+    :raises ValueError: If the size can't be parsed.
+    """
+    raw_size = raw_size.strip().upper()
+    number = raw_size.rstrip('ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+    unit = raw_size[len(number):]
+    exponent = 0
+    if unit:
+        labels = [label.upper() for label in units]
+        short_labels = [label[:-1] for label in labels]
+        if unit in labels:
+            exponent = labels.index(unit)
+        elif unit in short_labels[1:]:
+            exponent = short_labels.index(unit, 1)
+        else:
+            raise ValueError(f'unknown unit: {unit}')
+    size = float(number) * unit_size ** exponent
+    if size < 0:
+        raise ValueError('size must not be negative')
+    return int(size)
+
+
+def parse_rate(raw_rate: str) -> float:
+    """
+    Parses a transfer rate, such as one given on the command line, into a number of bytes per second.
+    Rates in bits per second use decimal units (as network speeds usually are),
+    and rates in bytes per second use the same units as parse_size() followed by "/s".
+
+    Examples::
+
+        parse_rate('8 bps')    == 1
+        parse_rate('50Mbps')   == 6_250_000
+        parse_rate('1MB/s')    == 1_048_576
+
+    :param raw_rate: The rate to parse.
+    :return: The rate in bytes per second.
+    :raises ValueError: If the rate can't be parsed.
+    """
+    raw_rate = raw_rate.strip()
+    if raw_rate.upper().endswith('/S'):
+        rate = parse_size(raw_rate[:-2])
+    elif raw_rate.upper().endswith('BPS'):
+        rate = parse_size(raw_rate, TRANSMISSION_RATES, 1000) / 8
+    else:
+        raise ValueError('missing unit (e.g. 50Mbps or 5MB/s)')
+    if rate <= 0:
+        raise ValueError('rate must be positive')
+    return rate
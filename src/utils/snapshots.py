@@ -0,0 +1,383 @@
+import os
+from datetime import datetime, timezone
+from typing import Iterator, NamedTuple, Optional
+
+import boto3
+
+from .chunks import CHUNK_MANIFEST_SUFFIX, DeltaEntry, DeltaIndex, chunk_manifest_key
+from .dedup import DedupEntry, DedupManifest, blob_key
+from .deletion import delete_objects
+from .listing import ObjectIndex, list_objects
+from .manifest import dump_manifest, get_manifest, load_manifest, metadata_key, put_manifest
+from .packs import PackEntry, PackIndex, delete_packs, get_pack_index, pack_key
+
+
+# The directory snapshots downloaded from or uploaded to a bucket are cached in,
+# so that they can be compared without downloading them again.
+DEFAULT_SNAPSHOT_CACHE: str = os.path.join(os.path.expanduser('~'), '.aws-backup', 'snapshots')
+# The suffix of every snapshot's key.
+SNAPSHOT_SUFFIX: str = '.jsonl.gz'
+# The ID that refers to the most recent snapshot.
+LATEST_SNAPSHOT: str = 'latest'
+# The format of snapshot IDs: when the snapshot was taken, to the microsecond, so that no two backups share one.
+SNAPSHOT_ID_FORMAT: str = '%Y%m%dT%H%M%S.%fZ'
+# The format of the IDs of snapshots taken before they included microseconds.
+SECONDS_SNAPSHOT_ID_FORMAT: str = '%Y%m%dT%H%M%SZ'
+# The name of the summary of the objects the snapshots refer to, kept beside (not among) the snapshots.
+SNAPSHOT_REFERENCES_NAME: str = 'snapshot-references.jsonl.gz'
+
+# The kinds of objects a file in a snapshot can be stored in.
+OBJECT_KIND: str = 'object'
+PACK_KIND: str = 'pack'
+BLOB_KIND: str = 'blob'
+DELTA_KIND: str = 'delta'
+
+
+# The type of each file in a snapshot.
+# The key is of the object that holds the file: its own object, its pack, its blob, or its chunk manifest.
+# The version ID and ETag are only known for files in their own object, and the offset for packed files.
+class SnapshotEntry(NamedTuple):
+    size: int
+    mtime_ns: int
+    kind: str
+    key: str
+    version_id: Optional[str] = None
+    etag: Optional[str] = None
+    offset: Optional[int] = None
+
+
+class Snapshot:
+    """
+    A record of every file backed up by one backup, and where each one was stored,
+    so that the directory can be restored as it was at the time without listing the bucket.
+    Updating the entries from multiple threads is safe, as long as each thread only sets its own entries.
+    """
+
+    snapshot_id: str
+    entries: dict[str, SnapshotEntry]
+
+    def __init__(self, snapshot_id: Optional[str] = None, entries: Optional[dict[str, SnapshotEntry]] = None) -> None:
+        """
+        Initializes the Snapshot.
+
+        :param snapshot_id: The ID of the snapshot, which is when it was taken (see new_snapshot_id()).
+                            Defaults to now.
+        :param entries: Every file in the snapshot, by relative path.
+        """
+        self.snapshot_id = new_snapshot_id() if snapshot_id is None else snapshot_id
+        self.entries = {} if entries is None else entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, relative_path: str) -> Optional[SnapshotEntry]:
+        return self.entries.get(relative_path)
+
+    @property
+    def created_at(self) -> datetime:
+        """When the snapshot was taken."""
+        id_format = SNAPSHOT_ID_FORMAT if '.' in self.snapshot_id else SECONDS_SNAPSHOT_ID_FORMAT
+        return datetime.strptime(self.snapshot_id, id_format).replace(tzinfo=timezone.utc)
+
+    @property
+    def total_size(self) -> int:
+        """The total size of every file in the snapshot in bytes."""
+        return sum(entry.size for entry in self.entries.values())
+
+    def add_indexes(self, bucket_directory: str, pack_index: Optional[PackIndex] = None,
+                    dedup_manifest: Optional[DedupManifest] = None, delta_index: Optional[DeltaIndex] = None) -> None:
+        """
+        Adds every file in the indexes of a backup to the snapshot.
+
+        :param bucket_directory: The name of the backed up directory in the bucket.
+        :param pack_index: The pack index of the backup, if it packed files.
+        :param dedup_manifest: The dedup manifest of the backup, if it deduplicated files.
+        :param delta_index: The delta index of the backup, if it backed up files as chunks.
+        """
+        if pack_index is not None:
+            for relative_path, entry in pack_index.entries.items():
+                self.entries[relative_path] = SnapshotEntry(entry.length, entry.mtime_ns, PACK_KIND,
+                                                            pack_key(bucket_directory, entry.pack),
+                                                            offset=entry.offset)
+        if dedup_manifest is not None:
+            for relative_path, entry in dedup_manifest.entries.items():
+                self.entries[relative_path] = SnapshotEntry(entry.size, entry.mtime_ns, BLOB_KIND,
+                                                            blob_key(entry.digest))
+        if delta_index is not None:
+            for relative_path, entry in delta_index.entries.items():
+                self.entries[relative_path] = SnapshotEntry(entry.size, entry.mtime_ns, DELTA_KIND,
+                                                            chunk_manifest_key(bucket_directory, relative_path,
+                                                                               entry.manifest))
+
+    def to_indexes(self, bucket_directory: str) -> tuple[ObjectIndex, PackIndex, DedupManifest, DeltaIndex]:
+        """
+        Splits the snapshot into the listing and indexes that restore_directory() restores from,
+        so that a snapshot is restored the same way as the current backup.
+        The objects are given the modification times of their files as their last modified dates.
+
+        :param bucket_directory: The name of the backed up directory in the bucket.
+        :return: The files in their own objects, the packed files, the deduplicated files,
+                 and the files backed up as chunks.
+        """
+        object_index = ObjectIndex(os.path.join(bucket_directory, ''))
+        pack_index = PackIndex(last_modified=self.created_at)
+        dedup_manifest = DedupManifest(last_modified=self.created_at)
+        delta_index = DeltaIndex(last_modified=self.created_at)
+        for relative_path, entry in self.entries.items():
+            if entry.kind == OBJECT_KIND:
+                mtime = datetime.fromtimestamp(entry.mtime_ns / 1_000_000_000, timezone.utc)
+                object_index.add(entry.key, entry.size, mtime, entry.etag or '')
+            elif entry.kind == PACK_KIND:
+                pack_index.entries[relative_path] = PackEntry(os.path.basename(entry.key), entry.offset, entry.size,
+                                                              entry.mtime_ns)
+            elif entry.kind == BLOB_KIND:
+                dedup_manifest.entries[relative_path] = DedupEntry(os.path.basename(entry.key), entry.size,
+                                                                   entry.mtime_ns)
+            elif entry.kind == DELTA_KIND:
+                # Files backed up before chunk manifests were named after their digests refer to their own manifest.
+                manifest = None
+                if entry.key != chunk_manifest_key(bucket_directory, relative_path):
+                    manifest = os.path.basename(entry.key)[:-len(CHUNK_MANIFEST_SUFFIX)]
+                delta_index.entries[relative_path] = DeltaEntry(entry.size, entry.mtime_ns, manifest)
+        return object_index, pack_index, dedup_manifest, delta_index
+
+
+class SnapshotChange(NamedTuple):
+    change: str
+    relative_path: str
+    old_entry: Optional[SnapshotEntry]
+    new_entry: Optional[SnapshotEntry]
+
+
+def new_snapshot_id() -> str:
+    """Creates the ID of a snapshot taken now, which sorts in the order snapshots are taken."""
+    return datetime.now(timezone.utc).strftime(SNAPSHOT_ID_FORMAT)
+
+
+def snapshot_key(bucket_directory: str, snapshot_id: str) -> str:
+    """Gets the key of the snapshot with the given ID."""
+    return metadata_key(bucket_directory, 'snapshots', f'{snapshot_id}{SNAPSHOT_SUFFIX}')
+
+
+def diff_snapshots(old_snapshot: Snapshot, new_snapshot: Snapshot) -> Iterator[SnapshotChange]:
+    """
+    Compares two snapshots, without making any requests.
+    A file is modified if its size, modification time, or the object (or version) it's stored in changed.
+
+    :param old_snapshot: The earlier snapshot.
+    :param new_snapshot: The later snapshot.
+    :return: Each file that was 'added', 'removed', or 'modified' between the snapshots, ordered by path.
+    """
+    for relative_path in sorted(old_snapshot.entries.keys() | new_snapshot.entries.keys()):
+        old_entry = old_snapshot.get(relative_path)
+        new_entry = new_snapshot.get(relative_path)
+        if old_entry is None:
+            yield SnapshotChange('added', relative_path, None, new_entry)
+        elif new_entry is None:
+            yield SnapshotChange('removed', relative_path, old_entry, None)
+        elif old_entry != new_entry:
+            yield SnapshotChange('modified', relative_path, old_entry, new_entry)
+
+
+def _entry_to_dict(relative_path: str, entry: SnapshotEntry) -> dict:
+    """Converts a snapshot entry to a manifest entry, leaving out the fields that aren't known."""
+    entry_dict = {'path': relative_path, 'size': entry.size, 'mtime_ns': entry.mtime_ns, 'kind': entry.kind,
+                  'key': entry.key}
+    for name in ('version_id', 'etag', 'offset'):
+        value = getattr(entry, name)
+        if value is not None:
+            entry_dict[name] = value
+    return entry_dict
+
+
+def _load_snapshot(snapshot_id: str, entries: Iterator[dict]) -> Snapshot:
+    """Loads a snapshot from its manifest entries."""
+    snapshot = Snapshot(snapshot_id)
+    for entry in entries:
+        snapshot.entries[entry['path']] = SnapshotEntry(entry['size'], entry['mtime_ns'], entry['kind'], entry['key'],
+                                                        entry.get('version_id'), entry.get('etag'),
+                                                        entry.get('offset'))
+    return snapshot
+
+
+def _cache_path(cache_directory: str, bucket_name: str, bucket_directory: str, snapshot_id: str) -> str:
+    """Gets the path a snapshot is cached at."""
+    return os.path.join(cache_directory, bucket_name, bucket_directory, f'{snapshot_id}{SNAPSHOT_SUFFIX}')
+
+
+def put_snapshot(bucket_name: str, bucket_directory: str, snapshot: Snapshot, s3_client=None,
+                 cache_directory: Optional[str] = DEFAULT_SNAPSHOT_CACHE) -> None:
+    """
+    Uploads a snapshot as a gzipped JSON lines manifest, and caches it locally.
+    Then counts it in the summary of the objects snapshots refer to (see get_snapshot_references()).
+
+    :param bucket_name: The name of the bucket.
+    :param bucket_directory: The name of the backed up directory in the bucket.
+    :param snapshot: The snapshot.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :param cache_directory: The directory to cache the snapshot in, or None to not cache it.
+    """
+    # Create a simple S3 Client if none was specified.
+    if s3_client is None:
+        s3_client = boto3.client('s3')
+    references = get_snapshot_references(bucket_name, bucket_directory, s3_client, cache_directory)
+    entries = [_entry_to_dict(relative_path, entry) for relative_path, entry in sorted(snapshot.entries.items())]
+    put_manifest(bucket_name, snapshot_key(bucket_directory, snapshot.snapshot_id), entries, s3_client)
+    for key in _referenced_keys(snapshot):
+        references[key] = references.get(key, 0) + 1
+    _put_snapshot_references(bucket_name, bucket_directory, references, s3_client)
+    if cache_directory is not None:
+        path = _cache_path(cache_directory, bucket_name, bucket_directory, snapshot.snapshot_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(dump_manifest(entries))
+
+
+def get_snapshot(bucket_name: str, bucket_directory: str, snapshot_id: str, s3_client=None,
+                 cache_directory: Optional[str] = DEFAULT_SNAPSHOT_CACHE) -> Optional[Snapshot]:
+    """
+    Gets a snapshot from the local cache, or downloads it with a single request (caching it) if it isn't cached.
+
+    :param bucket_name: The name of the bucket.
+    :param bucket_directory: The name of the backed up directory in the bucket.
+    :param snapshot_id: The ID of the snapshot, or LATEST_SNAPSHOT for the most recent one (which lists the snapshots).
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :param cache_directory: The directory snapshots are cached in, or None to not use a cache.
+    :return: The snapshot, or None if there is no such snapshot.
+    """
+    # Create a simple S3 Client if none was specified.
+    if s3_client is None:
+        s3_client = boto3.client('s3')
+    if snapshot_id == LATEST_SNAPSHOT:
+        snapshot_id = max(list_snapshots(bucket_name, bucket_directory, s3_client), default=None)
+        if snapshot_id is None:
+            return None
+    path = None
+    if cache_directory is not None:
+        path = _cache_path(cache_directory, bucket_name, bucket_directory, snapshot_id)
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                return _load_snapshot(snapshot_id, load_manifest(f))
+    manifest = get_manifest(bucket_name, snapshot_key(bucket_directory, snapshot_id), s3_client)
+    if manifest is None:
+        return None
+    snapshot = _load_snapshot(snapshot_id, manifest[0])
+    if path is not None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(dump_manifest(_entry_to_dict(relative_path, entry)
+                                  for relative_path, entry in sorted(snapshot.entries.items())))
+    return snapshot
+
+
+def list_snapshots(bucket_name: str, bucket_directory: str, s3_client=None) -> list[str]:
+    """
+    Lists the IDs of the snapshots of the backed up directory.
+
+    :param bucket_name: The name of the bucket.
+    :param bucket_directory: The name of the backed up directory in the bucket.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :return: The IDs of the snapshots, oldest first.
+    """
+    prefix = snapshot_key(bucket_directory, '')[:-len(SNAPSHOT_SUFFIX)]
+    object_index = list_objects(bucket_name, prefix, s3_client)
+    return sorted(object_info.key[len(prefix):-len(SNAPSHOT_SUFFIX)] for object_info in object_index
+                  if object_info.key.endswith(SNAPSHOT_SUFFIX))
+
+
+def _referenced_keys(snapshot: Snapshot) -> set[str]:
+    """Gets the keys of the objects a snapshot refers to that backups delete: files' own objects, and packs."""
+    return {entry.key for entry in snapshot.entries.values() if entry.kind in (OBJECT_KIND, PACK_KIND)}
+
+
+def _references_key(bucket_directory: str) -> str:
+    """Gets the key of the summary of the objects the snapshots of the backed up directory refer to."""
+    return metadata_key(bucket_directory, SNAPSHOT_REFERENCES_NAME)
+
+
+def _put_snapshot_references(bucket_name: str, bucket_directory: str, references: dict[str, int],
+                             s3_client=None) -> None:
+    """Uploads the summary of the objects the snapshots of the backed up directory refer to."""
+    entries = ({'key': key, 'snapshots': count} for key, count in sorted(references.items()))
+    put_manifest(bucket_name, _references_key(bucket_directory), entries, s3_client)
+
+
+def get_snapshot_references(bucket_name: str, bucket_directory: str, s3_client=None,
+                            cache_directory: Optional[str] = DEFAULT_SNAPSHOT_CACHE) -> dict[str, int]:
+    """
+    Gets how many snapshots of the backed up directory refer to each object that a backup could delete
+    (files' own objects, and packs), so that they aren't deleted while the snapshots that refer to them still exist.
+    This is a single request for the summary put_snapshot() keeps up to date. If there is no summary yet
+    (because the snapshots were recorded before there was one), it is built from every snapshot, and uploaded.
+
+    :param bucket_name: The name of the bucket.
+    :param bucket_directory: The name of the backed up directory in the bucket.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :param cache_directory: The directory snapshots are cached in, or None to not use a cache.
+    :return: The number of snapshots that refer to each object, by key. Objects no snapshot refers to are left out.
+    """
+    # Create a simple S3 Client if none was specified.
+    if s3_client is None:
+        s3_client = boto3.client('s3')
+    manifest = get_manifest(bucket_name, _references_key(bucket_directory), s3_client)
+    if manifest is not None:
+        return {entry['key']: entry['snapshots'] for entry in manifest[0]}
+    references = {}
+    snapshot_ids = list_snapshots(bucket_name, bucket_directory, s3_client)
+    for snapshot_id in snapshot_ids:
+        snapshot = get_snapshot(bucket_name, bucket_directory, snapshot_id, s3_client, cache_directory)
+        if snapshot is not None:
+            for key in _referenced_keys(snapshot):
+                references[key] = references.get(key, 0) + 1
+    if snapshot_ids:
+        _put_snapshot_references(bucket_name, bucket_directory, references, s3_client)
+    return references
+
+
+def prune_snapshots(bucket_name: str, bucket_directory: str, keep: int, s3_client=None,
+                    cache_directory: Optional[str] = DEFAULT_SNAPSHOT_CACHE) -> list[str]:
+    """
+    Deletes every snapshot of the backed up directory except the most recent ones,
+    then deletes the packs that only the deleted snapshots referred to (and that the pack index doesn't).
+    Files' own objects that only the deleted snapshots referred to are left for a backup with --mirror to delete.
+
+    :param bucket_name: The name of the bucket.
+    :param bucket_directory: The name of the backed up directory in the bucket.
+    :param keep: The number of the most recent snapshots to keep.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :param cache_directory: The directory snapshots are cached in, or None to not use a cache.
+    :return: The IDs of the deleted snapshots, oldest first.
+    """
+    # Create a simple S3 Client if none was specified.
+    if s3_client is None:
+        s3_client = boto3.client('s3')
+    snapshot_ids = list_snapshots(bucket_name, bucket_directory, s3_client)
+    pruned_ids = snapshot_ids[:max(len(snapshot_ids) - keep, 0)]
+    if not pruned_ids:
+        return []
+    references = get_snapshot_references(bucket_name, bucket_directory, s3_client, cache_directory)
+    released_packs = set()
+    for snapshot_id in pruned_ids:
+        snapshot = get_snapshot(bucket_name, bucket_directory, snapshot_id, s3_client, cache_directory)
+        if snapshot is None:
+            continue
+        for key in _referenced_keys(snapshot):
+            count = references.pop(key, 0) - 1
+            if count > 0:
+                references[key] = count
+        released_packs.update(entry.key for entry in snapshot.entries.values() if entry.kind == PACK_KIND)
+    # Delete the snapshots before updating the summary, so that it never leaves out an object a snapshot refers to.
+    delete_objects(bucket_name, (snapshot_key(bucket_directory, snapshot_id) for snapshot_id in pruned_ids),
+                   s3_client)
+    if cache_directory is not None:
+        for snapshot_id in pruned_ids:
+            try:
+                os.remove(_cache_path(cache_directory, bucket_name, bucket_directory, snapshot_id))
+            except FileNotFoundError:
+                pass
+    _put_snapshot_references(bucket_name, bucket_directory, references, s3_client)
+    # Packs that the current pack index refers to are still in use, even if no snapshot refers to them.
+    pack_names = {os.path.basename(key) for key in released_packs - references.keys()}
+    pack_names -= {entry.pack for entry in get_pack_index(bucket_name, bucket_directory, s3_client).entries.values()}
+    delete_packs(bucket_name, bucket_directory, pack_names, s3_client)
+    return pruned_ids
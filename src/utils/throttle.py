@@ -0,0 +1,277 @@
+import time
+from datetime import datetime
+from threading import Lock
+from typing import Iterator, NamedTuple, Optional
+
+from .size import parse_rate
+
+
+# How long a limiter may go without being used and still send at full speed afterwards, in seconds.
+# Limits how far above the rate a burst can go after a pause.
+BURST_DURATION: float = 0.25
+# The number of bytes a throttled stream reads or writes before consuming them from its limiter,
+# so that streams read in small blocks (such as 8 KiB by http.client) don't take the limiter's lock for each one.
+THROTTLE_CHUNK_SIZE: int = 64 * 1024
+# The rate of a rule that doesn't limit transfers, such as to make an exception to another rule.
+UNLIMITED: str = 'unlimited'
+# How often the rate of a scheduled limiter is checked against the time of day, in seconds.
+SCHEDULE_CHECK_INTERVAL: float = 1
+
+
+# A bandwidth limit, optionally only applied between two times of day.
+# Times are minutes after midnight in local time. A window that ends before it starts wraps past midnight.
+class BandwidthRule(NamedTuple):
+    rate: Optional[float]
+    start: Optional[int] = None
+    end: Optional[int] = None
+
+    def applies_at(self, minute: int) -> bool:
+        """
+        Determines if the rule applies at a time of day.
+
+        :param minute: The number of minutes after midnight.
+        :return: True if the rule has no window, or the time is in its window, False otherwise.
+        """
+        if self.start is None:
+            return True
+        if self.start <= self.end:
+            return self.start <= minute < self.end
+        return minute >= self.start or minute < self.end
+
+
+def parse_bandwidth_rule(raw_rule: str) -> BandwidthRule:
+    """
+    Parses a bandwidth limit, such as one given on the command line.
+    The rate (see parse_rate(), or "unlimited") is optionally followed by "@" and a window of local time,
+    with hours and optionally minutes.
+
+    Examples::
+
+        parse_bandwidth_rule('50Mbps')           == BandwidthRule(6_250_000)
+        parse_bandwidth_rule('50Mbps@9-17')      == BandwidthRule(6_250_000, 540, 1020)
+        parse_bandwidth_rule('unlimited@22:30-6') == BandwidthRule(None, 1350, 360)
+
+    :param raw_rule: The rule to parse.
+    :return: The rule.
+    :raises ValueError: If the rule can't be parsed.
+    """
+    raw_rate, _, raw_window = raw_rule.partition('@')
+    rate = None if raw_rate.strip().lower() == UNLIMITED else parse_rate(raw_rate)
+    if not raw_window:
+        return BandwidthRule(rate)
+    raw_start, separator, raw_end = raw_window.partition('-')
+    if not separator:
+        raise ValueError('the time window must be a start and end time (e.g. 9-17 or 9:30-17:00)')
+    # A window starting at 24:00 starts at midnight, but one ending at 24:00 ends at the end of the day.
+    start = _parse_time_of_day(raw_start) % (24 * 60)
+    end = _parse_time_of_day(raw_end)
+    if start == end:
+        raise ValueError('the time window must not be empty')
+    return BandwidthRule(rate, start, end)
+
+
+def _parse_time_of_day(raw_time: str) -> int:
+    """Parses a time of day in hours, and optionally minutes (e.g. 9 or 9:30), into minutes after midnight."""
+    raw_hours, _, raw_minutes = raw_time.strip().partition(':')
+    try:
+        hours = int(raw_hours)
+        minutes = int(raw_minutes) if raw_minutes else 0
+    except ValueError:
+        raise ValueError(f'invalid time of day: {raw_time.strip()}')
+    # Allow 24:00 to end a window at midnight.
+    if not (0 <= hours <= 24 and 0 <= minutes < 60) or hours * 60 + minutes > 24 * 60:
+        raise ValueError(f'invalid time of day: {raw_time.strip()}')
+    return hours * 60 + minutes
+
+
+class RateLimiter:
+    """
+    A token bucket that limits the rate of bytes shared by every transfer that consumes from it.
+
+    Consuming more bytes than are available reserves them, and waits until the bucket has refilled enough,
+    so a large consumption is allowed, but every consumption after it waits longer.
+    Reservations are made while holding a lock, but waiting is done without it,
+    so many threads share the rate fairly without serializing their transfers.
+    Safe to use from multiple threads.
+    """
+
+    rules: list[BandwidthRule]
+    _lock: Lock
+    _rate: Optional[float]
+    _tokens: float
+    _last_refill: float
+    _rate_checked_at: Optional[float]
+
+    def __init__(self, rules: list[BandwidthRule]) -> None:
+        """
+        Initializes the RateLimiter.
+
+        :param rules: The bandwidth limits, in bytes per second. The first rule that applies at the time is used,
+                      and transfers are unlimited when none applies.
+        """
+        self.rules = rules
+        self._lock = Lock()
+        self._rate = None
+        self._tokens = 0
+        self._last_refill = time.monotonic()
+        self._rate_checked_at = None
+
+    def rate_at(self, moment: datetime) -> Optional[float]:
+        """
+        Gets the rate that applies at a moment.
+
+        :param moment: The moment, in local time.
+        :return: The rate in bytes per second, or None if transfers are unlimited.
+        """
+        minute = moment.hour * 60 + moment.minute
+        return next((rule.rate for rule in self.rules if rule.applies_at(minute)), None)
+
+    def consume(self, amount: int) -> None:
+        """
+        Consumes bytes from the bucket, waiting until the rate allows them.
+
+        :param amount: The number of bytes.
+        """
+        with self._lock:
+            now = time.monotonic()
+            # Only check the schedule once in a while, as getting the time of day is comparatively slow.
+            if self._rate_checked_at is None or now - self._rate_checked_at >= SCHEDULE_CHECK_INTERVAL:
+                self._rate = self.rate_at(datetime.now())
+                self._rate_checked_at = now
+            if self._rate is None:
+                self._last_refill = now
+                return
+            self._tokens = min(self._rate * BURST_DURATION, self._tokens + (now - self._last_refill) * self._rate)
+            self._last_refill = now
+            self._tokens -= amount
+            wait = -self._tokens / self._rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ThrottledReader:
+    """
+    A readable stream that consumes the bytes read from another stream from a RateLimiter,
+    such as the body of a request being sent.
+    Seeking is passed through, so that requests can still be retried.
+    """
+
+    _source: object
+    _limiter: RateLimiter
+    _unconsumed: int
+
+    def __init__(self, source, limiter: RateLimiter) -> None:
+        """
+        Initializes the ThrottledReader.
+
+        :param source: The stream to read from, or bytes.
+        :param limiter: The RateLimiter to consume the bytes read from.
+        """
+        if isinstance(source, (bytes, bytearray)):
+            source = _BytesReader(source)
+        self._source = source
+        self._limiter = limiter
+        self._unconsumed = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._source.read(size)
+        self._unconsumed += len(data)
+        if self._unconsumed >= THROTTLE_CHUNK_SIZE or not data:
+            self._limiter.consume(self._unconsumed)
+            self._unconsumed = 0
+        return data
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        return self._source.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._source.tell()
+
+    def __getattr__(self, name: str):
+        return getattr(self._source, name)
+
+
+class ThrottledBody:
+    """
+    A response body (see botocore's StreamingBody) that consumes the bytes read from it from a RateLimiter.
+    """
+
+    _body: object
+    _limiter: RateLimiter
+    _unconsumed: int
+
+    def __init__(self, body, limiter: RateLimiter) -> None:
+        """
+        Initializes the ThrottledBody.
+
+        :param body: The body of a response, such as the 'Body' of a get_object() response.
+        :param limiter: The RateLimiter to consume the bytes read from.
+        """
+        self._body = body
+        self._limiter = limiter
+        self._unconsumed = 0
+
+    def read(self, amt: Optional[int] = None) -> bytes:
+        data = self._body.read(amt)
+        self._unconsumed += len(data)
+        if self._unconsumed >= THROTTLE_CHUNK_SIZE or not data or amt is None:
+            self._limiter.consume(self._unconsumed)
+            self._unconsumed = 0
+        return data
+
+    def iter_chunks(self, chunk_size: int = 1024) -> Iterator[bytes]:
+        while True:
+            data = self.read(chunk_size)
+            if not data:
+                break
+            yield data
+
+    def __iter__(self) -> Iterator[bytes]:
+        return self.iter_chunks()
+
+    def __getattr__(self, name: str):
+        return getattr(self._body, name)
+
+
+class _BytesReader:
+    """A minimal seekable stream of bytes, without copying them like io.BytesIO does."""
+
+    def __init__(self, data: bytes) -> None:
+        self._data = memoryview(data)
+        self._position = 0
+
+    def read(self, size: int = -1) -> bytes:
+        end = len(self._data) if size is None or size < 0 else self._position + size
+        data = bytes(self._data[self._position:end])
+        self._position += len(data)
+        return data
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        self._position = offset if whence == 0 else (self._position if whence == 1 else len(self._data)) + offset
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+
+def throttle_client(s3_client, limiter: RateLimiter) -> None:
+    """
+    Throttles every request and response body of the S3 Client through the RateLimiter, through botocore's event hooks.
+    Covers every transfer made through the client, including the parts of transfers made by its transfer manager,
+    so that concurrent transfers share the limit.
+
+    :param s3_client: The S3 Client to throttle.
+    :param limiter: The RateLimiter shared by every transfer.
+    """
+    def throttle_request(request, **kwargs) -> None:
+        # Called before each attempt of a request is sent.
+        if request.body:
+            request.body = ThrottledReader(request.body, limiter)
+
+    def throttle_response(parsed: dict, **kwargs) -> None:
+        if 'Body' in parsed:
+            parsed['Body'] = ThrottledBody(parsed['Body'], limiter)
+
+    events = s3_client.meta.events
+    events.register('before-send.s3', throttle_request)
+    events.register('after-call.s3', throttle_response)
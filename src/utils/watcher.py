@@ -0,0 +1,336 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+from abc import ABC, abstractmethod
+from typing import Iterable, NamedTuple, Optional
+
+from .scanner import scan_directory
+
+
+# inotify event flags (see inotify(7)).
+IN_MODIFY: int = 0x00000002
+IN_ATTRIB: int = 0x00000004
+IN_CLOSE_WRITE: int = 0x00000008
+IN_MOVED_FROM: int = 0x00000040
+IN_MOVED_TO: int = 0x00000080
+IN_CREATE: int = 0x00000100
+IN_DELETE: int = 0x00000200
+IN_DELETE_SELF: int = 0x00000400
+IN_Q_OVERFLOW: int = 0x00004000
+IN_IGNORED: int = 0x00008000
+IN_ONLYDIR: int = 0x01000000
+IN_DONT_FOLLOW: int = 0x02000000
+IN_EXCL_UNLINK: int = 0x04000000
+IN_ISDIR: int = 0x40000000
+IN_NONBLOCK: int = 0o4000
+IN_CLOEXEC: int = 0o2000000
+# The events watched in every directory.
+WATCH_MASK: int = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+                   | IN_DELETE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+# The layout of the fixed size part of each inotify event: wd, mask, cookie, and the length of the name.
+EVENT_HEADER: struct.Struct = struct.Struct('iIII')
+# The number of bytes to read events into at once.
+EVENT_BUFFER_SIZE: int = 64 * 1024
+# The default number of seconds between scans, when changes are found by scanning.
+DEFAULT_POLL_INTERVAL: float = 60
+
+
+# The changes found by a DirectoryWatcher. Paths are relative to the watched directory.
+class Changes(NamedTuple):
+    # Files that may have changed, and directories whose every file may have changed (e.g. moved in).
+    changed: set[str]
+    # Files and directories that were deleted or moved away.
+    removed: set[str]
+    # True if changes were lost (e.g. the inotify queue overflowed), so the whole directory must be scanned again.
+    overflowed: bool = False
+
+
+class DirectoryWatcher(ABC):
+    """
+    Finds the changes made to a directory (including in subdirectories). Not safe to use from multiple threads.
+
+    Changes to ignored paths (and anything in them) are never reported, such as the program's own state database,
+    which would otherwise be changed by backing up each change, and so be reported again forever.
+    """
+
+    directory: str
+    ignored_paths: frozenset[str]
+
+    def is_ignored(self, relative_path: str) -> bool:
+        """
+        Checks if a path is ignored.
+
+        :param relative_path: The path, relative to the directory.
+        :return: True if the path is an ignored path or in one, otherwise False.
+        """
+        while relative_path:
+            if relative_path in self.ignored_paths:
+                return True
+            relative_path = os.path.dirname(relative_path)
+        return False
+
+    def _ignore_paths(self, ignored_paths: Iterable[str]) -> None:
+        """Sets the ignored paths, relative to the directory, from their paths. Paths outside of it are dropped."""
+        directory = os.path.realpath(self.directory)
+        relative_paths = set()
+        for path in ignored_paths:
+            relative_path = os.path.relpath(os.path.realpath(path), directory)
+            if relative_path != os.curdir and relative_path.split(os.sep)[0] != os.pardir:
+                relative_paths.add(relative_path)
+        self.ignored_paths = frozenset(relative_paths)
+
+    @abstractmethod
+    def read_changes(self, timeout: Optional[float] = None) -> Optional[Changes]:
+        """
+        Waits for changes to be made to the directory.
+
+        :param timeout: The most seconds to wait, or None to wait until there are changes.
+        :return: The changes since the last call, or None if there were none before the timeout.
+        """
+
+    def close(self) -> None:
+        """Stops watching the directory."""
+
+    def __enter__(self) -> 'DirectoryWatcher':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class InotifyWatcher(DirectoryWatcher):
+    """
+    Watches a directory with Linux's inotify, which reports changes as soon as they're made,
+    without scanning the directory. Every subdirectory is watched, including ones created later.
+    Symbolic links are not followed.
+    """
+
+    _fd: int
+    _paths: dict[int, str]
+    _libc: ctypes.CDLL
+
+    def __init__(self, directory: str, ignored_paths: Iterable[str] = ()) -> None:
+        """
+        Starts watching the directory.
+
+        :param directory: The directory to watch.
+        :param ignored_paths: The paths of files and directories whose changes are never reported.
+        :raises OSError: If inotify isn't available, or a subdirectory can't be watched
+                         (e.g. the limit on the number of watches was reached).
+        """
+        self.directory = directory
+        self._ignore_paths(ignored_paths)
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self._paths = {}
+        try:
+            self._watch_tree('')
+        except OSError:
+            self.close()
+            raise
+
+    def read_changes(self, timeout: Optional[float] = None) -> Optional[Changes]:
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return None
+        changes = Changes(set(), set())
+        while True:
+            try:
+                buffer = os.read(self._fd, EVENT_BUFFER_SIZE)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, cookie, name_length = EVENT_HEADER.unpack_from(buffer, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(buffer[offset:offset + name_length].rstrip(b'\0'))
+                offset += name_length
+                if self._handle_event(wd, mask, name, changes):
+                    changes = changes._replace(overflowed=True)
+        return changes
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def _handle_event(self, wd: int, mask: int, name: str, changes: Changes) -> bool:
+        """Adds the change an event describes to the changes. Returns True if changes were lost."""
+        if mask & IN_Q_OVERFLOW:
+            return True
+        directory_path = self._paths.get(wd)
+        if mask & IN_IGNORED:
+            # The directory was deleted or moved away.
+            self._paths.pop(wd, None)
+            return False
+        if directory_path is None or mask & IN_DELETE_SELF:
+            return False
+        relative_path = os.path.join(directory_path, name)
+        if self.is_ignored(relative_path):
+            return False
+        if mask & (IN_DELETE | IN_MOVED_FROM):
+            changes.removed.add(relative_path)
+            changes.changed.discard(relative_path)
+            if mask & IN_ISDIR:
+                self._unwatch_tree(relative_path)
+            return False
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                # Files may be created in a new directory before it's watched, so it's scanned as a whole.
+                changes.changed.add(relative_path)
+                changes.removed.discard(relative_path)
+                try:
+                    self._watch_tree(relative_path)
+                except OSError:
+                    return True
+            return False
+        changes.changed.add(relative_path)
+        changes.removed.discard(relative_path)
+        return False
+
+    def _watch_tree(self, relative_path: str) -> None:
+        """Watches a directory and every subdirectory of it."""
+        self._watch(relative_path)
+        directories = [relative_path]
+        while directories:
+            relative_directory = directories.pop()
+            try:
+                entries = os.scandir(os.path.join(self.directory, relative_directory))
+            except OSError:
+                continue
+            with entries:
+                for entry in entries:
+                    try:
+                        if entry.is_symlink() or not entry.is_dir():
+                            continue
+                    except OSError:
+                        continue
+                    relative_subdirectory = os.path.join(relative_directory, entry.name)
+                    if self.is_ignored(relative_subdirectory):
+                        continue
+                    if self._watch(relative_subdirectory):
+                        directories.append(relative_subdirectory)
+
+    def _watch(self, relative_path: str) -> bool:
+        """Watches a single directory. Returns False if it no longer exists."""
+        path = os.fsencode(os.path.join(self.directory, relative_path))
+        wd = self._libc.inotify_add_watch(self._fd, path, WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR):
+                return False
+            raise OSError(error, os.strerror(error), path)
+        self._paths[wd] = relative_path
+        return True
+
+    def _unwatch_tree(self, relative_path: str) -> None:
+        """Stops watching a directory that was moved away, and every subdirectory of it."""
+        prefix = os.path.join(relative_path, '')
+        for wd, path in list(self._paths.items()):
+            if path == relative_path or path.startswith(prefix):
+                del self._paths[wd]
+                self._libc.inotify_rm_watch(self._fd, wd)
+
+
+class PollingWatcher(DirectoryWatcher):
+    """
+    Watches a directory by scanning it periodically, and comparing each scan to the one before it.
+    Used where inotify isn't available. Only the scans' metadata is compared, so files are never read.
+    """
+
+    poll_interval: float
+    followlinks: bool
+    _files: dict[str, tuple[int, int, int]]
+    _last_scan: float
+
+    def __init__(self, directory: str, poll_interval: float = DEFAULT_POLL_INTERVAL, followlinks: bool = False,
+                 ignored_paths: Iterable[str] = ()) -> None:
+        """
+        Starts watching the directory, scanning it for the first time.
+
+        :param directory: The directory to watch.
+        :param poll_interval: The number of seconds between scans.
+        :param followlinks: True to follow symbolic links, False to skip them.
+        :param ignored_paths: The paths of files and directories whose changes are never reported.
+        """
+        self.directory = directory
+        self._ignore_paths(ignored_paths)
+        self.poll_interval = poll_interval
+        self.followlinks = followlinks
+        self._files = self._scan()
+        self._last_scan = time.monotonic()
+
+    def read_changes(self, timeout: Optional[float] = None) -> Optional[Changes]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            next_scan = self._last_scan + self.poll_interval
+            if deadline is not None and deadline < next_scan:
+                time.sleep(max(0.0, deadline - time.monotonic()))
+                return None
+            time.sleep(max(0.0, next_scan - time.monotonic()))
+            files = self._scan()
+            self._last_scan = time.monotonic()
+            changed = {path for path, metadata in files.items() if self._files.get(path) != metadata}
+            removed = self._files.keys() - files.keys()
+            self._files = files
+            if changed or removed:
+                return Changes(changed, removed)
+
+    def _scan(self) -> dict[str, tuple[int, int, int]]:
+        """Scans the directory, getting the size, modification time, and inode of every file."""
+        return {file.relative_path: (file.size, file.mtime_ns, file.inode)
+                for file in scan_directory(self.directory, self.followlinks) if not self.is_ignored(file.relative_path)}
+
+
+def create_watcher(directory: str, poll_interval: float = DEFAULT_POLL_INTERVAL,
+                   ignored_paths: Iterable[str] = ()) -> DirectoryWatcher:
+    """
+    Starts watching the directory with inotify, or by scanning it periodically if inotify isn't available.
+
+    :param directory: The directory to watch.
+    :param poll_interval: The number of seconds between scans, if the directory is scanned.
+    :param ignored_paths: The paths of files and directories whose changes are never reported.
+    :return: The DirectoryWatcher.
+    """
+    try:
+        return InotifyWatcher(directory, ignored_paths)
+    except (OSError, AttributeError):
+        return PollingWatcher(directory, poll_interval, ignored_paths=ignored_paths)
+
+
+def collect_changes(watcher: DirectoryWatcher, debounce: float, max_delay: float) -> Changes:
+    """
+    Waits for changes, then keeps collecting them until none are made for a while,
+    so that a burst of writes (e.g. to the same file) is handled once.
+
+    :param watcher: The DirectoryWatcher to read changes from.
+    :param debounce: The number of seconds without changes that ends a burst.
+    :param max_delay: The most seconds to keep collecting changes for, so that constant changes are still handled.
+    :return: The changes, merged.
+    """
+    changes = watcher.read_changes()
+    while changes is None:
+        changes = watcher.read_changes()
+    deadline = time.monotonic() + max_delay
+    while not changes.overflowed:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        more_changes = watcher.read_changes(min(debounce, remaining))
+        if more_changes is None:
+            break
+        # Later changes supersede earlier ones to the same path (e.g. a file deleted then created again).
+        changes.changed.difference_update(more_changes.removed)
+        changes.removed.difference_update(more_changes.changed)
+        changes.changed.update(more_changes.changed)
+        changes.removed.update(more_changes.removed)
+        changes = changes._replace(overflowed=more_changes.overflowed)
+    return changes
@@ -0,0 +1,93 @@
+from queue import Queue
+from threading import Thread
+from typing import Callable, Iterable, Iterator, Optional, TypeVar
+
+
+T = TypeVar('T')
+
+# Marks the end of the items in the queue.
+_DONE = object()
+
+
+def run_workers(worker: Callable[[T], None], items: Iterable[T], jobs: int = 1, backlog: Optional[int] = None) -> None:
+    """
+    Calls worker() on every item, using a pool of threads.
+
+    Items are fed to the threads through a bounded queue,
+    so producing the items (e.g. walking a directory or listing a bucket) overlaps with working on them,
+    without ever holding every item in memory.
+    If a call to worker() raises an exception, the remaining items are still worked on,
+    then the first exception is raised once every thread has finished.
+
+    :param worker: The function to call on each item. Must be safe to call from multiple threads.
+    :param items: The items to work on.
+    :param jobs: The number of threads. If 1, the items are worked on in the calling thread.
+    :param backlog: The maximum number of items waiting in the queue. Defaults to twice the number of threads.
+    """
+    if jobs <= 1:
+        for item in items:
+            worker(item)
+        return
+    if backlog is None:
+        backlog = jobs * 2
+    queue = Queue(maxsize=backlog)
+    errors = []
+
+    def work() -> None:
+        while True:
+            item = queue.get()
+            if item is _DONE:
+                return
+            try:
+                worker(item)
+            except BaseException as e:
+                errors.append(e)
+
+    threads = [Thread(target=work, daemon=True) for _ in range(jobs)]
+    for thread in threads:
+        thread.start()
+    try:
+        for item in items:
+            queue.put(item)
+    finally:
+        # Always stop the threads, even if producing the items failed.
+        for _ in threads:
+            queue.put(_DONE)
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+
+
+def prefetch(items: Iterable[T], backlog: int = 0) -> Iterator[T]:
+    """
+    Produces the items in a background thread, yielding them as they become available.
+
+    Lets a slow producer (e.g. scanning a directory) run ahead of its consumer,
+    rather than only producing an item each time the consumer asks for one.
+    If producing the items raises an exception, it is raised by this generator after the items produced before it.
+
+    :param items: The items to produce.
+    :param backlog: The maximum number of items produced ahead of the consumer, or 0 for no maximum.
+    :return: The items, in order.
+    """
+    queue = Queue(maxsize=backlog)
+    errors = []
+
+    def produce() -> None:
+        try:
+            for item in items:
+                queue.put(item)
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            queue.put(_DONE)
+
+    Thread(target=produce, daemon=True).start()
+    while True:
+        item = queue.get()
+        if item is _DONE:
+            break
+        yield item
+    if errors:
+        raise errors[0]
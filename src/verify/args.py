@@ -0,0 +1,69 @@
+import os
+from argparse import ArgumentParser, ArgumentTypeError, Namespace
+from typing import Optional
+
+
+class Arguments:
+    """Data class for storing command line arguments."""
+
+    def __init__(self, args: Namespace) -> None:
+        """
+        Initializes the object from the Namespace object.
+        :param args: The Namespace from ArgumentParser.parse_args().
+        """
+        self.local_dir: str = args.local
+        self.bucket_name: str = args.backup[0]
+        self.bucket_dir: str = args.backup[1]
+        self.jobs: int = args.jobs
+        self.hash_processes: Optional[int] = args.hash_processes
+        self.report_file: Optional[str] = args.report
+        self.profile_file: Optional[str] = args.profile
+
+
+def parse_arguments() -> Arguments:
+    """
+    Parses command line arguments.
+    Exits the program if the arguments are invalid.
+    :return: The parsed arguments.
+    """
+    parser = ArgumentParser(description='Verifies that a directory matches its backup in AWS, '
+                                        'without downloading the backup.')
+    parser.add_argument('local', metavar='directory', type=directory,
+                        help='directory to verify, such as the backed up directory or a restored one')
+    parser.add_argument('backup', metavar='bucket::directory', type=bucket_and_directory,
+                        help='bucket and directory of the backup to verify against')
+    parser.add_argument('-j', '--jobs', type=positive_integer, default=1,
+                        help='number of requests to make concurrently (default: 1)')
+    parser.add_argument('--hash-processes', metavar='count', type=positive_integer,
+                        help='number of processes to hash files in (default: number of CPUs)')
+    parser.add_argument('--report', metavar='file',
+                        help='write metrics of the run (requests, latencies, and time spent in each phase) as JSON')
+    parser.add_argument('--profile', metavar='file',
+                        help='write a cProfile profile of the run, which can be read with pstats')
+    return Arguments(parser.parse_args())
+
+
+def directory(raw_path: str) -> str:
+    """Meant to be used a type converter for ArgumentParser.add_argument()."""
+    if not os.path.isdir(raw_path):
+        raise ArgumentTypeError('no such directory')
+    return raw_path
+
+
+def bucket_and_directory(name: str) -> tuple[str, str]:
+    """Meant to be used a type converter for ArgumentParser.add_argument()."""
+    elements = name.split('::')
+    if len(elements) != 2:
+        raise ArgumentTypeError('missing bucket directory')
+    return elements[0], elements[1]
+
+
+def positive_integer(raw_integer: str) -> int:
+    """Meant to be used a type converter for ArgumentParser.add_argument()."""
+    try:
+        integer = int(raw_integer)
+    except ValueError:
+        raise ArgumentTypeError('not an integer')
+    if integer < 1:
+        raise ArgumentTypeError('must be at least 1')
+    return integer
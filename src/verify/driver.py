@@ -0,0 +1,75 @@
+import sys
+from functools import partial
+
+from .args import Arguments, parse_arguments
+from .verify import EXTRA, MATCHED, MISMATCHED, MISSING, UNVERIFIED, verify_directory
+from ..restore.restore import bucket_exists
+from ..utils.chunks import get_delta_index
+from ..utils.client import create_client
+from ..utils.dedup import get_dedup_manifest
+from ..utils.listing import list_bucket_directory
+from ..utils.metrics import Metrics, run_with_metrics
+from ..utils.packs import get_pack_index
+from ..utils.progress import ProgressLogger
+from ..utils.scanner import scan_directory
+from ..utils.size import files_summary, format_size
+
+
+# The label printed before each file with a result worth listing.
+RESULT_LABELS: dict[str, str] = {MISMATCHED: 'Mismatched', MISSING: 'Missing', EXTRA: 'Extra'}
+
+
+def main():
+    args = parse_arguments()
+    run_with_metrics(partial(verify, args), args.report_file, args.profile_file)
+
+
+def verify(args: Arguments, metrics: Metrics) -> None:
+    """
+    Runs the verify program. Exits with status 1 if any file is mismatched, missing, or extra.
+
+    :param args: The parsed command line arguments.
+    :param metrics: The Metrics to record the phases of the program and the requests of its client in.
+    """
+    # Create a reusable client.
+    s3_client = create_client(args.jobs)
+    metrics.instrument(s3_client)
+    if not bucket_exists(args.bucket_name, s3_client):
+        print(f'Error: The bucket {args.bucket_name} does not exist.', file=sys.stderr)
+        sys.exit(1)
+    # Scan the directory and list the bucket directory once each, before any file is read.
+    print('Scanning the directory and listing the backup...')
+    with metrics.phase('scan'):
+        files = list(scan_directory(args.local_dir))
+        directory_info = files_summary(files)
+    with metrics.phase('list'):
+        object_index = list_bucket_directory(args.bucket_name, args.bucket_dir, s3_client, args.jobs)
+    with metrics.phase('get_indexes'):
+        pack_index = get_pack_index(args.bucket_name, args.bucket_dir, s3_client)
+        dedup_manifest = get_dedup_manifest(args.bucket_name, args.bucket_dir, s3_client)
+        delta_index = get_delta_index(args.bucket_name, args.bucket_dir, s3_client)
+    progress = ProgressLogger(directory_info.file_count, directory_info.total_size)
+    formatted_directory_size = format_size(directory_info.total_size)
+    print(f'Verifying {directory_info.file_count} files ({formatted_directory_size}).')
+    progress.print_progress_info()
+
+    def print_result(relative_path: str, result: str) -> None:
+        # Only list the files that don't match their backup.
+        label = RESULT_LABELS.get(result)
+        if label is not None:
+            print(f'{label:<18}{relative_path}')
+
+    with metrics.phase('verify'):
+        results = verify_directory(args.local_dir, args.bucket_name, args.bucket_dir, s3_client, args.jobs,
+                                   args.hash_processes, files, object_index, pack_index, dedup_manifest,
+                                   delta_index, progress, print_result)
+    # Redraw the final progress, in case the last redraw was skipped.
+    progress.print_progress_info()
+    print(f'\nVerification completed: {results[MATCHED]} matched, {results[MISMATCHED]} mismatched, '
+          f'{results[MISSING]} missing, {results[EXTRA]} extra, {results[UNVERIFIED]} unverified.')
+    if results[MISMATCHED] or results[MISSING] or results[EXTRA]:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,327 @@
+import hashlib
+import mmap
+import os
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from threading import Lock
+from typing import Callable, Iterable, NamedTuple, Optional
+
+import boto3
+from botocore.exceptions import ClientError
+
+from ..utils.chunks import DeltaIndex, get_chunk_manifest, get_delta_index
+from ..utils.compression import COMPRESSION_METADATA
+from ..utils.dedup import HASH_CHUNK_SIZE, MMAP_THRESHOLD, DedupManifest, get_dedup_manifest
+from ..utils.listing import ObjectIndex, list_bucket_directory, parse_etag
+from ..utils.manifest import is_metadata_path
+from ..utils.multipart import guess_part_size
+from ..utils.packs import PackIndex, get_pack_index
+from ..utils.progress import ProgressLogger
+from ..utils.scanner import FileEntry, scan_directory
+from ..utils.snapshots import BLOB_KIND, DELTA_KIND, OBJECT_KIND, PACK_KIND
+
+
+# The results of verifying a file.
+# Unverified files are the same size as their backup, but their backup has no checksum to compare them against
+# (e.g. packed or compressed files, or objects encrypted with KMS).
+MATCHED: str = 'matched'
+MISMATCHED: str = 'mismatched'
+MISSING: str = 'missing'
+EXTRA: str = 'extra'
+UNVERIFIED: str = 'unverified'
+# Files are hashed in batches of ranges (parts or chunks) of about this many bytes,
+# so that the ranges of a large file are hashed in several processes at once,
+# and each task is still worth sending to another process.
+HASH_BATCH_SIZE: int = 64 * 1024 * 1024
+
+
+# What the backup of a file says about its contents.
+# The checksum is the ETag of a file in its own object, or the SHA-256 digest of a deduplicated file.
+# Files backed up as chunks have the digest of their chunk manifest instead (which has the digest of each chunk),
+# if they have one, and packed files have none.
+class BackedUpFile(NamedTuple):
+    size: int
+    kind: str
+    last_modified: datetime
+    checksum: Optional[str] = None
+
+
+# How to check a file: hash ranges of it with an algorithm, then pass the digests to a function that compares them.
+class _Check(NamedTuple):
+    algorithm: str
+    ranges: list[tuple[int, int]]
+    matches: Callable[[list[bytes]], bool]
+
+
+def backed_up_files(object_index: ObjectIndex, pack_index: PackIndex, dedup_manifest: DedupManifest,
+                    delta_index: DeltaIndex) -> dict[str, BackedUpFile]:
+    """
+    Gathers every file in a backup from the listing of its bucket directory and its indexes.
+    Like restore_directory(), a file in more than one of them is taken from whichever was updated last.
+
+    :param object_index: The objects in the bucket directory (see list_bucket_directory()).
+    :param pack_index: The pack index of the bucket directory.
+    :param dedup_manifest: The dedup manifest of the bucket directory.
+    :param delta_index: The delta index of the bucket directory.
+    :return: Every backed up file, by relative path.
+    """
+    files = {}
+
+    def add(relative_path: str, backed_up_file: BackedUpFile) -> None:
+        current = files.get(relative_path)
+        if current is None or current.last_modified < backed_up_file.last_modified:
+            files[relative_path] = backed_up_file
+
+    for object_info in object_index:
+        relative_path = object_info.key[len(object_index.prefix):]
+        if not is_metadata_path(relative_path):
+            add(relative_path, BackedUpFile(object_info.size, OBJECT_KIND, object_info.last_modified, object_info.etag))
+    for relative_path, entry in pack_index.entries.items():
+        add(relative_path, BackedUpFile(entry.length, PACK_KIND, pack_index.last_modified))
+    for relative_path, entry in dedup_manifest.entries.items():
+        add(relative_path, BackedUpFile(entry.size, BLOB_KIND, dedup_manifest.last_modified, entry.digest))
+    for relative_path, entry in delta_index.entries.items():
+        add(relative_path, BackedUpFile(entry.size, DELTA_KIND, delta_index.last_modified, entry.manifest))
+    return files
+
+
+def hash_ranges(file_path: str, algorithm: str, ranges: list[tuple[int, int]]) -> list[bytes]:
+    """
+    Hashes ranges of the file, such as the parts it was uploaded in.
+    Large files are mapped into memory rather than read, so they are never copied into Python.
+    Meant to be run in another process.
+
+    :param file_path: The file path on this machine.
+    :param algorithm: The name of the hash algorithm (see hashlib.new()).
+    :param ranges: The offset and length of each range.
+    :return: The digest of each range.
+    """
+    digests = []
+    with open(file_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+                # Each byte is read once, in order, so let the kernel read ahead and drop pages behind.
+                if hasattr(mapped_file, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+                    mapped_file.madvise(mmap.MADV_SEQUENTIAL)
+                with memoryview(mapped_file) as data:
+                    for offset, length in ranges:
+                        digests.append(hashlib.new(algorithm, data[offset:offset + length]).digest())
+            return digests
+        for offset, length in ranges:
+            digest = hashlib.new(algorithm)
+            f.seek(offset)
+            remaining = length
+            while remaining > 0:
+                chunk = f.read(min(remaining, HASH_CHUNK_SIZE))
+                if not chunk:
+                    break
+                digest.update(chunk)
+                remaining -= len(chunk)
+            digests.append(digest.digest())
+    return digests
+
+
+def split_ranges(size: int, part_size: int) -> list[tuple[int, int]]:
+    """Splits a file of the given size into consecutive ranges of the part size (the last one may be shorter)."""
+    return [(offset, min(part_size, size - offset)) for offset in range(0, size, part_size)] or [(0, 0)]
+
+
+def batch_ranges(ranges: list[tuple[int, int]]) -> list[list[tuple[int, int]]]:
+    """Groups consecutive ranges into batches of about HASH_BATCH_SIZE bytes (or a single larger range)."""
+    batches = []
+    batch = []
+    batch_length = 0
+    for offset, length in ranges:
+        if batch and batch_length + length > HASH_BATCH_SIZE:
+            batches.append(batch)
+            batch = []
+            batch_length = 0
+        batch.append((offset, length))
+        batch_length += length
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def plan_check(bucket_name: str, bucket_directory: str, relative_path: str, backed_up_file: BackedUpFile,
+               s3_client) -> Optional[_Check]:
+    """
+    Plans how to check a file against its backup, which must be the same size.
+
+    A file in its own object is checked against the object's ETag, which is the MD5 digest of the file,
+    or for a multipart upload, the MD5 digest of the MD5 digests of its parts (see file_etag()).
+    A deduplicated file is checked against its SHA-256 digest from the dedup manifest,
+    and a file backed up as chunks against the SHA-256 digest of each chunk from its chunk manifest.
+
+    :param bucket_name: The name of the bucket.
+    :param bucket_directory: The name of the backed up directory in the bucket.
+    :param relative_path: The relative path of the file.
+    :param backed_up_file: The backup of the file.
+    :param s3_client: The S3 Client to download the chunk manifest of a file backed up as chunks with.
+    :return: The check, or None if the file's backup has no checksum to check it against.
+    :raises ClientError: If the chunk manifest can't be downloaded.
+    """
+    size = backed_up_file.size
+    if backed_up_file.kind == OBJECT_KIND:
+        digest, parts = parse_etag(backed_up_file.checksum)
+        if digest is None:
+            return None
+        if parts == 0:
+            return _Check('md5', [(0, size)], lambda digests: digests[0] == digest)
+        ranges = split_ranges(size, guess_part_size(size, parts))
+        return _Check('md5', ranges,
+                      lambda digests: len(digests) == parts and hashlib.md5(b''.join(digests)).digest() == digest)
+    if backed_up_file.kind == BLOB_KIND:
+        return _Check('sha256', [(0, size)], lambda digests: digests[0].hex() == backed_up_file.checksum)
+    if backed_up_file.kind == DELTA_KIND:
+        chunks = get_chunk_manifest(bucket_name, bucket_directory, relative_path, s3_client, backed_up_file.checksum)
+        # A file without a chunk manifest can't be restored, so it doesn't match its backup.
+        chunks = [] if chunks is None else list(chunks)
+        expected_digests = [chunk.digest for chunk in chunks]
+        ranges = [(chunk.offset, chunk.length) for chunk in chunks]
+        chunks_size = sum(length for _, length in ranges)
+        return _Check('sha256', ranges or [(0, 0)],
+                      lambda digests: chunks_size == size and [d.hex() for d in digests] == expected_digests)
+    return None
+
+
+def is_compressed(bucket_name: str, object_key: str, s3_client) -> bool:
+    """Determines if the object was compressed when it was backed up, from its metadata."""
+    try:
+        response = s3_client.head_object(Bucket=bucket_name, Key=object_key)
+    except ClientError:
+        return False
+    return COMPRESSION_METADATA in response.get('Metadata', {})
+
+
+def verify_directory(directory: str, bucket_name: str, bucket_directory: str, s3_client=None, jobs: int = 1,
+                     processes: Optional[int] = None, files: Optional[Iterable[FileEntry]] = None,
+                     object_index: Optional[ObjectIndex] = None, pack_index: Optional[PackIndex] = None,
+                     dedup_manifest: Optional[DedupManifest] = None, delta_index: Optional[DeltaIndex] = None,
+                     progress: Optional[ProgressLogger] = None,
+                     callback: Optional[Callable[[str, str], None]] = None) -> Counter:
+    """
+    Verifies that the directory matches its backup, without downloading the backup.
+
+    The bucket directory is listed once, and every local file is read exactly once, in a pool of processes,
+    to compute the checksums its backup has: the ETag of its object (including multipart ETags),
+    or the SHA-256 digests recorded when it was deduplicated or backed up as chunks.
+    Large files are hashed a batch of parts or chunks at a time, so even a single huge file uses every core.
+    Files that aren't the same size as their backup mismatch without being read,
+    unless their object was compressed (which is checked with a request for each).
+
+    :param directory: The local directory, such as the backed up or a restored directory.
+    :param bucket_name: The name of the bucket.
+    :param bucket_directory: The name of the backed up directory in the bucket.
+    :param s3_client: The S3 Client to use. A simple client will be created if none is specified.
+    :param jobs: The number of list and other requests to make concurrently.
+    :param processes: The number of processes to hash files in. Defaults to the number of CPUs.
+    :param files: The files in the directory (see scan_directory()).
+                  The directory will be scanned if none are specified.
+    :param object_index: The objects in the bucket directory (see list_bucket_directory()).
+                         The bucket directory will be listed if none is specified.
+    :param pack_index: The pack index of the bucket directory. Downloaded if none is specified.
+    :param dedup_manifest: The dedup manifest of the bucket directory. Downloaded if none is specified.
+    :param delta_index: The delta index of the bucket directory. Downloaded if none is specified.
+    :param progress: The ProgressLogger to report the progress of hashing to, if any.
+    :param callback: An optional callback function that will be called with the relative path and result
+                     (e.g. MATCHED) of each file, including missing files.
+    :return: The number of files with each result.
+    """
+    # Create a simple S3 Client if none was specified.
+    if s3_client is None:
+        s3_client = boto3.client('s3')
+    if files is None:
+        files = scan_directory(directory)
+    if object_index is None:
+        object_index = list_bucket_directory(bucket_name, bucket_directory, s3_client, jobs)
+    if pack_index is None:
+        pack_index = get_pack_index(bucket_name, bucket_directory, s3_client)
+    if dedup_manifest is None:
+        dedup_manifest = get_dedup_manifest(bucket_name, bucket_directory, s3_client)
+    if delta_index is None:
+        delta_index = get_delta_index(bucket_name, bucket_directory, s3_client)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    backed_up = backed_up_files(object_index, pack_index, dedup_manifest, delta_index)
+    results = Counter()
+    # Only one thread at a time may record a result, so that the callback's output doesn't interleave.
+    lock = Lock() if progress is None else progress.lock
+
+    def report(relative_path: str, result: str, size: int = 0, hashed_size: int = 0) -> None:
+        with lock:
+            results[result] += 1
+            if callback is not None:
+                callback(relative_path, result)
+            if progress is not None and result != MISSING:
+                progress.complete(size, hashed_size)
+
+    # Files whose object isn't the same size, which match only if the object was compressed.
+    resized_files = []
+    pending = deque()
+    in_flight = 0
+    backlog = processes * 4
+
+    def finish_oldest() -> None:
+        # Wait for the oldest file's batches, showing progress as each one is hashed.
+        nonlocal in_flight
+        file, check, batches = pending.popleft()
+        digests = []
+        hashed_size = 0
+        try:
+            for future, batch_size in batches:
+                digests += future.result()
+                hashed_size += batch_size
+                if progress is not None:
+                    progress.transfer(batch_size)
+            result = MATCHED if check.matches(digests) else MISMATCHED
+        except OSError:
+            # The file couldn't be read, such as if it was deleted after the directory was scanned.
+            result = MISMATCHED
+        in_flight -= len(batches)
+        report(file.relative_path, result, file.size, hashed_size if progress is not None else 0)
+
+    with ProcessPoolExecutor(processes) as executor:
+        for file in files:
+            backed_up_file = backed_up.pop(file.relative_path, None)
+            if backed_up_file is None:
+                if not is_metadata_path(file.relative_path):
+                    report(file.relative_path, EXTRA, file.size)
+                continue
+            if file.size != backed_up_file.size:
+                if backed_up_file.kind == OBJECT_KIND:
+                    resized_files.append(file)
+                else:
+                    report(file.relative_path, MISMATCHED, file.size)
+                continue
+            try:
+                check = plan_check(bucket_name, bucket_directory, file.relative_path, backed_up_file, s3_client)
+            except ClientError:
+                report(file.relative_path, MISMATCHED, file.size)
+                continue
+            if check is None:
+                report(file.relative_path, UNVERIFIED, file.size)
+                continue
+            batches = [(executor.submit(hash_ranges, file.path, check.algorithm, batch),
+                        sum(length for _, length in batch))
+                       for batch in batch_ranges(check.ranges)]
+            pending.append((file, check, batches))
+            in_flight += len(batches)
+            while in_flight >= backlog:
+                finish_oldest()
+        while pending:
+            finish_oldest()
+
+    # Check the metadata of the resized files' objects concurrently, as each is a request.
+    def check_resized(file: FileEntry) -> None:
+        object_key = object_index.prefix + file.relative_path
+        report(file.relative_path, UNVERIFIED if is_compressed(bucket_name, object_key, s3_client) else MISMATCHED,
+               file.size)
+
+    with ThreadPoolExecutor(jobs) as executor:
+        list(executor.map(check_resized, resized_files))
+    for relative_path in sorted(backed_up):
+        report(relative_path, MISSING)
+    return results
@@ -0,0 +1,141 @@
+import hashlib
+import sys
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from threading import Barrier
+
+from src.utils.listing import DELIMITER, ObjectIndex, format_etag, iter_objects, list_objects
+
+
+EPOCH = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def make_object(key: str) -> dict:
+    """Makes a listed object whose size, last modified date, and ETag are all derived from its key."""
+    digest = hashlib.md5(key.encode()).digest()
+    # Every tenth object has an ETag that isn't an MD5 digest, as if it were encrypted with KMS.
+    etag = f'"kms-{digest.hex()}"' if digest[0] % 10 == 0 else format_etag(digest)
+    return {'Key': key, 'Size': int.from_bytes(digest[:4], 'big'),
+            'LastModified': EPOCH + timedelta(seconds=digest[4]), 'ETag': etag}
+
+
+class FakePaginator:
+    """Lists objects from memory, taking longer for shards that sort earlier, so that they finish out of order."""
+
+    def __init__(self, keys: list[str]) -> None:
+        self.keys = sorted(keys)
+
+    def paginate(self, Bucket: str, Prefix: str, Delimiter: str = None):
+        objects = []
+        common_prefixes = set()
+        for key in self.keys:
+            if not key.startswith(Prefix):
+                continue
+            rest = key[len(Prefix):]
+            if Delimiter is not None and Delimiter in rest:
+                common_prefixes.add(Prefix + rest[:rest.index(Delimiter) + 1])
+            else:
+                objects.append(make_object(key))
+        time.sleep(0.02 * (ord(Prefix[-2]) % 5) if len(Prefix) > 1 else 0)
+        # Split the listing into several pages, like S3 does for large listings.
+        for start in range(0, max(len(objects), 1), 7):
+            yield {'Contents': objects[start:start + 7],
+                   'CommonPrefixes': [{'Prefix': prefix} for prefix in sorted(common_prefixes)] if start == 0 else []}
+
+
+class FakeClient:
+    def __init__(self, keys: list[str]) -> None:
+        self.keys = keys
+
+    def get_paginator(self, operation: str) -> FakePaginator:
+        return FakePaginator(self.keys)
+
+
+def make_keys(prefix: str) -> list[str]:
+    return [f'{prefix}{a}{DELIMITER}{b}{DELIMITER}file{c}' for a in 'abcde' for b in 'vwxyz' for c in range(80)] \
+        + [f'{prefix}top{c}' for c in range(5)]
+
+
+class ObjectIndexThreadingTest(unittest.TestCase):
+    def setUp(self) -> None:
+        # Switch threads as often as possible, so that a thread is likely to be interrupted while sorting.
+        self.switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+
+    def tearDown(self) -> None:
+        sys.setswitchinterval(self.switch_interval)
+
+    def check_reads(self, object_index: ObjectIndex, keys: list[str], threads: int = 16) -> None:
+        """Reads every key from many threads at once, checking that each key is paired with its own metadata."""
+        barrier = Barrier(threads)
+
+        def read(offset: int) -> None:
+            barrier.wait()
+            for key in keys[offset:] + keys[:offset]:
+                expected = make_object(key)
+                info = object_index.get(key)
+                self.assertIsNotNone(info, key)
+                self.assertEqual((info.key, info.size, info.last_modified, info.etag),
+                                 (key, expected['Size'], expected['LastModified'], expected['ETag']))
+
+        with ThreadPoolExecutor(threads) as executor:
+            for future in [executor.submit(read, i * len(keys) // threads) for i in range(threads)]:
+                future.result()
+
+    def test_parallel_listing_out_of_order(self):
+        keys = make_keys('dir/')
+        object_index = list_objects('bucket', 'dir/', FakeClient(keys), jobs=8)
+        self.assertEqual(len(object_index), len(keys))
+        self.assertEqual([info.key for info in object_index], sorted(keys))
+        self.check_reads(object_index, keys)
+
+    def test_concurrent_reads_of_unsorted_index(self):
+        keys = make_keys('dir/')
+        for _ in range(5):
+            object_index = ObjectIndex('dir/')
+            for key in reversed(keys):
+                object_index.add_object(make_object(key))
+            self.check_reads(object_index, keys)
+
+
+class IterObjectsTest(unittest.TestCase):
+    def check_objects(self, jobs: int) -> None:
+        keys = make_keys('dir/')
+        listed = {}
+        for info in iter_objects('bucket', 'dir/', FakeClient(keys), jobs, exclude_prefixes=['dir/top']):
+            expected = make_object(info.key)
+            self.assertNotIn(info.key, listed)
+            self.assertEqual((info.size, info.last_modified, info.etag),
+                             (expected['Size'], expected['LastModified'], expected['ETag']))
+            listed[info.key] = info
+        self.assertEqual(sorted(listed), sorted(key for key in keys if not key.startswith('dir/top')))
+
+    def test_serial(self):
+        self.check_objects(1)
+
+    def test_parallel(self):
+        self.check_objects(8)
+
+    def test_listing_overlaps_with_consumer(self):
+        # The first object is yielded long before the slowest shards are listed.
+        started = time.monotonic()
+        objects = iter_objects('bucket', 'dir/', FakeClient(make_keys('dir/')), jobs=8)
+        next(objects)
+        first = time.monotonic() - started
+        for _ in objects:
+            pass
+        self.assertLess(first, (time.monotonic() - started) / 2)
+
+    def test_errors_are_raised(self):
+        class FailingClient(FakeClient):
+            def get_paginator(self, operation: str):
+                raise RuntimeError('listing failed')
+
+        with self.assertRaises(RuntimeError):
+            list(iter_objects('bucket', 'dir/', FailingClient([]), jobs=4))
+
+
+if __name__ == '__main__':
+    unittest.main()